@@ -22,12 +22,19 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import argparse
-import pkg_resources
+import json
+import os
 import subprocess
 import sys
+import threading
 
 import virtdeploy
+from virtdeploy import daemon
 from virtdeploy import errors
+from virtdeploy import metrics
+from virtdeploy import policy
+from virtdeploy import remote
+from virtdeploy import stats
 from virtdeploy import utils
 
 DRIVER = 'libvirt'
@@ -38,10 +45,67 @@ EXITCODE_TIMEOUT = 124
 EXITCODE_KEYBINT = 130
 
 
+def get_driver():
+    # Forward to the daemon when one is running, it holds warm connections
+    client = daemon.get_client()
+
+    if client is not None:
+        return client
+
+    return virtdeploy.get_driver(DRIVER)
+
+
+def print_progress(event):
+    print(u'{0}: [{1}] {2}'.format(event['instance'], event['stage'],
+                                   event['message']), file=sys.stderr)
+
+
 def instance_create(args):
-    driver = virtdeploy.get_driver(DRIVER)
-    instance = driver.instance_create(args.id, args.template)
+    driver = get_driver()
+    kwargs = {}
+
+    if args.profile is not None:
+        from virtdeploy import profiles
+        kwargs['profile'] = profiles.load_profile(args.profile)
+
+    if args.snapshot:
+        kwargs['snapshot'] = True
+
+    if args.tuning is not None:
+        kwargs['tuning'] = args.tuning
+
+    for key in ('disk_bus', 'cache', 'io', 'iothreads', 'net_queues'):
+        if getattr(args, key) is not None:
+            kwargs[key] = getattr(args, key)
+
+    if args.overlay:
+        kwargs['overlay'] = dict(x.partition('=')[::2] for x in args.overlay)
+
+    for key in ('sparsify', 'compress', 'ephemeral'):
+        if getattr(args, key):
+            kwargs[key] = True
+
+    if args.scratch is not None:
+        kwargs['scratch'] = args.scratch
+
+    if args.copy_in:
+        kwargs['files'] = absolute_files(args.copy_in)
+
+    if args.progress:
+        kwargs['progress'] = print_progress
+
+    instance = driver.instance_create(args.id, args.template, **kwargs)
+    remote.forget_addresses([instance['name']])
+    print_instance(instance)
+
+
+def absolute_files(files):
+    # The driver (daemon) may run in another working directory
+    return ['{0}:{1}'.format(os.path.abspath(source), directory)
+            for source, directory in utils.parse_files(files)]
+
 
+def print_instance(instance):
     print('name: {0}'.format(instance['name']))
     print('root password: {0}'.format(instance['password']))
     print('mac address: {0}'.format(instance['mac']))
@@ -49,95 +113,671 @@ def instance_create(args):
     print('ip address: {0}'.format(instance['ipaddress']))
 
 
+def for_each_instance(method, names, workers, **kwargs):
+    # Each worker gets its own driver (and daemon connection)
+    def call(name):
+        return getattr(get_driver(), method)(name, **kwargs)
+
+    exitcode = EXITCODE_SUCCESS
+    succeeded = []
+    results = utils.parallel(call, names, workers)
+
+    for name, (result, error) in zip(names, results):
+        if error is not None:
+            print('{0}: {1}'.format(name, error), file=sys.stderr)
+            exitcode = EXITCODE_FAILURE
+        else:
+            succeeded.append(result)
+
+    return exitcode, succeeded
+
+
+def instance_reset(args):
+    kwargs = {}
+
+    if args.progress:
+        kwargs['progress'] = print_progress
+
+    exitcode, instances = for_each_instance('instance_reset', args.name,
+                                            args.parallel, **kwargs)
+    remote.forget_addresses([x['name'] for x in instances])
+
+    for instance in instances:
+        print_instance(instance)
+
+    return exitcode
+
+
+def instance_clone(args):
+    driver = get_driver()
+    kwargs = {}
+
+    if args.progress:
+        kwargs['progress'] = print_progress
+
+    result = driver.instance_clone(args.name, args.count, args.prefix,
+                                   args.parallel, **kwargs)
+    remote.forget_addresses([x['name'] for x in result['instances']])
+
+    for instance in result['instances']:
+        print_instance(instance)
+
+    for name, error in sorted(result['errors'].items()):
+        print('{0}: {1}'.format(name, error), file=sys.stderr)
+
+    if result['errors']:
+        return EXITCODE_FAILURE
+
+
+def command_apply(args):
+    from virtdeploy import environment
+
+    env = environment.load_environment(args.file)
+    plan = environment.plan_environment(env, get_driver().instance_list(),
+                                        args.reset)
+
+    for action in plan:
+        print('{0}: {1}'.format(action['action'],
+                                action['name'] or action['existing']))
+
+    if args.dry_run:
+        return
+
+    kwargs = {}
+
+    if args.progress:
+        kwargs['progress'] = print_progress
+
+    results = environment.apply_plan(get_driver, env, plan, args.parallel,
+                                     **kwargs)
+    remote.forget_addresses([x[k] for x in plan if x['action'] != 'keep'
+                             for k in ('name', 'existing') if x[k]])
+    exitcode = EXITCODE_SUCCESS
+
+    for action in plan:
+        result, error = results.get(action['id'], (None, None))
+
+        if error is not None:
+            print('{0}: {1}'.format(action['id'], error), file=sys.stderr)
+            exitcode = EXITCODE_FAILURE
+        elif action['action'] in ('create', 'recreate', 'reset'):
+            print_instance(result)
+
+    return exitcode
+
+
+def instance_suspend(args):
+    return for_each_instance('instance_suspend', args.name,
+                             args.parallel)[0]
+
+
+def instance_resume(args):
+    return for_each_instance('instance_resume', args.name,
+                             args.parallel)[0]
+
+
+def instance_benchmark(args):
+    driver = get_driver()
+
+    print(u'{0:32}{1:12}{2:>12}{3:>12}{4:>12}{5:>12}'.format(
+        'NAME', 'TUNING', 'READ IOPS', 'WRITE IOPS', 'READ LAT', 'WRITE LAT'))
+
+    # One at a time, concurrent runs would share the host storage
+    for name in args.name:
+        result = driver.instance_benchmark(name, args.runtime)
+
+        print(u'{0:32}{1:12}{2:>12}{3:>12}{4:>10}us{5:>10}us'.format(
+            name, result['tuning'] or '-', result['read_iops'],
+            result['write_iops'], result['read_latency'],
+            result['write_latency']))
+
+
 def instance_start(args):
-    driver = virtdeploy.get_driver(DRIVER)
+    driver = get_driver()
     driver.instance_start(args.name)
 
     if args.wait:
-        address_found = utils.wait_tcp_access(driver, args.name)
-        if address_found is None:
+        if not utils.wait_instance(driver, args.name):
             return EXITCODE_TIMEOUT
 
     return EXITCODE_SUCCESS
 
 
 def instance_stop(args):
-    driver = virtdeploy.get_driver(DRIVER)
-    return driver.instance_stop(args.name)
+    driver = get_driver()
+
+    if not args.wait:
+        for name in args.name:
+            driver.instance_stop(name)
+        return EXITCODE_SUCCESS
+
+    result = driver.instance_stop_wait(args.name, args.grace)
+
+    for name in args.name:
+        if result[name] == 'destroyed':
+            print('{0}: forced off after the grace period'.format(name),
+                  file=sys.stderr)
+
+    return EXITCODE_SUCCESS
 
 
 def instance_delete(args):
-    driver = virtdeploy.get_driver(DRIVER)
-    return driver.instance_delete(args.name)
+    driver = get_driver()
+
+    try:
+        return driver.instance_delete(args.name)
+    finally:
+        remote.forget_addresses([args.name])
 
 
 def template_list(args):
-    driver = virtdeploy.get_driver(DRIVER)
+    driver = get_driver()
     for template in driver.template_list():
         print(u'{0:24}{1:24}'.format(template['id'], template['name']))
 
 
+def pool_info(args):
+    driver = get_driver()
+    info = driver.pool_info(args.pool)
+
+    print('name: {0}'.format(info['name']))
+
+    for key in ('capacity', 'allocation', 'available', 'trash'):
+        print('{0}: {1}'.format(key, utils.format_size(info[key])))
+
+
+def pool_gc(args):
+    driver = get_driver()
+    rate = args.rate * 1024 * 1024 if args.rate else None
+    result = driver.pool_gc(args.pool, rate, args.age)
+
+    print('reclaimed {0} in {1} files'.format(
+        utils.format_size(result['bytes']), result['files']))
+
+    if result.get('ephemeral'):
+        print('released {0} ephemeral instances'.format(result['ephemeral']))
+
+    if result.get('bases'):
+        print('trashed {0} unused clone bases'.format(result['bases']))
+
+
+def print_stats(rates):
+    def rate(value, unit='/s'):
+        if value is None:
+            return '-'
+        return '{0}{1}'.format(utils.format_size(value), unit)
+
+    print(u'{0:32}{1:>8}{2:>12}{3:>14}{4:>14}{5:>14}{6:>14}'.format(
+        'NAME', 'CPU%', 'MEMORY', 'READ', 'WRITE', 'RX', 'TX'))
+
+    for name, x in sorted(rates.items()):
+        print(u'{0:32}{1:>8}{2:>12}{3:>14}{4:>14}{5:>14}{6:>14}'.format(
+            name, '-' if x['cpu'] is None else '{0:.1f}'.format(x['cpu']),
+            rate(x['memory_used'], ''), rate(x['block_read']),
+            rate(x['block_write']), rate(x['net_rx']), rate(x['net_tx'])))
+
+
+def pool_fsck(args):
+    driver = get_driver()
+    result = driver.pool_fsck(args.pool, args.repair)
+
+    for x in result['domains']:
+        print('orphan domain: {0}'.format(x))
+
+    for x in result['hosts']:
+        print('orphan dhcp host: {0} {1} {2} ({3})'.format(
+            x['name'], x['mac'], x['ip'], x['network']))
+
+    for x in result['dns']:
+        print('orphan dns host: {0} ({1})'.format(x['name'], x['network']))
+
+    for x in result['images']:
+        print('orphan image: {0}'.format(x))
+
+    orphans = policy.count_orphans(result)
+
+    if orphans and not args.repair:
+        print('{0} orphans found (--repair to remove them)'.format(orphans))
+        return EXITCODE_FAILURE
+
+    print('{0} orphans {1}'.format(orphans, 'removed' if orphans else
+                                   'found'))
+
+
+def journal_recover(args):
+    driver = get_driver()
+    result = driver.journal_recover(args.pool, args.rollback)
+
+    for instance in result['instances']:
+        print_instance(instance)
+
+    for name in result['rolledback']:
+        print('rolled back: {0}'.format(name))
+
+    for name, error in sorted(result['errors'].items()):
+        print('{0}: {1}'.format(name, error), file=sys.stderr)
+
+    if result['errors']:
+        return EXITCODE_FAILURE
+
+
+def command_top(args):
+    driver = get_driver()
+    clear = not args.stream and sys.stdout.isatty()
+
+    for timestamp, rates in stats.sample_rates(driver, args.interval,
+                                               args.count):
+        if args.stream:
+            print(json.dumps({'time': timestamp, 'instances': rates},
+                             sort_keys=True))
+        else:
+            if clear:
+                sys.stdout.write('\x1b[H\x1b[2J')
+            print_stats(rates)
+
+        sys.stdout.flush()
+
+
+def command_metrics(args):
+    sys.stdout.write(get_driver().metrics_collect())
+
+
 def instance_address(args):
-    driver = virtdeploy.get_driver(DRIVER)
+    driver = get_driver()
     print('\n'.join(driver.instance_address(args.name)))
 
 
 def command_ssh(args):
-    driver = virtdeploy.get_driver(DRIVER)
+    user, _, name = args.name.rpartition('@')
+    return remote.ssh_call(get_driver, name, args.arguments, user or None)
 
-    command = ['ssh', '-A',
-               '-o', 'StrictHostKeychecking=no',
-               '-o', 'UserKnownHostsFile=/dev/null',
-               '-o', 'LogLevel=QUIET']
 
-    user, _, name = args.name.rpartition('@')
+def command_exec(args):
+    names = args.name
+
+    # All the running virt-deploy instances
+    if args.all:
+        names = [x['name'] for x in get_driver().instance_list()
+                 if x['active']]
+
+    if not names:
+        raise errors.VirtDeployException('No instances to run on')
+
+    exitcode = EXITCODE_SUCCESS
+    results = remote.run(get_driver, names, args.remote, args.user,
+                         args.parallel, args.timeout)
+
+    for name, (result, error) in zip(names, results):
+        if error is not None:
+            print('{0}: {1}'.format(name, error), file=sys.stderr)
+            exitcode = EXITCODE_FAILURE
+            continue
+
+        for line in result['output']:
+            print(u'{0}: {1}'.format(name, line))
+
+        if result['exitcode'] != 0:
+            print('{0}: exit code {1}'.format(name, result['exitcode']),
+                  file=sys.stderr)
+            exitcode = EXITCODE_FAILURE
+
+    return exitcode
+
+
+def command_copy(args):
+    files = absolute_files(args.file)
+    instances = get_driver().instance_list()
+
+    if args.all:
+        names = [x['name'] for x in instances if x['active']]
+    else:
+        names = args.name
 
-    if user:
-        command.extend(('-l', user))
+    if not names:
+        raise errors.VirtDeployException('No instances to copy to')
 
-    command.append(driver.instance_address(name)[0])
-    command.extend(args.arguments)
+    # The stopped instances get the files in their disk (virt-customize),
+    # the others over ssh. The suspended ones (managed save) can't have
+    # their disk modified, they are resumed first.
+    stopped = set(x['name'] for x in instances
+                  if not x['active'] and not x.get('saved'))
+    saved = set(x['name'] for x in instances if x.get('saved'))
+    offline = [x for x in names if x in stopped]
+    online = [x for x in names if x not in stopped]
 
-    return subprocess.call(command)
+    def copy_in(name):
+        return get_driver().instance_copy_in(name, files)
+
+    def resume(name):
+        return get_driver().instance_resume(name)
+
+    exitcode = EXITCODE_SUCCESS
+    resumed = [x for x in online if x in saved]
+    results = utils.parallel(resume, resumed, args.parallel)
+
+    for name, (_, error) in zip(resumed, results):
+        if error is not None:
+            print('{0}: {1}'.format(name, error), file=sys.stderr)
+            exitcode = EXITCODE_FAILURE
+            online.remove(name)
+
+    results = remote.copy(get_driver, online, files, args.user,
+                          args.parallel)
+
+    for name, (result, error) in zip(online, results):
+        if error is None and result['exitcode'] != 0:
+            error = '\n'.join(result['output'] or
+                              ['exit code {0}'.format(result['exitcode'])])
+
+        if error is not None:
+            print('{0}: {1}'.format(name, error), file=sys.stderr)
+            exitcode = EXITCODE_FAILURE
+        else:
+            print('{0}: copied (ssh)'.format(name))
+
+    results = utils.parallel(copy_in, offline, args.parallel)
+
+    for name, (_, error) in zip(offline, results):
+        if error is not None:
+            print('{0}: {1}'.format(name, error), file=sys.stderr)
+            exitcode = EXITCODE_FAILURE
+        else:
+            print('{0}: copied (disk)'.format(name))
+
+    return exitcode
+
+
+def command_mirror(args):
+    from virtdeploy import mirror
+
+    if args.mirror_command == 'serve':
+        server = mirror.make_server(
+            (args.address, args.port or mirror.MIRROR_PORT), args.path)
+
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+        return
+
+    result = mirror.Mirror(args.path).sync(args.index, args.template,
+                                           args.arch)
+
+    for x in result['downloaded']:
+        print('downloaded: {0}'.format(x))
+
+    for x in result['present']:
+        print('present: {0}'.format(x))
+
+    print('{0} downloaded'.format(utils.format_size(result['bytes'])))
+
+
+def command_serve(args):
+    if daemon.get_client(args.socket) is not None:
+        raise errors.VirtDeployException(
+            'Daemon already running on {0}'.format(args.socket))
+
+    driver = virtdeploy.get_driver(DRIVER)
+    server = daemon.VirtDeployServer(args.socket, driver)
+    stop = threading.Event()
+
+    def start_policy(target, interval, report):
+        thread = threading.Thread(target=target, args=(driver, interval),
+                                  kwargs={'stop': stop, 'report': report})
+        thread.daemon = True
+        thread.start()
+
+    def report_suspend(name, error):
+        if error is None:
+            print('{0}: suspended (idle)'.format(name), file=sys.stderr)
+        else:
+            print('{0}: {1}'.format(name or 'suspend', error),
+                  file=sys.stderr)
+
+    def report_fsck(result, error):
+        if error is None:
+            print('fsck: removed {0} orphans'.format(
+                policy.count_orphans(result)), file=sys.stderr)
+        else:
+            print('fsck: {0}'.format(error), file=sys.stderr)
+
+    def report_gc(result, error):
+        if error is None:
+            print('gc: reclaimed {0} in {1} files'.format(
+                utils.format_size(result['bytes']), result['files']),
+                file=sys.stderr)
+        else:
+            print('gc: {0}'.format(error), file=sys.stderr)
+
+    if args.suspend_idle is not None:
+        start_policy(policy.suspend_idle, args.suspend_idle, report_suspend)
+
+    if args.gc_interval:
+        start_policy(policy.collect_garbage, args.gc_interval, report_gc)
+
+    if args.fsck_interval:
+        start_policy(policy.reconcile, args.fsck_interval, report_fsck)
+
+    if args.metrics_port is not None:
+        exporter = metrics.make_server(
+            (args.metrics_address, args.metrics_port), driver.metrics_collect)
+
+        thread = threading.Thread(target=exporter.serve_forever)
+        thread.daemon = True
+        thread.start()
+    else:
+        exporter = None
+
+    try:
+        server.serve_forever()
+    finally:
+        stop.set()
+        server.server_close()
+
+        if exporter is not None:
+            exporter.shutdown()
+            exporter.server_close()
 
 
 COMMAND_TABLE = {
     'create': instance_create,
+    'reset': instance_reset,
+    'clone': instance_clone,
+    'apply': command_apply,
     'start': instance_start,
     'stop': instance_stop,
+    'suspend': instance_suspend,
+    'resume': instance_resume,
     'delete': instance_delete,
     'templates': template_list,
+    'benchmark': instance_benchmark,
+    'pool': pool_info,
+    'gc': pool_gc,
+    'fsck': pool_fsck,
+    'recover': journal_recover,
+    'top': command_top,
+    'metrics': command_metrics,
     'address': instance_address,
     'ssh': command_ssh,
+    'exec': command_exec,
+    'copy': command_copy,
+    'mirror': command_mirror,
+    'serve': command_serve,
 }
 
 
+def get_version():
+    # Resolving the version scans the installed distributions: it is done
+    # only when requested and not at every invocation.
+    try:
+        from importlib import metadata
+    except ImportError:  # pragma: no cover
+        import pkg_resources
+        return pkg_resources.get_distribution('virt-deploy').version
+
+    return metadata.version('virt-deploy')
+
+
+class VersionAction(argparse.Action):
+    def __init__(self, option_strings, dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS, help=None):
+        super(VersionAction, self).__init__(
+            option_strings=option_strings, dest=dest, default=default,
+            nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        print('{0} {1}'.format(parser.prog, get_version()))
+        parser.exit()
+
+
 def parse_command_line(cmdline):
     parser = argparse.ArgumentParser()
 
-    version = pkg_resources.get_distribution('virt-deploy').version
-    parser.add_argument('-v', '--version', action='version',
-                        version='%(prog)s {0}'.format(version))
+    parser.add_argument('-v', '--version', action=VersionAction,
+                        help="show program's version number and exit")
 
     cmd = parser.add_subparsers(dest='command')
 
     cmd_create = cmd.add_parser('create', help='create a new instance')
+    cmd_create.add_argument('--profile', metavar='FILE',
+                            help='template build profile (json)')
+    cmd_create.add_argument('--snapshot', action='store_true',
+                            help='start from a booted template snapshot')
+    cmd_create.add_argument('--tuning', metavar='PROFILE',
+                            help='performance tuning profile '
+                                 '(default, throughput, latency)')
+    cmd_create.add_argument('--progress', action='store_true',
+                            help='report the progress of each stage')
+    cmd_create.add_argument('--disk-bus', choices=('scsi', 'virtio'),
+                            help='disk bus (virtio-scsi or virtio-blk)')
+    cmd_create.add_argument('--cache', help='disk cache mode')
+    cmd_create.add_argument('--io', help='disk aio mode')
+    cmd_create.add_argument('--iothreads', type=int,
+                            help='disk iothreads')
+    cmd_create.add_argument('--net-queues', type=int, metavar='QUEUES',
+                            help='virtio-net queues (0 for one per vcpu)')
+    cmd_create.add_argument('--overlay', action='append',
+                            metavar='OPTION=VALUE',
+                            help='overlay creation option (qemu-img)')
+    cmd_create.add_argument('--sparsify', action='store_true',
+                            help='sparsify a new template image')
+    cmd_create.add_argument('--compress', action='store_true',
+                            help='compress a new template image')
+    cmd_create.add_argument('--ephemeral', action='store_true',
+                            help='transient instance removed once stopped')
+    cmd_create.add_argument('--scratch', metavar='DIR',
+                            help='disk directory of an ephemeral instance')
+    cmd_create.add_argument('--copy-in', action='append',
+                            metavar='SOURCE:DIRECTORY',
+                            help='copy a file (or directory) in the disk')
     cmd_create.add_argument('id', help='new instance id')
     cmd_create.add_argument('template', help='template id')
 
+    cmd_reset = cmd.add_parser('reset', help='reset an instance disk')
+    cmd_reset.add_argument('--progress', action='store_true',
+                           help='report the progress of each stage')
+    cmd_reset.add_argument('--parallel', type=int,
+                           default=utils.PARALLEL_WORKERS,
+                           help='number of instances reset concurrently')
+    cmd_reset.add_argument('name', nargs='+', help='name of instance to reset')
+
+    cmd_clone = cmd.add_parser('clone', help='clone an instance')
+    cmd_clone.add_argument('--count', type=int, default=1,
+                           help='number of clones')
+    cmd_clone.add_argument('--prefix', metavar='ID',
+                           help='prefix of the clones ids')
+    cmd_clone.add_argument('--parallel', type=int,
+                           default=utils.PARALLEL_WORKERS,
+                           help='number of clones created concurrently')
+    cmd_clone.add_argument('--progress', action='store_true',
+                           help='report the progress of each stage')
+    cmd_clone.add_argument('name', help='name of instance to clone')
+
+    cmd_apply = cmd.add_parser('apply', help='apply an environment file')
+    cmd_apply.add_argument('--reset', action='store_true',
+                           help='reset the unchanged instances')
+    cmd_apply.add_argument('--dry-run', action='store_true',
+                           help='only show the planned actions')
+    cmd_apply.add_argument('--parallel', type=int,
+                           default=utils.PARALLEL_WORKERS,
+                           help='number of instances created concurrently')
+    cmd_apply.add_argument('--progress', action='store_true',
+                           help='report the progress of each stage')
+    cmd_apply.add_argument('file', help='environment file (json or yaml)')
+
     cmd_start = cmd.add_parser('start', help='start an instance')
     cmd_start.add_argument('--wait', action='store_true',
                            help='wait for ssh access availability')
     cmd_start.add_argument('name', help='name of instance to start')
 
     cmd_stop = cmd.add_parser('stop', help='stop an instance')
-    cmd_stop.add_argument('name', help='name of instance to stop')
+    cmd_stop.add_argument('--wait', action='store_true',
+                          help='wait for the instance to be stopped')
+    cmd_stop.add_argument('--grace', type=int,
+                          help='seconds before forcing the stop (--wait)')
+    cmd_stop.add_argument('name', nargs='+', help='name of instance to stop')
+
+    cmd_suspend = cmd.add_parser('suspend', help='suspend an instance')
+    cmd_suspend.add_argument('--parallel', type=int,
+                             default=utils.PARALLEL_WORKERS,
+                             help='number of instances suspended '
+                                  'concurrently')
+    cmd_suspend.add_argument('name', nargs='+',
+                             help='name of instance to suspend')
+
+    cmd_resume = cmd.add_parser('resume', help='resume an instance')
+    cmd_resume.add_argument('--parallel', type=int,
+                            default=utils.PARALLEL_WORKERS,
+                            help='number of instances resumed concurrently')
+    cmd_resume.add_argument('name', nargs='+',
+                            help='name of instance to resume')
 
     cmd_delete = cmd.add_parser('delete', help='delete an instance')
     cmd_delete.add_argument('name', help='name of instance to delete')
 
     cmd.add_parser('templates', help='list all the templates')
 
+    cmd_benchmark = cmd.add_parser('benchmark',
+                                   help='run an i/o benchmark (fio)')
+    cmd_benchmark.add_argument('--runtime', type=int,
+                               help='seconds of each benchmark run')
+    cmd_benchmark.add_argument('name', nargs='+', help='instance name')
+
+    cmd_pool = cmd.add_parser('pool', help='storage pool usage')
+    cmd_pool.add_argument('--pool', help='storage pool name')
+
+    cmd_gc = cmd.add_parser('gc', help='reclaim the deleted disks')
+    cmd_gc.add_argument('--pool', help='storage pool name')
+    cmd_gc.add_argument('--rate', type=int, metavar='MIB',
+                        help='MiB per second freed (i/o throttling)')
+    cmd_gc.add_argument('--age', type=int, metavar='SECONDS',
+                        help='reclaim only the disks deleted at least '
+                             'SECONDS ago')
+
+    cmd_fsck = cmd.add_parser('fsck', help='find orphan reservations and '
+                                           'images')
+    cmd_fsck.add_argument('--pool', help='storage pool name')
+    cmd_fsck.add_argument('--repair', action='store_true',
+                          help='remove the orphans')
+
+    cmd_recover = cmd.add_parser('recover',
+                                 help='resume the interrupted operations')
+    cmd_recover.add_argument('--pool', help='storage pool name')
+    cmd_recover.add_argument('--rollback', action='store_true',
+                             help='roll back the interrupted creations')
+
+    cmd_top = cmd.add_parser('top', help='instances resource usage')
+    cmd_top.add_argument('--interval', type=float,
+                         default=stats.STATS_INTERVAL,
+                         help='seconds between the updates')
+    cmd_top.add_argument('--count', type=int,
+                         help='number of updates (default unlimited)')
+    cmd_top.add_argument('--stream', action='store_true',
+                         help='json output (one line per update)')
+
+    cmd.add_parser('metrics', help='dump the metrics (prometheus)')
+
     cmd_address = cmd.add_parser('address', help='instance ip address')
     cmd_address.add_argument('name', help='instance name')
 
@@ -145,6 +785,66 @@ def parse_command_line(cmdline):
     cmd_ssh.add_argument('name', help='instance name')
     cmd_ssh.add_argument('arguments', nargs='*', help='ssh arguments')
 
+    cmd_exec = cmd.add_parser('exec', help='run a command on instances')
+    cmd_exec.add_argument('-l', '--user', help='remote user name')
+    cmd_exec.add_argument('--all', action='store_true',
+                          help='all the running instances')
+    cmd_exec.add_argument('--parallel', type=int,
+                          default=remote.EXEC_WORKERS,
+                          help='number of instances reached concurrently')
+    cmd_exec.add_argument('--timeout', type=int, metavar='SECONDS',
+                          help='command timeout')
+    cmd_exec.add_argument('remote', metavar='command',
+                          help='command (remote shell)')
+    cmd_exec.add_argument('name', nargs='*', help='name of the instances')
+
+    cmd_copy = cmd.add_parser('copy', help='copy files to instances')
+    cmd_copy.add_argument('-f', '--file', action='append', required=True,
+                          metavar='SOURCE:DIRECTORY',
+                          help='file (or directory) to copy')
+    cmd_copy.add_argument('-l', '--user', help='remote user name')
+    cmd_copy.add_argument('--all', action='store_true',
+                          help='all the running instances')
+    cmd_copy.add_argument('--parallel', type=int,
+                          default=remote.EXEC_WORKERS,
+                          help='number of instances reached concurrently')
+    cmd_copy.add_argument('name', nargs='*', help='name of the instances')
+
+    cmd_mirror = cmd.add_parser('mirror', help='template images mirror')
+    cmd_mirror.add_argument('--path', metavar='DIR',
+                            help='mirror directory')
+    mirror_cmd = cmd_mirror.add_subparsers(dest='mirror_command')
+    mirror_cmd.required = True
+
+    mirror_sync = mirror_cmd.add_parser('sync', help='download the images')
+    mirror_sync.add_argument('--index', metavar='URL',
+                             help='virt-builder index to mirror')
+    mirror_sync.add_argument('--arch', help='architecture to mirror')
+    mirror_sync.add_argument('template', nargs='*',
+                             help='template id (all by default)')
+
+    mirror_serve = mirror_cmd.add_parser('serve',
+                                         help='serve the mirror over http')
+    mirror_serve.add_argument('--port', type=int, help='listening port')
+    mirror_serve.add_argument('--address', default='',
+                              help='listening address')
+
+    cmd_serve = cmd.add_parser('serve', help='run the virt-deploy daemon')
+    cmd_serve.add_argument('--socket', default=daemon.socket_path(),
+                           help='unix socket path')
+    cmd_serve.add_argument('--suspend-idle', type=int, metavar='SECONDS',
+                           help='suspend the instances idle for longer')
+    cmd_serve.add_argument('--gc-interval', type=int, metavar='SECONDS',
+                           default=policy.GC_INTERVAL,
+                           help='seconds between trash reclaims (0 disables)')
+    cmd_serve.add_argument('--fsck-interval', type=int, metavar='SECONDS',
+                           help='seconds between orphans removals')
+    cmd_serve.add_argument('--metrics-port', type=int, metavar='PORT',
+                           help='serve the metrics over http (prometheus)')
+    cmd_serve.add_argument('--metrics-address', default='127.0.0.1',
+                           metavar='ADDRESS',
+                           help='address of the metrics endpoint')
+
     args = parser.parse_args(args=cmdline)
     return COMMAND_TABLE[args.command](args)
 
@@ -152,8 +852,16 @@ def parse_command_line(cmdline):
 def main():
     try:
         return parse_command_line(sys.argv[1:])
+    except errors.CommandTimeout as e:
+        print('error: {0}'.format(e), file=sys.stderr)
+        raise SystemExit(EXITCODE_TIMEOUT)
     except errors.VirtDeployException as e:
         print('error: {0}'.format(e), file=sys.stderr)
         raise SystemExit(EXITCODE_FAILURE)
+    except subprocess.CalledProcessError as e:
+        print('error: {0}'.format(e), file=sys.stderr)
+        if e.output:
+            print(e.output, file=sys.stderr)
+        raise SystemExit(EXITCODE_FAILURE)
     except KeyboardInterrupt:
         raise SystemExit(EXITCODE_KEYBINT)
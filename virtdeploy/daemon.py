@@ -0,0 +1,401 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import errno
+import json
+import os
+import select
+import socket
+import subprocess
+import threading
+
+from . import errors
+from .driverbase import VirtDeployDriverBase
+from .errors import VirtDeployException
+
+try:
+    import socketserver
+except ImportError:  # pragma: no cover
+    import SocketServer as socketserver
+
+SOCKET_ENV = 'VIRT_DEPLOY_SOCKET'
+SOCKET_NAME = 'virt-deploy.sock'
+
+DAEMON_WORKERS = 16
+
+# The daemon exposes the driver interface (VirtDeployDriverBase) using
+# json-rpc 2.0 messages, one per line, over a unix socket.
+RPC_METHODS = frozenset((
+    'template_list',
+    'instance_create',
+    'instance_reset',
+    'instance_clone',
+    'instance_address',
+    'instance_copy_in',
+    'instance_ready',
+    'instance_start',
+    'instance_suspend',
+    'instance_resume',
+    'instance_list',
+    'instance_cpu_stats',
+    'instance_stats',
+    'instance_benchmark',
+    'instance_stop',
+    'instance_stop_wait',
+    'instance_delete',
+    'pool_info',
+    'pool_gc',
+    'pool_fsck',
+    'journal_recover',
+    'metrics_collect',
+))
+
+# The long operations are cancelled (as on ctrl-c with the local driver)
+# when the connection of their client drops.
+RPC_CANCELLABLE = frozenset((
+    'instance_create',
+    'instance_reset',
+    'instance_clone',
+    'instance_copy_in',
+))
+
+RPC_VERSION = '2.0'
+RPC_PARSE_ERROR = -32700
+RPC_METHOD_NOT_FOUND = -32601
+RPC_INVALID_PARAMS = -32602
+RPC_DRIVER_ERROR = -32000
+
+
+def socket_path():
+    path = os.environ.get(SOCKET_ENV)
+
+    if path:
+        return path
+
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/run'),
+                        SOCKET_NAME)
+
+
+def get_client(path=None):
+    if path is None:
+        path = socket_path()
+
+    if not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        sock.close()
+        # Stale socket left behind by a daemon that is not running
+        if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+            return None
+        raise
+
+    return VirtDeployClient(sock)
+
+
+class VirtDeployClient(VirtDeployDriverBase):
+    def __init__(self, sock):
+        self._sock = sock
+        self._file = sock.makefile('rb')
+        self._lastid = 0
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def _call(self, method, progress=None, **params):
+        self._lastid += 1
+
+        if progress is not None:
+            params['progress'] = True
+
+        request = {'jsonrpc': RPC_VERSION, 'id': self._lastid,
+                   'method': method, 'params': params}
+        self._sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+        while True:
+            line = self._file.readline()
+
+            if not line:
+                raise VirtDeployException('Connection to daemon lost')
+
+            message = json.loads(line.decode('utf-8'))
+
+            # Notifications (no id) carry the progress events of the call
+            if 'id' not in message:
+                if progress is not None:
+                    progress(message['params'])
+                continue
+
+            if 'error' in message:
+                raise _error_from_data(message['error'])
+
+            return message['result']
+
+    def template_list(self):
+        return self._call('template_list')
+
+    def instance_create(self, vmid, template, **kwargs):
+        return self._call('instance_create', vmid=vmid, template=template,
+                          **kwargs)
+
+    def instance_reset(self, vmid, **kwargs):
+        return self._call('instance_reset', vmid=vmid, **kwargs)
+
+    def instance_clone(self, vmid, count, prefix=None, workers=None,
+                       **kwargs):
+        return self._call('instance_clone', vmid=vmid, count=count,
+                          prefix=prefix, workers=workers, **kwargs)
+
+    def instance_address(self, vmid, network=None):
+        return self._call('instance_address', vmid=vmid, network=network)
+
+    def instance_copy_in(self, vmid, files, **kwargs):
+        return self._call('instance_copy_in', vmid=vmid, files=files,
+                          **kwargs)
+
+    def instance_ready(self, vmid):
+        return self._call('instance_ready', vmid=vmid)
+
+    def instance_start(self, vmid):
+        return self._call('instance_start', vmid=vmid)
+
+    def instance_suspend(self, vmid):
+        return self._call('instance_suspend', vmid=vmid)
+
+    def instance_resume(self, vmid):
+        return self._call('instance_resume', vmid=vmid)
+
+    def instance_list(self):
+        return self._call('instance_list')
+
+    def instance_cpu_stats(self):
+        return self._call('instance_cpu_stats')
+
+    def instance_stats(self):
+        return self._call('instance_stats')
+
+    def instance_benchmark(self, vmid, runtime=None):
+        return self._call('instance_benchmark', vmid=vmid, runtime=runtime)
+
+    def instance_stop(self, vmid):
+        return self._call('instance_stop', vmid=vmid)
+
+    def instance_stop_wait(self, vmids, grace=None):
+        return self._call('instance_stop_wait', vmids=vmids, grace=grace)
+
+    def instance_delete(self, vmid):
+        return self._call('instance_delete', vmid=vmid)
+
+    def pool_info(self, pool=None):
+        return self._call('pool_info', pool=pool)
+
+    def pool_gc(self, pool=None, rate=None, age=None):
+        return self._call('pool_gc', pool=pool, rate=rate, age=age)
+
+    def pool_fsck(self, pool=None, repair=False):
+        return self._call('pool_fsck', pool=pool, repair=repair)
+
+    def journal_recover(self, pool=None, rollback=False):
+        return self._call('journal_recover', pool=pool, rollback=rollback)
+
+    def metrics_collect(self):
+        return self._call('metrics_collect')
+
+
+def _error_data(e):
+    # The type and arguments the client needs to raise the same exception
+    if isinstance(e, subprocess.CalledProcessError):
+        output = e.output
+
+        if isinstance(output, bytes):
+            output = output.decode('utf-8', 'replace')
+
+        data = {'type': 'CalledProcessError', 'returncode': e.returncode,
+                'cmd': e.cmd, 'output': output}
+    elif isinstance(e, VirtDeployException):
+        data = {'type': type(e).__name__, 'args': e.args}
+    else:
+        return None
+
+    # Arguments that are not json values (e.g. errors) as their text
+    return json.loads(json.dumps(data, default=str))
+
+
+def _error_from_data(error):
+    data = error.get('data') or {}
+    name = data.get('type')
+
+    if name == 'CalledProcessError':
+        return subprocess.CalledProcessError(data['returncode'], data['cmd'],
+                                             data['output'])
+
+    cls = getattr(errors, name or '', None)
+
+    if isinstance(cls, type) and issubclass(cls, VirtDeployException):
+        try:
+            return cls(*data['args'])
+        except (KeyError, TypeError):
+            pass
+
+    return VirtDeployException(error['message'])
+
+
+class _ConnectionWatch(object):
+    # Sets the cancel event when the client closes its connection while
+    # waiting for the result (it doesn't send anything meanwhile).
+    def __init__(self, sock, interval=0.5):
+        self.cancel = threading.Event()
+        self._sock = sock
+        self._interval = interval
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._watch)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        # Not joined: the watch ends (at most an interval later) unused
+        self._done.set()
+
+    def _watch(self):
+        while not self._done.is_set():
+            readable, _, _ = select.select([self._sock], [], [],
+                                           self._interval)
+
+            if not readable:
+                continue
+
+            try:
+                closed = not self._sock.recv(1, socket.MSG_PEEK)
+            except socket.error:
+                closed = True
+
+            if closed:
+                self.cancel.set()
+
+            return
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, b''):
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError:
+                self._send_error(None, RPC_PARSE_ERROR, 'Parse error')
+                continue
+
+            try:
+                with self.server.workers:
+                    self._dispatch(request)
+            except socket.error as e:
+                # The client is gone, its operation was cancelled
+                if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                    raise
+                return
+
+    def _send(self, message):
+        message['jsonrpc'] = RPC_VERSION
+        self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+    def _send_error(self, requestid, code, message, data=None):
+        error = {'code': code, 'message': message}
+
+        if data is not None:
+            error['data'] = data
+
+        self._send({'id': requestid, 'error': error})
+
+    def _dispatch(self, request):
+        requestid = request.get('id')
+        method = request.get('method')
+        params = request.get('params') or {}
+
+        if method not in RPC_METHODS:
+            self._send_error(requestid, RPC_METHOD_NOT_FOUND,
+                             'Method not found: {0}'.format(method))
+            return
+
+        if not isinstance(params, dict):
+            self._send_error(requestid, RPC_INVALID_PARAMS, 'Invalid params')
+            return
+
+        if params.pop('progress', False):
+            params['progress'] = self._send_progress
+
+        try:
+            if method in RPC_CANCELLABLE:
+                with _ConnectionWatch(self.connection) as watch:
+                    params['cancel'] = watch.cancel
+                    result = getattr(self.server.driver, method)(**params)
+            else:
+                result = getattr(self.server.driver, method)(**params)
+        except Exception as e:
+            self._send_error(requestid, RPC_DRIVER_ERROR, str(e),
+                             _error_data(e))
+        else:
+            self._send({'id': requestid, 'result': result})
+
+    def _send_progress(self, event):
+        self._send({'method': 'progress', 'params': event})
+
+
+class VirtDeployServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, driver, workers=DAEMON_WORKERS):
+        # A previous daemon may have left its socket behind
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        # The socket is created by bind, only accessible to the owner
+        umask = os.umask(0o177)
+
+        try:
+            socketserver.UnixStreamServer.__init__(self, path,
+                                                   _RequestHandler)
+        finally:
+            os.umask(umask)
+
+        self.driver = driver
+        self.workers = threading.BoundedSemaphore(workers)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+
+        try:
+            os.remove(self.server_address)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -28,14 +28,66 @@ class VirtDeployDriverBase(object):
     def instance_create(self, vmid, template, **kwargs):
         raise NotImplementedError('instance_create')
 
+    def instance_reset(self, vmid, **kwargs):
+        raise NotImplementedError('instance_reset')
+
+    def instance_clone(self, vmid, count, prefix=None, workers=None,
+                       **kwargs):
+        raise NotImplementedError('instance_clone')
+
     def instance_address(self, vmid, network=None):
         raise NotImplementedError('instance_address')
 
+    def instance_copy_in(self, vmid, files, **kwargs):
+        raise NotImplementedError('instance_copy_in')
+
+    def instance_ready(self, vmid):
+        raise NotImplementedError('instance_ready')
+
     def instance_start(self, vmid):
         raise NotImplementedError('instance_start')
 
+    def instance_suspend(self, vmid):
+        raise NotImplementedError('instance_suspend')
+
+    def instance_resume(self, vmid):
+        raise NotImplementedError('instance_resume')
+
+    def instance_list(self):
+        raise NotImplementedError('instance_list')
+
+    def instance_cpu_stats(self):
+        raise NotImplementedError('instance_cpu_stats')
+
+    def instance_stats(self):
+        raise NotImplementedError('instance_stats')
+
+    def instance_benchmark(self, vmid, runtime=None):
+        raise NotImplementedError('instance_benchmark')
+
     def instance_stop(self, vmid):
         raise NotImplementedError('instance_stop')
 
+    def instance_stop_wait(self, vmids, grace=None):
+        raise NotImplementedError('instance_stop_wait')
+
     def instance_delete(self, vmid):
         raise NotImplementedError('instance_delete')
+
+    def pool_fsck(self, pool=None, repair=False):
+        raise NotImplementedError('pool_fsck')
+
+    def journal_recover(self, pool=None, rollback=False):
+        raise NotImplementedError('journal_recover')
+
+    def metrics_collect(self):
+        raise NotImplementedError('metrics_collect')
+
+    def instance_reap(self, vmid):
+        raise NotImplementedError('instance_reap')
+
+    def pool_info(self, pool=None):
+        raise NotImplementedError('pool_info')
+
+    def pool_gc(self, pool=None, rate=None, age=None):
+        raise NotImplementedError('pool_gc')
@@ -20,25 +20,55 @@
 
 from __future__ import absolute_import
 
+import base64
+import contextlib
+import errno
+import fcntl
+import functools
 import json
-import libvirt
-import netaddr
 import os
 import os.path
 import subprocess
+import sys
+import threading
+import time
+import uuid
 
-from lxml import etree
-
+from .. import metrics
 from ..driverbase import VirtDeployDriverBase
+from ..errors import CommandTimeout
 from ..errors import InstanceNotFound
+from ..errors import OperationCancelled
 from ..errors import VirtDeployException
+from ..journal import Journal
+from ..journal import NullJournal
+from ..profiles import image_profile
+from ..profiles import profile_hash
+from ..utils import LazyModule
+from ..utils import PARALLEL_WORKERS
+from ..utils import Rollback
 from ..utils import execute
+from ..utils import filesystem_type
+from ..utils import monotonic_time
+from ..utils import parallel
+from ..utils import parse_files
+from ..utils import parse_progress
+from ..utils import process_alive
 from ..utils import random_password
+from ..utils import reclaim_file
+from ..utils import spawn_detached
+
+# Imported on first use, the commands that don't reach libvirt (or parse
+# its xml) don't pay for them.
+libvirt = LazyModule('libvirt')
+etree = LazyModule('lxml.etree')
 
 DEFAULT_NET = 'default'
 DEFAULT_POOL = 'default'
 
 BASE_FORMAT = 'qcow2'
+
+HOSTNAME_PREFIX = 'vm-'
 BASE_SIZE = '20G'
 
 INSTANCE_DEFAULTS = {
@@ -48,33 +78,373 @@ INSTANCE_DEFAULTS = {
     'network': DEFAULT_NET,
     'pool': DEFAULT_POOL,
     'password': None,
+    'profile': None,
+    'base': None,
+    'snapshot': False,
+    'tuning': None,
+    'labels': None,
+    'files': None,
+    'disk_bus': None,
+    'cache': None,
+    'io': None,
+    'iothreads': None,
+    'l2_cache': None,
+    'net_queues': None,
+    'overlay': None,
+    'sparsify': False,
+    'compress': False,
+    'ephemeral': False,
+    'scratch': None,
+    'progress': None,
+    'timeouts': None,
+    'cancel': None,
+}
+
+# Seconds allowed to each stage of the instance creation
+STAGE_TIMEOUTS = {
+    'build': 3600,
+    'sysprep': 600,
+    'overlay': 60,
+    'customize': 600,
+    'install': 300,
+    'snapshot': 600,
+    'sparsify': 1800,
+    'compress': 1800,
+    'clone': 1800,
+}
+
+# The disks of the deleted instances are moved in the trash directory of
+# the pool and reclaimed in background (pool_gc). Their trash name starts
+# with the time of the deletion (TIME-UUID-NAME): they are reclaimed from
+# the oldest, and only after a given age when requested.
+TRASH_DIR = '.trash'
+
+# The stages of the instances creations and resets are recorded in the
+# journal of the pool: the operations interrupted by a crash are resumed
+# (or rolled back) by a later run (journal_recover).
+JOURNAL_FILE = '.journal'
+
+# The base images of the clones (CLONE-NAME-TIME-UUID) are flattened from
+# the source instance. They are reclaimed by gc once no disk (defined,
+# orphan or being created) reads from them anymore.
+CLONE_BASE_PREFIX = '_clone-'
+
+# Ephemeral instances have their disk in a scratch directory (memory backed
+# by default) and a transient domain. A detached reaper releases the disk
+# and the network reservations (recorded in the state directory) as soon
+# as the domain stops. The states outlive a host reboot, that stops the
+# domains without their reapers, and they are then released by gc.
+EPHEMERAL_DIR = '/dev/shm/virt-deploy'
+EPHEMERAL_STATE_DIR = '/var/lib/virt-deploy/ephemeral'
+
+# The host cpus reserved by the domains being created (pinning and numa
+# tuning), shared by all the processes placing instances on the host.
+PLACEMENT_FILE = '/var/lib/virt-deploy/placement.json'
+
+# Serializes the address allocations and reservations of all the processes
+# (cli and daemon) managing the networks of the host.
+NETWORK_LOCK_FILE = '/var/lib/virt-deploy/network.lock'
+
+# The templates are downloaded from the mirror (virt-builder index) set in
+# the environment, or from the local mirror when it has them.
+MIRROR_ENV = 'VIRT_DEPLOY_MIRROR'
+
+# Files (overlays, ephemeral states) younger than this may belong to an
+# instance still being created, they are never considered orphans.
+RECONCILE_GRACE = 7200
+
+# Bytes per second freed reclaiming the trash
+GC_RATE = 256 * 1024 * 1024
+
+# Creation options (qemu-img -o) of the instances overlays
+OVERLAY_KEYS = ('cluster_size', 'preallocation', 'extended_l2',
+                'lazy_refcounts')
+
+OVERLAY_DEFAULTS = {
+    'lazy_refcounts': True,
+}
+
+# Subclusters (extended l2) reduce the copy on write of the first writes
+# and allow the preallocation of the metadata on top of a backing file.
+# On copy on write filesystems the preallocation is pointless.
+FILESYSTEM_OVERLAY_DEFAULTS = {
+    'xfs': {
+        'cluster_size': '128k',
+        'extended_l2': True,
+        'preallocation': 'metadata',
+        'lazy_refcounts': True,
+    },
+    'ext4': {
+        'cluster_size': '128k',
+        'extended_l2': True,
+        'preallocation': 'metadata',
+        'lazy_refcounts': True,
+    },
+    'btrfs': {
+        'cluster_size': '128k',
+        'extended_l2': True,
+        'lazy_refcounts': True,
+    },
+}
+
+DEFAULT_CPU_MODEL = 'host-model-only,+vmx'
+
+# Performance tuning profiles (selected per instance or in the template
+# build profile):
+#   cpu: cpu model (virt-install --cpu)
+#   pinning: vcpus pinned to dedicated host cpus of a single numa cell
+#   emulator: emulator threads pinned to a dedicated host cpu
+#   numa: memory bound to the numa cell of the instance
+#   hugepages, locked: memory backing
+#   disk_bus: scsi (virtio-scsi) or virtio (virtio-blk)
+#   cache, io: disk cache and aio modes (e.g. none, native or io_uring)
+#   iothreads: dedicated iothreads for the disk (or the scsi controller)
+#   l2_cache: qcow2 metadata cache size (bytes)
+#   net_queues: virtio-net (vhost) queues, 0 means one per vcpu
+TUNING_PROFILES = {
+    'default': {},
+    'throughput': {
+        'cpu': 'host-passthrough',
+        'numa': True,
+        'hugepages': True,
+        'cache': 'none',
+        'io': 'native',
+        'iothreads': 1,
+        'l2_cache': 4194304,
+        'net_queues': 0,
+    },
+    'latency': {
+        'cpu': 'host-passthrough',
+        'pinning': True,
+        'emulator': True,
+        'numa': True,
+        'hugepages': True,
+        'locked': True,
+        'disk_bus': 'virtio',
+        'cache': 'none',
+        'io': 'io_uring',
+        'iothreads': 1,
+        'l2_cache': 4194304,
+        'net_queues': 0,
+    },
 }
 
-_NET_ADD_LAST = libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_LAST
-_NET_MODIFY = libvirt.VIR_NETWORK_UPDATE_COMMAND_MODIFY
-_NET_DELETE = libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE
-_NET_DNS_HOST = libvirt.VIR_NETWORK_SECTION_DNS_HOST
-_NET_DHCP_HOST = libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST
-_NET_UPDATE_FLAGS = (
-    libvirt.VIR_NETWORK_UPDATE_AFFECT_CONFIG |
-    libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE
+# The tuning keys that can be also set for a single instance
+IO_OPTIONS = ('disk_bus', 'cache', 'io', 'iothreads', 'l2_cache',
+              'net_queues')
+
+DISK_BUSES = ('scsi', 'virtio')
+
+# The benchmark runs fio (it must be installed in the guest) with a mixed
+# random read/write workload on the instance disk.
+BENCHMARK_RUNTIME = 30
+BENCHMARK_FILE = '/var/tmp/virt-deploy.fio'
+BENCHMARK_JOB = (
+    '--name=virt-deploy',
+    '--size=1G',
+    '--rw=randrw',
+    '--bs=4k',
+    '--iodepth=32',
+    '--ioengine=libaio',
+    '--direct=1',
+    '--time_based',
+    '--unlink=1',
+    '--output-format=json',
 )
 
+# Instances created by virt-deploy are marked in the domain metadata
+METADATA_URI = 'https://github.com/simon3z/virt-deploy'
+METADATA_PREFIX = 'virtdeploy'
+
 _IMAGE_OS_TABLE = {
     'centos-6': 'centos6.6',  # TODO: fix versions
 }
 
 
+AGENT_TIMEOUT = 10
+AGENT_PING_TIMEOUT = 1
+AGENT_EXEC_INTERVAL = 0.2
+
+# States reported by systemctl is-system-running once the boot completed
+BOOT_COMPLETE_STATES = ('running', 'degraded')
+
+# Seconds given to the guests to shut down before destroying them
+STOP_GRACE = 60
+
+EVENT_RECHECK_INTERVAL = 5.0
+
+READY_INTERVAL = 1.0
+
+# The template disks booted once (see _create_snapshot), the instances
+# created with a snapshot are overlays of them.
+SNAPSHOT_SUFFIX = '-booted'
+
+OPERATIONS = metrics.Counter(
+    'virtdeploy_operations_total',
+    'Driver operations by result', ('operation', 'result'))
+OPERATION_DURATION = metrics.Histogram(
+    'virtdeploy_operation_duration_seconds',
+    'Duration of the driver operations', ('operation',))
+STAGE_DURATION = metrics.Histogram(
+    'virtdeploy_stage_duration_seconds',
+    'Duration of the instance creation stages', ('stage',))
+STAGE_FAILURES = metrics.Counter(
+    'virtdeploy_stage_failures_total',
+    'Instance creation stages failed', ('stage',))
+
+# Gauges refreshed when the metrics are collected
+NETWORK_ADDRESSES = metrics.Gauge(
+    'virtdeploy_network_addresses',
+    'Addresses of the network', ('network',))
+NETWORK_ADDRESSES_USED = metrics.Gauge(
+    'virtdeploy_network_addresses_used',
+    'Addresses of the network reserved or leased', ('network',))
+POOL_CAPACITY = metrics.Gauge(
+    'virtdeploy_pool_capacity_bytes', 'Storage pool capacity', ('pool',))
+POOL_AVAILABLE = metrics.Gauge(
+    'virtdeploy_pool_available_bytes', 'Storage pool free space', ('pool',))
+POOL_TRASH = metrics.Gauge(
+    'virtdeploy_pool_trash_bytes',
+    'Storage used by the deleted disks not reclaimed yet', ('pool',))
+POOL_BASES = metrics.Gauge(
+    'virtdeploy_pool_base_images',
+    'Base (template) images ready in the pool', ('pool',))
+POOL_SNAPSHOTS = metrics.Gauge(
+    'virtdeploy_pool_snapshots',
+    'Template snapshots ready in the pool', ('pool',))
+
+_EVENT_LOOP_LOCK = threading.Lock()
+_event_loop = None
+
+
+class _PlacementTracker(object):
+    # The host cpus pinned by the defined domains are read from libvirt,
+    # the ones of the domains still being created (by any process) are
+    # recorded in the placement file, with the pid of their creator. The
+    # placement is decided under the lock of the file, the reservations of
+    # the processes that died meanwhile are ignored.
+    def __init__(self, path=None):
+        self._path = path
+
+    def place(self, conn, name, vcpus, tuning):
+        if not tuning.get('pinning') and not tuning.get('numa'):
+            return None
+
+        path = self._path or PLACEMENT_FILE
+        _make_directory(os.path.dirname(path))
+
+        with _locked_file(path) as f:
+            pending = _load_placements(f)
+            used = _get_pinned_cpus(conn)
+
+            for x in pending.values():
+                used.update(x['cpus'])
+
+            placement = _place_instance(_get_host_topology(conn), used,
+                                        vcpus, tuning)
+            pending[name] = {'pid': os.getpid(),
+                             'cpus': sorted(placement['pinned'])}
+            _save_placements(f, pending)
+
+        return placement
+
+    def release(self, name):
+        path = self._path or PLACEMENT_FILE
+
+        # Nothing was ever placed (no pinning or numa tuning)
+        if not os.path.exists(path):
+            return
+
+        with _locked_file(path) as f:
+            pending = _load_placements(f)
+
+            if pending.pop(name, None) is not None:
+                _save_placements(f, pending)
+
+
+@contextlib.contextmanager
+def _locked_file(path):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+    with os.fdopen(fd, 'r+b') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield f
+
+
+@contextlib.contextmanager
+def _network_lock():
+    _make_directory(os.path.dirname(NETWORK_LOCK_FILE))
+
+    with _locked_file(NETWORK_LOCK_FILE):
+        yield
+
+
+def _load_placements(f):
+    f.seek(0)
+
+    try:
+        pending = json.loads(f.read().decode('utf-8') or '{}')
+    except ValueError:
+        return {}  # partially written by a crashed process
+
+    return dict((k, v) for k, v in pending.items()
+                if process_alive(v['pid']))
+
+
+def _save_placements(f, pending):
+    f.seek(0)
+    f.truncate()
+    f.write(json.dumps(pending, sort_keys=True).encode('utf-8'))
+    f.flush()
+
+
+_PLACEMENT = _PlacementTracker()
+
+
+def _instrumented(func):
+    operation = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            with OPERATION_DURATION.time(operation=operation):
+                result = func(*args, **kwargs)
+        except Exception:
+            OPERATIONS.inc(operation=operation, result='failure')
+            raise
+
+        OPERATIONS.inc(operation=operation, result='success')
+        return result
+
+    return wrapper
+
+
 class VirtDeployLibvirtDriver(VirtDeployDriverBase):
     def __init__(self, uri='qemu:///system'):
         self._uri = uri
+        self._conn = None
+        self._conn_events = False
+        self._conn_lock = threading.Lock()
 
-    def _libvirt_open(self):
+    def _libvirt_open(self, events=False):
         def libvirt_callback(ctx, err):
             pass  # add logging only when required
 
-        libvirt.registerErrorHandler(libvirt_callback, ctx=None)
-        return libvirt.open(self._uri)
+        # The connection is kept open and shared, a long running process
+        # (the daemon) pays the connection setup only once. The event loop
+        # is started only by the operations waiting for lifecycle events,
+        # and must be registered before opening their connection.
+        with self._conn_lock:
+            if (self._conn is None or not self._conn.isAlive() or
+                    (events and not self._conn_events)):
+                if events:
+                    _event_loop_start()
+
+                libvirt.registerErrorHandler(libvirt_callback, ctx=None)
+                self._conn = libvirt.open(self._uri)
+                self._conn_events = _event_loop is not None
+
+            return self._conn
 
     def template_list(self):
         templates = _get_virt_templates()
@@ -85,8 +455,9 @@ class VirtDeployLibvirtDriver(VirtDeployDriverBase):
         return [{'id': x['os-version'], 'name': x['full-name']}
                 for x in templates['templates']]
 
+    @_instrumented
     def instance_create(self, vmid, template, **kwargs):
-        kwargs = dict(INSTANCE_DEFAULTS.items() + kwargs.items())
+        kwargs = dict(INSTANCE_DEFAULTS, **kwargs)
 
         name = '{0}-{1}-{2}'.format(vmid, template, kwargs['arch'])
         image = '{0}.qcow2'.format(name)
@@ -96,35 +467,167 @@ class VirtDeployLibvirtDriver(VirtDeployDriverBase):
         net = conn.networkLookupByName(kwargs['network'])
 
         repository = _get_pool_path(pool)
-        path = os.path.join(repository, image)
+        ephemeral = kwargs['ephemeral']
 
-        if os.path.exists(path):
-            raise OSError(os.errno.EEXIST, "Image already exists")
+        # The files are copied in the disk by the customization
+        copy_in = list(_copy_in_options(kwargs['files']))
+
+        if ephemeral:
+            scratch = kwargs['scratch'] or EPHEMERAL_DIR
+            # Traversed by qemu (not running as root on qemu:///system)
+            _make_directory(scratch, 0o711)
+            path = os.path.join(scratch, image)
+        else:
+            path = os.path.join(repository, image)
 
-        base = _create_base(template, kwargs['arch'], repository)
+        # Ephemeral instances have their own state (and reaper)
+        if ephemeral:
+            journal = NullJournal()
+        else:
+            journal = _get_journal(repository)
 
-        execute(('qemu-img', 'create', '-f', 'qcow2', '-b', base, image),
-                cwd=repository)
+        # The image (and domain) of an interrupted creation is resumed, a
+        # domain defined by anything else is never removed by the rollback.
+        if name not in journal.pending():
+            if os.path.exists(path):
+                raise OSError(errno.EEXIST, "Image already exists")
 
-        hostname = 'vm-{0}'.format(vmid)
+            if not ephemeral and _lookup_domain(conn, name) is not None:
+                raise VirtDeployException(
+                    'Domain {0} already exists'.format(name))
 
-        domainname = _get_network_domainname(net)
+        stage = _stage_options(kwargs)
+        tuning = _get_tuning_profile(kwargs)
 
-        if domainname is None:
-            fqdn = hostname
+        # An existing image of the pool (e.g. the base of the clones)
+        if kwargs['base'] is not None:
+            base = kwargs['base']
         else:
-            fqdn = '{0}.{1}'.format(hostname, domainname)
+            base = _create_base(template, kwargs['arch'], repository,
+                                image_profile(kwargs['profile']),
+                                kwargs['sparsify'], kwargs['compress'],
+                                **stage)
 
-        if kwargs['password'] is None:
-            kwargs['password'] = random_password()
+        if kwargs['snapshot']:
+            base = self._create_snapshot(template, base, repository, kwargs,
+                                         stage, tuning)
 
-        password_string = 'password:{0}'.format(kwargs['password'])
+        overlay = _get_overlay_options(os.path.dirname(path),
+                                       kwargs['overlay'])
 
-        execute(('virt-customize',
-                 '-a', path,
-                 '--hostname', fqdn,
-                 '--root-password', password_string))
+        # The backing file is relative to the directory of the overlay
+        if ephemeral:
+            base = os.path.join(repository, base)
+
+        hostname = '{0}{1}'.format(HOSTNAME_PREFIX, vmid)
+
+        if kwargs['password'] is None:
+            kwargs['password'] = random_password()
 
+        resumed = journal.begin(name, 'create', vmid=vmid,
+                                template=template, path=path,
+                                hostname=hostname,
+                                kwargs=_journal_options(kwargs))
+
+        if resumed is None:
+            resumed = {'stages': []}
+
+        # The password is not journaled, a resumed creation sets it again
+        done = [x for x in resumed['stages'] if x != 'customize']
+
+        with Rollback() as rollback:
+            rollback.add(journal.end, name, 'rollback')
+            rollback.add(_remove_file, path)
+
+            if 'overlay' not in done:
+                _create_overlay(base, path, name, stage, overlay)
+                journal.record(name, 'overlay')
+
+            fqdn = _get_network_fqdn(net, hostname)
+
+            if 'customize' not in done:
+                _customize_instance(path, fqdn, kwargs['password'], name,
+                                    stage, copy_in)
+                journal.record(name, 'customize')
+
+            # The cpus are reserved until the domain pinning them exists
+            placement = _PLACEMENT.place(conn, name, kwargs['cpus'], tuning)
+            rollback.add(_PLACEMENT.release, name)
+
+            # The labels can't override the attributes of the instance
+            metadata = dict(kwargs['labels'] or {}, template=template,
+                            arch=kwargs['arch'], tuning=tuning['name'])
+
+            if ephemeral:
+                xmldesc = self._install_domain(name, path, template, kwargs,
+                                               stage, tuning, placement,
+                                               define=False)
+            else:
+                rollback.add(_remove_domain, conn, name)
+
+                if 'define' not in done:
+                    # Defined before a crash, but not recorded
+                    if resumed['stages']:
+                        _remove_domain(conn, name)
+
+                    self._install_domain(name, path, template, kwargs, stage,
+                                         tuning, placement)
+                    _set_domain_metadata(_get_domain(conn, name), metadata)
+                    journal.record(name, 'define')
+
+                _PLACEMENT.release(name)
+
+                dom = _get_domain(conn, name)
+                xmldesc = dom.XMLDesc()
+
+            netmac = next(_get_xml_mac_addresses(xmldesc))
+
+            # Recorded before the reservations, that are not orphans then
+            if ephemeral:
+                rollback.add(_remove_file, _ephemeral_state_path(name))
+                _save_ephemeral_state({
+                    'name': name,
+                    'network': kwargs['network'],
+                    'hostname': hostname,
+                    'disk': path,
+                })
+
+            with _network_lock():
+                # The (idempotent) reservations of a resumed creation are
+                # applied again, with the same address.
+                ipaddress = (resumed.get('ipaddress') or
+                             _new_network_ipaddress(net))
+
+                rollback.add(_del_network_host, net, hostname)
+                _add_network_host(net, hostname, ipaddress)
+                rollback.add(_del_network_dhcp_host, net, hostname)
+                _add_network_dhcp_host(net, hostname, netmac['mac'],
+                                       ipaddress)
+
+            journal.record(name, 'reserve', ipaddress=ipaddress)
+
+            if ephemeral:
+                dom = conn.createXML(xmldesc, 0)
+                rollback.add(_destroy_domain, dom)
+                _PLACEMENT.release(name)
+
+                _set_domain_metadata(dom, metadata,
+                                     libvirt.VIR_DOMAIN_AFFECT_LIVE)
+                _spawn_reaper(self._uri, name)
+
+            journal.end(name)
+
+            return {
+                'name': name,
+                'password': kwargs['password'],
+                'mac': netmac['mac'],
+                'hostname': fqdn,
+                'ipaddress': ipaddress,
+            }
+
+    def _install_domain(self, name, path, template, kwargs, stage, tuning,
+                        placement=None, define=True):
+        conn = self._libvirt_open()
         network = 'network={0}'.format(kwargs['network'])
 
         try:
@@ -135,41 +638,199 @@ class VirtDeployLibvirtDriver(VirtDeployDriverBase):
         else:
             network += ',filterref=clean-traffic'
 
-        disk = 'path={0},format=qcow2,bus=scsi,discard=unmap'.format(path)
         channel = 'unix,name=org.qemu.guest_agent.0'
 
-        execute(('virt-install',
+        args = (('virt-install',
                  '--quiet',
                  '--connect={0}'.format(self._uri),
                  '--name', name,
-                 '--cpu', 'host-model-only,+vmx',
                  '--vcpus', str(kwargs['cpus']),
                  '--memory', str(kwargs['memory']),
-                 '--controller', 'scsi,model=virtio-scsi',
-                 '--disk', disk,
-                 '--network', network,
                  '--graphics', 'spice',
                  '--channel', channel,
                  '--os-variant', _get_image_os(template),
                  '--import',
                  '--noautoconsole',
-                 '--noreboot'))
+                 '--noreboot') +
+                tuple(_get_device_options(path, network, tuning,
+                                          kwargs['cpus'])) +
+                tuple(_get_tuning_options(tuning, placement)))
+
+        if define:
+            _execute_stage(args, name, 'install', **stage)
+            return None
+
+        # Only the domain xml, the caller creates the (transient) domain
+        stdout, _ = execute(args + ('--print-xml',), stdout=subprocess.PIPE,
+                            timeout=stage['timeouts']['install'],
+                            cancel=stage['cancel'])
+        return stdout.decode('utf-8')
+
+    def _create_snapshot(self, template, base, repository, kwargs, stage,
+                         tuning):
+        # The template booted once (its first boot work done), shut down
+        # and cleaned as the bases (virt-sysprep): the instances are cold
+        # booted from overlays of its disk and get their own machine id and
+        # ssh host keys. Nothing of the guest memory is reused.
+        seed = '{0}{1}'.format(os.path.splitext(base)[0], SNAPSHOT_SUFFIX)
+        disk = '{0}.{1}'.format(seed, BASE_FORMAT)
+        path = os.path.join(repository, disk)
+
+        if os.path.exists(path):
+            return disk
+
+        conn = self._libvirt_open()
+        partial = '{0}.part'.format(path)
+
+        with Rollback() as rollback:
+            rollback.add(_remove_file, partial)
+            _create_overlay(base, partial, seed, stage,
+                            _get_overlay_options(repository,
+                                                 kwargs['overlay']))
+
+            rollback.add(_remove_domain, conn, seed)
+            self._install_domain(seed, partial, template, kwargs, stage,
+                                 tuning)
+
+            dom = _get_domain(conn, seed)
+            dom.create()
+
+            _wait_domain_ready(dom, stage['timeouts']['snapshot'],
+                               stage['cancel'])
+
+            _shutdown_domain(dom)
+            _wait_domain_stopped(dom, STOP_GRACE, stage['cancel'])
+
+            _execute_stage(('virt-sysprep', '-a', partial,
+                            '--operations', 'defaults,-ssh-userdir'),
+                           seed, 'sysprep', **stage)
+
+        _remove_domain(conn, seed)
+        os.rename(partial, path)
+
+        return disk
+
+    @_instrumented
+    def instance_reset(self, vmid, **kwargs):
+        conn = self._libvirt_open()
+        dom = _get_domain(conn, vmid)
+        stage = _stage_options(kwargs)
+
+        if not dom.isPersistent():
+            raise VirtDeployException(
+                'Ephemeral instance {0} cannot be reset'.format(vmid))
+
+        path = _get_domain_disk_path(dom)
+        journal = _get_journal(os.path.dirname(path))
+        resumed = journal.begin(dom.name(), 'reset') or {'stages': []}
+
+        with Rollback() as rollback:
+            # An interrupted reset is left pending, to be resumed
+            rollback.add(journal.release, dom.name())
+
+            active = _destroy_domain(dom)
+
+            # A suspended memory state doesn't belong to the new disk
+            if dom.hasManagedSaveImage(0):
+                dom.managedSaveRemove(0)
+                active = True
+
+            # The instance may have been stopped by the interrupted run
+            if 'stop' in resumed['stages']:
+                active = active or resumed['active']
+            else:
+                journal.record(dom.name(), 'stop', active=active)
+
+            # The domain definition and the network reservations are kept:
+            # the instance gets a pristine overlay with the same identity.
+            if 'overlay' not in resumed['stages']:
+                _create_overlay(_get_image_backing(path), path, dom.name(),
+                                stage,
+                                _get_overlay_options(os.path.dirname(path),
+                                                     kwargs.get('overlay')))
+                journal.record(dom.name(), 'overlay')
 
-        netmac = _get_domain_mac_addresses(_get_domain(conn, name)).next()
-        ipaddress = _new_network_ipaddress(net)
+            netmac = next(_get_domain_mac_addresses(dom))
+            net = conn.networkLookupByName(netmac['network'])
 
-        # TODO: fix race between _new_network_ipaddress and ip reservation
-        _add_network_host(net, hostname, ipaddress)
-        _add_network_dhcp_host(net, hostname, netmac['mac'], ipaddress)
+            for host in _get_network_dhcp_hosts(net):
+                if host['mac'] == netmac['mac']:
+                    break
+            else:
+                raise VirtDeployException(
+                    'No network reservation for {0}'.format(vmid))
+
+            fqdn = _get_network_fqdn(net, host['name'])
+            password = kwargs.get('password') or random_password()
+
+            _customize_instance(path, fqdn, password, dom.name(), stage)
+
+            if active:
+                dom.create()
+
+            journal.end(dom.name())
 
         return {
-            'name': name,
-            'password': kwargs['password'],
+            'name': dom.name(),
+            'password': password,
             'mac': netmac['mac'],
             'hostname': fqdn,
-            'ipaddress': ipaddress,
+            'ipaddress': host['ip'],
         }
 
+    @_instrumented
+    def instance_clone(self, vmid, count, prefix=None, workers=None,
+                       **kwargs):
+        conn = self._libvirt_open()
+        dom = _get_domain(conn, vmid)
+        metadata = _get_domain_metadata(dom)
+
+        if metadata is None:
+            raise VirtDeployException(
+                'Instance {0} was not created by virt-deploy'.format(vmid))
+
+        kwargs = dict(kwargs)
+        pool = conn.storagePoolLookupByName(kwargs.get('pool') or
+                                            DEFAULT_POOL)
+
+        # The clones get the hardware of the source and a new identity
+        _, maxmem, _, cpus, _ = dom.info()
+        kwargs.setdefault('cpus', cpus)
+        kwargs.setdefault('memory', maxmem // 1024)
+        kwargs.setdefault('arch', metadata['arch'])
+        kwargs.setdefault('tuning', metadata.get('tuning'))
+        kwargs.setdefault('network', next(
+            _get_domain_mac_addresses(dom))['network'])
+
+        if prefix is None:
+            suffix = '-{0}-{1}'.format(metadata['template'], metadata['arch'])
+            prefix = '{0}-'.format(dom.name()[:-len(suffix)]
+                                   if dom.name().endswith(suffix)
+                                   else dom.name())
+
+        vmids = ['{0}{1}'.format(prefix, x) for x in range(1, count + 1)]
+
+        base = _create_clone_base(dom, _get_pool_path(pool),
+                                  _stage_options(kwargs))
+        kwargs['base'] = base
+
+        def create(x):
+            return self.instance_create(x, metadata['template'], **kwargs)
+
+        result = {'base': base, 'instances': [], 'errors': {}}
+
+        for x, (instance, error) in zip(vmids, parallel(
+                create, vmids, workers or PARALLEL_WORKERS)):
+            if error is None:
+                result['instances'].append(instance)
+            else:
+                result['errors'][x] = str(error)
+
+        if not result['instances']:
+            _remove_file(os.path.join(_get_pool_path(pool), base))
+
+        return result
+
     def instance_address(self, vmid, network=None):
         conn = self._libvirt_open()
         dom = _get_domain(conn, vmid)
@@ -177,11 +838,18 @@ class VirtDeployLibvirtDriver(VirtDeployDriverBase):
         netmacs = _get_domain_macs_by_network(dom)
 
         if network:
-            netmacs = {k: v for k, v in netmacs.iteritems()}
+            netmacs = {k: v for k, v in netmacs.items() if k == network}
+
+        # The guest agent knows also the addresses that are not assigned
+        # by dhcp (e.g. static), the leases are used when it's missing.
+        addresses = _get_agent_addresses(dom, netmacs)
+
+        if addresses is not None:
+            return addresses
 
         addresses = set()
 
-        for name, macs in netmacs.iteritems():
+        for name, macs in netmacs.items():
             net = conn.networkLookupByName(name)
 
             for lease in _get_network_dhcp_leases(net):
@@ -190,6 +858,22 @@ class VirtDeployLibvirtDriver(VirtDeployDriverBase):
 
         return list(addresses)
 
+    def instance_copy_in(self, vmid, files, **kwargs):
+        dom = _get_domain(self._libvirt_open(), vmid)
+
+        # The disk can't be modified while it's in use
+        if dom.isActive() or dom.hasManagedSaveImage(0):
+            raise VirtDeployException(
+                'Instance {0} is not stopped'.format(vmid))
+
+        _execute_stage(('virt-customize', '-a', _get_domain_disk_path(dom)) +
+                       tuple(_copy_in_options(files)),
+                       vmid, 'customize', **_stage_options(kwargs))
+
+    def instance_ready(self, vmid):
+        return _domain_ready(_get_domain(self._libvirt_open(), vmid))
+
+    @_instrumented
     def instance_start(self, vmid):
         dom = _get_domain(self._libvirt_open(), vmid)
 
@@ -199,22 +883,155 @@ class VirtDeployLibvirtDriver(VirtDeployDriverBase):
             if e.get_error_code() != libvirt.VIR_ERR_OPERATION_INVALID:
                 raise
 
-    def instance_stop(self, vmid):
+    @_instrumented
+    def instance_suspend(self, vmid):
         dom = _get_domain(self._libvirt_open(), vmid)
 
+        # The memory is saved to disk and the domain is stopped, the next
+        # start (or resume) restores it.
         try:
-            dom.shutdownFlags(
-                libvirt.VIR_DOMAIN_SHUTDOWN_GUEST_AGENT |
-                libvirt.VIR_DOMAIN_SHUTDOWN_ACPI_POWER_BTN
-            )
+            dom.managedSave(0)
         except libvirt.libvirtError as e:
             if e.get_error_code() != libvirt.VIR_ERR_OPERATION_INVALID:
                 raise
 
+    @_instrumented
+    def instance_resume(self, vmid):
+        dom = _get_domain(self._libvirt_open(), vmid)
+
+        if dom.isActive():
+            return
+
+        if not dom.hasManagedSaveImage(0):
+            raise VirtDeployException(
+                'Instance {0} is not suspended'.format(vmid))
+
+        dom.create()
+
+    def instance_list(self):
+        instances = []
+        journals = {}
+
+        for dom in self._libvirt_open().listAllDomains(0):
+            metadata = _get_domain_metadata(dom)
+
+            # Only the instances created by virt-deploy are listed
+            if metadata is None:
+                continue
+
+            # An interrupted creation (or reset) is pending in the journal
+            # of the pool holding the disk.
+            if dom.isPersistent():
+                repository = os.path.dirname(_get_domain_disk_path(dom))
+
+                if repository not in journals:
+                    journals[repository] = _get_journal(repository).pending()
+
+                pending = journals[repository].get(dom.name(), {})
+            else:
+                pending = {}
+
+            # The suspended instances (managed save) look inactive
+            active = bool(dom.isActive())
+            saved = not active and bool(dom.hasManagedSaveImage(0))
+
+            instances.append(dict(metadata, name=dom.name(), active=active,
+                                  saved=saved,
+                                  pending=pending.get('operation')))
+
+        return sorted(instances, key=lambda x: x['name'])
+
+    def instance_cpu_stats(self):
+        stats = {}
+
+        for name, record in _get_all_domain_stats(
+                self._libvirt_open(),
+                libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+                libvirt.VIR_DOMAIN_STATS_VCPU):
+            stats[name] = {'cpu_time': record['cpu.time'],
+                           'vcpus': record.get('vcpu.current', 1)}
+
+        return stats
+
+    def instance_stats(self):
+        stats = {}
+
+        for name, record in _get_all_domain_stats(
+                self._libvirt_open(),
+                libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+                libvirt.VIR_DOMAIN_STATS_VCPU |
+                libvirt.VIR_DOMAIN_STATS_BALLOON |
+                libvirt.VIR_DOMAIN_STATS_BLOCK |
+                libvirt.VIR_DOMAIN_STATS_INTERFACE):
+            stats[name] = _parse_domain_stats(record)
+
+        return stats
+
+    def instance_benchmark(self, vmid, runtime=None):
+        dom = _get_domain(self._libvirt_open(), vmid)
+
+        if runtime is None:
+            runtime = BENCHMARK_RUNTIME
+
+        exitcode, out = _agent_exec(
+            dom, '/usr/bin/fio', BENCHMARK_JOB + (
+                '--filename={0}'.format(BENCHMARK_FILE),
+                '--runtime={0}'.format(runtime)),
+            timeout=runtime + AGENT_TIMEOUT * 6)
+
+        if exitcode != 0:
+            raise VirtDeployException(
+                'Benchmark failed on {0}: {1}'.format(vmid, out.strip()))
+
+        result = _parse_fio_result(out)
+        result['tuning'] = (_get_domain_metadata(dom) or {}).get('tuning')
+
+        return result
+
+    def instance_stop(self, vmid):
+        _shutdown_domain(_get_domain(self._libvirt_open(), vmid))
+
+    @_instrumented
+    def instance_stop_wait(self, vmids, grace=None):
+        if grace is None:
+            grace = STOP_GRACE
+
+        conn = self._libvirt_open(events=True)
+        doms = dict((x, _get_domain(conn, x)) for x in vmids)
+
+        result = {}
+
+        # All the instances share the same event callback (and loop): the
+        # wait lasts as long as the slowest guest and not as their sum.
+        watch = _LifecycleWatch(conn, doms, libvirt.VIR_DOMAIN_EVENT_STOPPED)
+
+        with watch:
+            for name, dom in doms.items():
+                if not _shutdown_domain(dom):
+                    result[name] = 'stopped'
+
+            pending = set(doms) - set(result)
+            stopped = watch.wait(pending, grace)
+
+            for name in pending:
+                if name in stopped or not _destroy_domain(doms[name]):
+                    result[name] = 'shutdown'
+                else:
+                    result[name] = 'destroyed'
+
+        return result
+
+    @_instrumented
     def instance_delete(self, vmid):
         conn = self._libvirt_open()
         dom = _get_domain(conn, vmid)
 
+        # A transient domain is gone once destroyed
+        if not dom.isPersistent():
+            _destroy_domain(dom)
+            _release_ephemeral(conn, vmid)
+            return
+
         try:
             dom.destroy()
         except libvirt.libvirtError as e:
@@ -223,16 +1040,13 @@ class VirtDeployLibvirtDriver(VirtDeployDriverBase):
 
         xmldesc = etree.fromstring(dom.XMLDesc())
 
+        # Removing large disks can take long, they are only moved away
         for disk in xmldesc.iterfind('./devices/disk/source'):
-            try:
-                os.remove(disk.get('file'))
-            except OSError as e:
-                if e.errno != os.errno.ENOENT:
-                    raise
+            _trash_file(disk.get('file'))
 
         netmacs = _get_domain_macs_by_network(dom)
 
-        for network, macs in netmacs.iteritems():
+        for network, macs in netmacs.items():
             net = conn.networkLookupByName(network)
 
             for x in _get_network_dhcp_hosts(net):
@@ -240,154 +1054,1437 @@ class VirtDeployLibvirtDriver(VirtDeployDriverBase):
                     _del_network_host(net, x['name'])
                     _del_network_dhcp_host(net, x['name'])
 
-        dom.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA)
+        dom.undefineFlags(_undefine_flags())
 
+    def pool_info(self, pool=None):
+        conn = self._libvirt_open()
+        pool = conn.storagePoolLookupByName(pool or DEFAULT_POOL)
+        pool.refresh(0)
 
-def _get_image_os(image):
-    if image.startswith('centos-7'):
-        return 'centos7.0'
-    try:
-        return _IMAGE_OS_TABLE[image]
-    except KeyError:
-        return image.replace('-', '')
+        _, capacity, allocation, available = pool.info()
+        trash = _get_trash_usage(_get_pool_path(pool))
 
+        return {
+            'name': pool.name(),
+            'capacity': capacity,
+            'allocation': allocation,
+            'available': available,
+            'trash': trash,
+        }
 
-def _create_base(template, arch, repository):
-    name = '_{0}-{1}.{2}'.format(template, arch, BASE_FORMAT)
-    path = os.path.join(repository, name)
+    @_instrumented
+    def pool_gc(self, pool=None, rate=None, age=None):
+        conn = self._libvirt_open()
+        pool = conn.storagePoolLookupByName(pool or DEFAULT_POOL)
+        repository = _get_pool_path(pool)
+        trash = os.path.join(repository, TRASH_DIR)
 
-    if not os.path.exists(path):
-        execute(('virt-builder', template,
-                 '-o', path,
-                 '--size', BASE_SIZE,
-                 '--format', BASE_FORMAT,
-                 '--arch', arch,
-                 '--root-password', 'locked:disabled'))
-
-        # As mentioned in the virt-builder man in section "CLONES" the
-        # resulting image should be cleaned before bsing used as template.
-        # TODO: handle half-backed templates
-        execute(('virt-sysprep', '-a', path))
+        # The clone bases are trashed first, to be reclaimed with the rest
+        bases = 0
 
-    return name
+        for path in _list_unused_clone_bases(conn, repository):
+            _trash_file(path)
+            bases += 1
 
+        files, freed = 0, 0
 
-def _get_virt_templates():
-    stdout, _ = execute(('virt-builder', '-l', '--list-format', 'json'),
-                        stdout=subprocess.PIPE)
-    return json.loads(stdout)
+        for name in sorted(_list_directory(trash)):
+            if age is not None and _trash_age(name) < age:
+                continue
 
+            freed += reclaim_file(os.path.join(trash, name), rate or GC_RATE)
+            files += 1
 
-def _get_domain(conn, name):
-    try:
-        return conn.lookupByName(name)
-    except libvirt.libvirtError as e:
-        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
-            raise InstanceNotFound(name)
-        raise
+        # Ephemeral instances left behind by a reaper that didn't run
+        ephemeral = 0
 
+        for name in _list_ephemeral(conn):
+            if _release_ephemeral(conn, name):
+                ephemeral += 1
 
-def _get_domain_mac_addresses(dom):
-    xmldesc = etree.fromstring(dom.XMLDesc())
-    netxpath = './devices/interface[@type="network"]'
+        return {'files': files, 'bytes': freed, 'ephemeral': ephemeral,
+                'bases': bases}
 
-    for iface in xmldesc.iterfind(netxpath):
-        network = iface.find('./source').get('network')
-        mac = iface.find('./mac').get('address')
+    def pool_fsck(self, pool=None, repair=False):
+        conn = self._libvirt_open()
+        pool = conn.storagePoolLookupByName(pool or DEFAULT_POOL)
+        repository = _get_pool_path(pool)
 
-        yield {'mac': mac, 'network': network}
+        result = {'domains': [], 'hosts': [], 'dns': [], 'images': [],
+                  'repaired': repair}
 
+        # The networks are read before the domains and the ephemeral states:
+        # a reservation seen here belongs to something listed afterwards.
+        with _network_lock():
+            nets = [(x, etree.fromstring(x.XMLDesc())) for x in
+                    conn.listAllNetworks(
+                        libvirt.VIR_CONNECT_LIST_NETWORKS_ACTIVE)]
 
-def _get_domain_macs_by_network(dom):
-    netmacs = {}
+            macs, disks, broken = _get_domains_index(conn)
+            hostnames = set(_list_ephemeral_hostnames())
 
-    for x in _get_domain_mac_addresses(dom):
-        netmacs.setdefault(x['network'], []).append(x['mac'])
+            # The interrupted creations are resumed (or rolled back) by
+            # journal_recover, what they left behind is not an orphan.
+            for x in _get_journal(repository).pending().values():
+                if x['operation'] == 'create':
+                    hostnames.add(x['hostname'])
+                    disks.add(x['path'])
 
-    return netmacs
+            for net, xmldesc in nets:
+                hosts, dns = _get_network_orphans(xmldesc, macs, hostnames)
 
+                result['hosts'].extend(dict(x, network=net.name())
+                                       for x in hosts)
+                result['dns'].extend({'network': net.name(), 'name': x}
+                                     for x in dns)
 
-def _get_pool_path(pool):
-    xmldesc = etree.fromstring(pool.XMLDesc())
+                if repair:
+                    for x in hosts:
+                        _del_network_dhcp_host(net, x['name'])
+                    for x in dns:
+                        _del_network_host(net, x)
 
-    for x in xmldesc.iterfind('.[@type="dir"]/target/path'):
-        return x.text
+        for dom in broken:
+            result['domains'].append(dom.name())
 
-    raise OSError(os.errno.ENOENT, 'Path not found for pool')
+            if repair:
+                dom.undefineFlags(_undefine_flags())
 
+        for name in sorted(_list_directory(repository)):
+            path = os.path.join(repository, name)
 
-def _get_network_domainname(net):
-    xmldesc = etree.fromstring(net.XMLDesc())
+            if (path not in disks and _is_instance_image(path) and
+                    _file_age(path) >= RECONCILE_GRACE):
+                result['images'].append(path)
 
-    for domain in xmldesc.iterfind('./domain'):
-        return domain.get('name')
+                if repair:
+                    _trash_file(path)
 
+        return result
 
-def _add_network_host(net, hostname, ipaddress):
-    xmlhost = etree.Element('host')
-    xmlhost.set('ip', ipaddress)
-    etree.SubElement(xmlhost, 'hostname').text = hostname
+    def journal_recover(self, pool=None, rollback=False):
+        conn = self._libvirt_open()
+        pool = conn.storagePoolLookupByName(pool or DEFAULT_POOL)
+        journal = _get_journal(_get_pool_path(pool))
 
-    # Attempt to delete if present
-    _del_network_host(net, hostname)
-    net.update(_NET_ADD_LAST, _NET_DNS_HOST, 0, etree.tostring(xmlhost),
-               _NET_UPDATE_FLAGS)
+        result = {'instances': [], 'rolledback': [], 'errors': {}}
 
+        for name, state in sorted(journal.pending().items()):
+            try:
+                # A reset can only go forward, the old disk is gone
+                if state['operation'] == 'reset':
+                    if _lookup_domain(conn, name) is None:
+                        _rollback_operation(journal, name, state)
+                        result['rolledback'].append(name)
+                    else:
+                        result['instances'].append(self.instance_reset(name))
+                elif rollback:
+                    _rollback_create(conn, journal, name, state)
+                    result['rolledback'].append(name)
+                else:
+                    # A failure rolls the creation back
+                    result['instances'].append(self.instance_create(
+                        state['vmid'], state['template'], **state['kwargs']))
+            except Exception as e:
+                result['errors'][name] = str(e)
+
+        return result
+
+    def metrics_collect(self):
+        conn = self._libvirt_open()
 
-def _del_network_host(net, hostname):
-    xmlhost = etree.Element('host')
-    etree.SubElement(xmlhost, 'hostname').text = hostname
+        NETWORK_ADDRESSES.clear()
+        NETWORK_ADDRESSES_USED.clear()
 
-    try:
-        net.update(_NET_DELETE, _NET_DNS_HOST, 0, etree.tostring(xmlhost),
-                   _NET_UPDATE_FLAGS)
-    except libvirt.libvirtError as e:
-        if e.get_error_code() != libvirt.VIR_ERR_OPERATION_INVALID:
-            raise
+        for net in conn.listAllNetworks(
+                libvirt.VIR_CONNECT_LIST_NETWORKS_ACTIVE):
+            usage = _get_network_address_usage(net)
 
+            if usage is not None:
+                NETWORK_ADDRESSES.set(usage[1], network=net.name())
+                NETWORK_ADDRESSES_USED.set(usage[0], network=net.name())
 
-def _add_network_dhcp_host(net, hostname, mac, ipaddress):
-    xmlhost = etree.Element('host')
-    xmlhost.set('mac', mac)
-    xmlhost.set('name', hostname)
-    xmlhost.set('ip', ipaddress)
+        for gauge in (POOL_CAPACITY, POOL_AVAILABLE, POOL_TRASH, POOL_BASES,
+                      POOL_SNAPSHOTS):
+            gauge.clear()
 
-    # Attempt to delete if present
-    _del_network_dhcp_host(net, hostname)
-    net.update(_NET_ADD_LAST, _NET_DHCP_HOST, 0, etree.tostring(xmlhost),
-               _NET_UPDATE_FLAGS)
+        for pool in conn.listAllStoragePools(
+                libvirt.VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE):
+            _, capacity, _, available = pool.info()
+            POOL_CAPACITY.set(capacity, pool=pool.name())
+            POOL_AVAILABLE.set(available, pool=pool.name())
 
+            try:
+                repository = _get_pool_path(pool)
+            except OSError:
+                continue  # not a directory pool
 
-def _del_network_dhcp_host(net, hostname):
-    xmlhost = etree.Element('host')
-    xmlhost.set('name', hostname)
+            files = _list_directory(repository)
 
-    try:
-        net.update(_NET_DELETE, _NET_DHCP_HOST, 0, etree.tostring(xmlhost),
-                   _NET_UPDATE_FLAGS)
-    except libvirt.libvirtError as e:
-        if e.get_error_code() != libvirt.VIR_ERR_OPERATION_INVALID:
-            raise
+            POOL_TRASH.set(_get_trash_usage(repository), pool=pool.name())
+            snapshot = '{0}.{1}'.format(SNAPSHOT_SUFFIX, BASE_FORMAT)
 
+            POOL_BASES.set(sum(1 for x in files if x.startswith('_') and
+                               x.endswith('.' + BASE_FORMAT) and
+                               not x.endswith(snapshot)),
+                           pool=pool.name())
+            POOL_SNAPSHOTS.set(sum(1 for x in files if x.startswith('_') and
+                                   x.endswith(snapshot)),
+                               pool=pool.name())
 
-def _get_network_dhcp_hosts(net):
-    xmldesc = etree.fromstring(net.XMLDesc())
+        return metrics.render()
 
-    for x in xmldesc.iterfind('./ip/dhcp/host'):
-        yield {'name': x.get('name'), 'mac': x.get('mac'),
-               'ip': x.get('ip')}
+    def instance_reap(self, vmid):
+        # Waits for the ephemeral instance to stop and then releases its
+        # disk and network reservations (see virtdeploy.reaper).
+        conn = self._libvirt_open(events=True)
+        dom = _lookup_domain(conn, vmid)
 
+        if dom is not None:
+            watch = _LifecycleWatch(conn, {vmid: dom},
+                                    libvirt.VIR_DOMAIN_EVENT_STOPPED)
+
+            with watch:
+                if _domain_active(dom):
+                    watch.wait(set([vmid]), None)
+
+        return _release_ephemeral(conn, vmid)
 
-def _get_network_dhcp_leases(net):
-    for x in _get_network_dhcp_hosts(net):
-        yield x
 
-    for x in net.DHCPLeases():
-        yield {'name': x['hostname'], 'mac': x['mac'],
-               'ip': x['ipaddr']}
+def _get_all_domain_stats(conn, stats):
+    # A single bulk query for all the running domains (of virt-deploy)
+    for dom, record in conn.getAllDomainStats(
+            stats, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE):
+        if _get_domain_metadata(dom) is not None:
+            yield dom.name(), record
+
 
+def _sum_domain_stats(record, group, key):
+    return sum(record.get('{0}.{1}.{2}'.format(group, x, key), 0)
+               for x in range(record.get('{0}.count'.format(group), 0)))
+
+
+def _parse_domain_stats(record):
+    memory = record.get('balloon.current', 0) * 1024
+
+    # Without the guest memory stats the resident size is the best guess
+    if 'balloon.available' in record and 'balloon.unused' in record:
+        used = (record['balloon.available'] - record['balloon.unused']) * 1024
+    else:
+        used = record.get('balloon.rss', 0) * 1024
+
+    return {
+        'cpu_time': record.get('cpu.time', 0),
+        'vcpus': record.get('vcpu.current', 1),
+        'memory': memory,
+        'memory_used': used,
+        'block_rd_bytes': _sum_domain_stats(record, 'block', 'rd.bytes'),
+        'block_wr_bytes': _sum_domain_stats(record, 'block', 'wr.bytes'),
+        'block_rd_reqs': _sum_domain_stats(record, 'block', 'rd.reqs'),
+        'block_wr_reqs': _sum_domain_stats(record, 'block', 'wr.reqs'),
+        'net_rx_bytes': _sum_domain_stats(record, 'net', 'rx.bytes'),
+        'net_tx_bytes': _sum_domain_stats(record, 'net', 'tx.bytes'),
+    }
+
+
+def _event_loop_start():
+    global _event_loop
+
+    # The default event loop must be registered before opening the
+    # connections that are delivering the events.
+    with _EVENT_LOOP_LOCK:
+        if _event_loop is not None:
+            return
+
+        libvirt.virEventRegisterDefaultImpl()
+
+        _event_loop = threading.Thread(target=_event_loop_run)
+        _event_loop.daemon = True
+        _event_loop.start()
+
+
+def _event_loop_run():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+class _LifecycleWatch(object):
+    # Collects the names of the domains receiving a lifecycle event. The
+    # domains state is also checked periodically in case an event is lost.
+
+    def __init__(self, conn, doms, event):
+        self._conn = conn
+        self._doms = doms
+        self._event = event
+        self._cond = threading.Condition()
+        self._callback = None
+        self.received = set()
+
+    def __enter__(self):
+        self._callback = self._conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._received,
+            None)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self._conn.domainEventDeregisterAny(self._callback)
+
+    def _received(self, conn, dom, event, detail, opaque):
+        if event == self._event:
+            with self._cond:
+                self.received.add(dom.name())
+                self._cond.notify_all()
+
+    def wait(self, names, timeout):
+        # Without a timeout it waits until all the domains got the event
+        if timeout is not None:
+            endtime = monotonic_time() + timeout
+
+        with self._cond:
+            while not names <= self.received:
+                if timeout is None:
+                    remaining = EVENT_RECHECK_INTERVAL
+                else:
+                    remaining = endtime - monotonic_time()
+
+                if remaining <= 0:
+                    break
+
+                self._cond.wait(min(remaining, EVENT_RECHECK_INTERVAL))
+
+                if self._event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+                    self.received.update(
+                        x for x in names - self.received
+                        if not _domain_active(self._doms[x]))
+
+            return names & self.received
+
+
+def _agent_command(dom, command, arguments=None, timeout=AGENT_TIMEOUT):
+    import libvirt_qemu
+
+    request = {'execute': command}
+
+    if arguments is not None:
+        request['arguments'] = arguments
+
+    response = libvirt_qemu.qemuAgentCommand(dom, json.dumps(request),
+                                             timeout, 0)
+    return json.loads(response)['return']
+
+
+def _agent_ping(dom):
+    # No agent: not running (yet), without libvirt_qemu (python bindings)
+    # or answering garbage.
+    try:
+        _agent_command(dom, 'guest-ping', timeout=AGENT_PING_TIMEOUT)
+    except (libvirt.libvirtError, ImportError, KeyError, ValueError):
+        return False
+
+    return True
+
+
+def _agent_exec(dom, path, args=(), timeout=AGENT_TIMEOUT):
+    pid = _agent_command(dom, 'guest-exec', {
+        'path': path,
+        'arg': list(args),
+        'capture-output': True,
+    })['pid']
+
+    endtime = monotonic_time() + timeout
+
+    while True:
+        status = _agent_command(dom, 'guest-exec-status', {'pid': pid})
+
+        if status['exited']:
+            break
+
+        if monotonic_time() >= endtime:
+            raise CommandTimeout(path, timeout)
+
+        time.sleep(AGENT_EXEC_INTERVAL)
+
+    out = base64.b64decode(status.get('out-data', '')).decode('utf-8')
+    return status.get('exitcode'), out
+
+
+def _domain_ready(dom):
+    if not dom.isActive() or not _agent_ping(dom):
+        return False
+
+    # A timeout or a failed (or malformed) answer is not a completed boot,
+    # it's checked again until the stage timeout. The guests without a
+    # working agent are covered by the tcp probe (wait_instance).
+    try:
+        _, out = _agent_exec(dom, '/usr/bin/systemctl',
+                             ['is-system-running'])
+    except (CommandTimeout, libvirt.libvirtError, KeyError, ValueError):
+        return False
+
+    return out.strip() in BOOT_COMPLETE_STATES
+
+
+def _wait_domain_ready(dom, timeout, cancel=None):
+    endtime = monotonic_time() + timeout
+
+    while not _domain_ready(dom):
+        if cancel is not None and cancel.is_set():
+            raise OperationCancelled(dom.name())
+
+        if monotonic_time() >= endtime:
+            raise CommandTimeout(dom.name(), timeout)
+
+        time.sleep(READY_INTERVAL)
+
+
+def _wait_domain_stopped(dom, timeout, cancel=None):
+    endtime = monotonic_time() + timeout
+
+    while dom.isActive():
+        if cancel is not None and cancel.is_set():
+            raise OperationCancelled(dom.name())
+
+        if monotonic_time() >= endtime:
+            raise CommandTimeout(dom.name(), timeout)
+
+        time.sleep(READY_INTERVAL)
+
+
+def _get_agent_addresses(dom, netmacs):
+    if not dom.isActive() or not _agent_ping(dom):
+        return None
+
+    try:
+        ifaces = dom.interfaceAddresses(
+            libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT)
+    except libvirt.libvirtError:
+        return None
+
+    macs = set(mac for x in netmacs.values() for mac in x)
+    addresses = []
+
+    for iface in ifaces.values():
+        if iface['hwaddr'] not in macs:
+            continue
+
+        for x in iface['addrs'] or ():
+            if not x['addr'].startswith('fe80:'):
+                addresses.append(x['addr'])
+
+    return addresses
+
+
+def _get_image_os(image):
+    if image.startswith('centos-7'):
+        return 'centos7.0'
+    try:
+        return _IMAGE_OS_TABLE[image]
+    except KeyError:
+        return image.replace('-', '')
+
+
+def _stage_options(kwargs):
+    timeouts = dict(STAGE_TIMEOUTS)
+    timeouts.update(kwargs.get('timeouts') or {})
+
+    return {
+        'progress': kwargs.get('progress'),
+        'timeouts': timeouts,
+        'cancel': kwargs.get('cancel'),
+    }
+
+
+def _execute_stage(args, name, stage, progress=None, timeouts=None,
+                   cancel=None, cwd=None):
+    try:
+        with STAGE_DURATION.time(stage=stage):
+            return execute(args, cwd=cwd,
+                           callback=_stage_callback(progress, name, stage),
+                           timeout=(timeouts or STAGE_TIMEOUTS).get(stage),
+                           cancel=cancel)
+    except Exception:
+        STAGE_FAILURES.inc(stage=stage)
+        raise
+
+
+def _stage_callback(progress, name, stage):
+    # The output of the stages is always piped (and not inherited), so that
+    # parallel creations don't interleave their output and the last lines
+    # are kept for the error reports. It's forwarded only on request.
+    def callback(line):
+        if progress is None:
+            return
+
+        event = parse_progress(line)
+
+        if event is not None:
+            event.update({'instance': name, 'stage': stage})
+            progress(event)
+
+    return callback
+
+
+def _create_base(template, arch, repository, profile=None, sparsify=False,
+                 compress=False, **stage):
+    if profile:
+        name = '_{0}-{1}-{2}.{3}'.format(template, arch,
+                                         profile_hash(profile), BASE_FORMAT)
+    else:
+        name = '_{0}-{1}.{2}'.format(template, arch, BASE_FORMAT)
+
+    path = os.path.join(repository, name)
+
+    if not os.path.exists(path):
+        # The image is built under a temporary name and renamed only when
+        # ready, so that a failed build is never picked up as a base.
+        partial = '{0}.part'.format(path)
+
+        with Rollback() as rollback:
+            rollback.add(_remove_file, partial)
+            _build_base(template, arch, name, partial, profile, stage)
+            _shrink_base(name, partial, sparsify, compress, stage)
+
+        os.rename(partial, path)
+
+    return name
+
+
+def _build_base(template, arch, name, partial, profile, stage):
+    _execute_stage(('virt-builder', template,
+                    '-o', partial,
+                    '--size', BASE_SIZE,
+                    '--format', BASE_FORMAT,
+                    '--arch', arch,
+                    '--root-password', 'locked:disabled') +
+                   _get_source_options(template, arch) +
+                   _get_profile_options(profile),
+                   name, 'build', **stage)
+
+    # As mentioned in the virt-builder man in section "CLONES" the
+    # resulting image should be cleaned before bsing used as template.
+    # The ssh directories are preserved when a profile injected keys.
+    if profile:
+        operations = ('--operations', 'defaults,-ssh-userdir')
+    else:
+        operations = ()
+
+    _execute_stage(('virt-sysprep', '-a', partial) + operations,
+                   name, 'sysprep', **stage)
+
+
+def _shrink_base(name, partial, sparsify, compress, stage):
+    # Every overlay reads from the base: the less it takes, the less i/o
+    # (and page cache) the instances need.
+    if sparsify:
+        _execute_stage(('virt-sparsify', '--in-place', partial),
+                       name, 'sparsify', **stage)
+
+    if compress:
+        compressed = '{0}.compressed'.format(partial)
+
+        with Rollback() as rollback:
+            rollback.add(_remove_file, compressed)
+            _execute_stage(('qemu-img', 'convert', '-c', '-O', BASE_FORMAT,
+                            partial, compressed), name, 'compress', **stage)
+
+        os.rename(compressed, partial)
+
+
+def _create_clone_base(dom, repository, stage):
+    # The disk of the source is flattened (with its backing chain) in a new
+    # base image, cleaned as the template ones (virt-sysprep).
+    name = '{0}{1}-{2}-{3}.{4}'.format(
+        CLONE_BASE_PREFIX, dom.name(), time.strftime('%Y%m%d%H%M%S'),
+        uuid.uuid4().hex[:8], BASE_FORMAT)
+    path = os.path.join(repository, name)
+    partial = '{0}.part'.format(path)
+
+    with Rollback() as rollback:
+        rollback.add(_remove_file, partial)
+
+        with _DomainQuiesce(dom):
+            _execute_stage(('qemu-img', 'convert', '-U', '-O', BASE_FORMAT,
+                            _get_domain_disk_path(dom), partial),
+                           name, 'clone', **stage)
+
+        _execute_stage(('virt-sysprep', '-a', partial,
+                        '--operations', 'defaults,-ssh-userdir'),
+                       name, 'sysprep', **stage)
+
+    os.rename(partial, path)
+
+    return name
+
+
+class _DomainQuiesce(object):
+    # A running domain is paused (qemu flushes its disks) while its disk is
+    # copied, the guest filesystems are frozen first when the agent is up.
+    def __init__(self, dom):
+        self._dom = dom
+        self._paused = False
+        self._frozen = False
+
+    def __enter__(self):
+        if not self._dom.isActive():
+            return self
+
+        if _agent_ping(self._dom):
+            self._dom.fsFreeze()
+            self._frozen = True
+
+        # __exit__ is not called when __enter__ fails
+        try:
+            self._dom.suspend()
+        except Exception:
+            self._thaw()
+            raise
+
+        self._paused = True
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        try:
+            if self._paused:
+                self._dom.resume()
+        finally:
+            self._thaw()
+
+    def _thaw(self):
+        if self._frozen:
+            self._dom.fsThaw()
+            self._frozen = False
+
+
+def _get_overlay_options(repository, overrides=None):
+    options = dict(FILESYSTEM_OVERLAY_DEFAULTS.get(
+        filesystem_type(repository), OVERLAY_DEFAULTS))
+    options.update(overrides or {})
+
+    for key in options:
+        if key not in OVERLAY_KEYS:
+            raise VirtDeployException(
+                'Unknown overlay option {0}'.format(key))
+
+    preallocation = options.get('preallocation', 'off')
+
+    if preallocation != 'off' and _qemu_option(
+            options.get('extended_l2', False)) != 'on':
+        raise VirtDeployException(
+            'Overlay preallocation requires extended_l2')
+
+    return options
+
+
+def _qemu_option(value):
+    if value is True:
+        return 'on'
+    if value is False:
+        return 'off'
+    return str(value)
+
+
+def _get_profile_options(profile):
+    if not profile:
+        return ()
+
+    options = []
+
+    if profile.get('update'):
+        options.append('--update')
+
+    if profile.get('packages'):
+        options.extend(('--install', ','.join(profile['packages'])))
+
+    for upload in profile.get('files', ()):
+        options.extend(('--upload', upload))
+
+    for script in profile.get('scripts', ()):
+        options.extend(('--run', script))
+
+    for command in profile.get('commands', ()):
+        options.extend(('--run-command', command))
+
+    for key in profile.get('ssh_keys', ()):
+        options.extend(('--ssh-inject', 'root:string:{0}'.format(key)))
+
+    options.append('--selinux-relabel')
+
+    return tuple(options)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _make_directory(path, mode=0o700):
+    try:
+        os.makedirs(path, mode)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _ephemeral_state_path(name):
+    return os.path.join(EPHEMERAL_STATE_DIR, '{0}.json'.format(name))
+
+
+def _save_ephemeral_state(state):
+    _make_directory(EPHEMERAL_STATE_DIR)
+
+    path = _ephemeral_state_path(state['name'])
+    partial = '{0}.part'.format(path)
+
+    with open(partial, 'w') as f:
+        json.dump(state, f)
+
+    os.rename(partial, path)
+
+
+def _list_ephemeral(conn):
+    # The ephemeral instances recorded without a domain anymore
+    for x in _list_directory(EPHEMERAL_STATE_DIR):
+        name, ext = os.path.splitext(x)
+
+        if (ext == '.json' and
+                _file_age(os.path.join(EPHEMERAL_STATE_DIR, x)) >=
+                RECONCILE_GRACE and
+                _lookup_domain(conn, name) is None):
+            yield name
+
+
+def _list_ephemeral_hostnames():
+    for x in _list_directory(EPHEMERAL_STATE_DIR):
+        try:
+            with open(os.path.join(EPHEMERAL_STATE_DIR, x)) as f:
+                yield json.load(f)['hostname']
+        except (IOError, ValueError, KeyError):
+            continue  # released meanwhile or partial
+
+
+def _get_domains_index(conn):
+    # The mac addresses and the disks of all the domains (each definition
+    # is parsed once), and the inactive instances that lost their disk.
+    macs, disks, broken = set(), set(), []
+
+    for dom in conn.listAllDomains(0):
+        xmldesc = etree.fromstring(dom.XMLDesc())
+
+        macs.update(x.get('address') for x in
+                    xmldesc.iterfind('./devices/interface/mac'))
+
+        paths = [x.get('file') for x in
+                 xmldesc.iterfind('./devices/disk[@device="disk"]/source')
+                 if x.get('file')]
+        disks.update(paths)
+
+        if (not dom.isActive() and
+                any(not os.path.exists(x) for x in paths) and
+                _get_domain_metadata(dom) is not None):
+            broken.append(dom)
+
+    return macs, disks, broken
+
+
+def _get_network_orphans(xmldesc, macs, hostnames):
+    # Only the reservations of the virt-deploy instances are considered
+    hosts = [{'name': x.get('name'), 'mac': x.get('mac'), 'ip': x.get('ip')}
+             for x in xmldesc.iterfind('./ip/dhcp/host')
+             if _is_instance_hostname(x.get('name'))]
+
+    orphans = [x for x in hosts
+               if x['mac'] not in macs and x['name'] not in hostnames]
+    kept = hostnames.union(x['name'] for x in hosts if x not in orphans)
+
+    dns = [x.text for x in xmldesc.iterfind('./dns/host/hostname')
+           if _is_instance_hostname(x.text) and x.text not in kept]
+
+    return orphans, dns
+
+
+def _is_instance_hostname(name):
+    return bool(name) and name.startswith(HOSTNAME_PREFIX)
+
+
+def _is_instance_image(path):
+    # Overlays of the instances (and leftovers of failed creations) on the
+    # base images of the pool, that start with an underscore.
+    name = os.path.basename(path)
+
+    if name.startswith('_') or not (
+            name.endswith('.' + BASE_FORMAT) or
+            name.endswith('.{0}.part'.format(BASE_FORMAT))):
+        return False
+
+    try:
+        backing = _get_image_backing(path)
+    except (subprocess.CalledProcessError, VirtDeployException):
+        return False  # not an overlay (or not an image at all)
+
+    return os.path.basename(backing).startswith('_')
+
+
+def _list_unused_clone_bases(conn, repository):
+    suffixes = ('.' + BASE_FORMAT, '.{0}.part'.format(BASE_FORMAT))
+    names = [x for x in _list_directory(repository) if x.endswith(suffixes)]
+    bases = [x for x in names if x.startswith(CLONE_BASE_PREFIX) and
+             _file_age(os.path.join(repository, x)) >= RECONCILE_GRACE]
+
+    if not bases:
+        return []  # no image to inspect
+
+    # The disks of the domains (ephemeral ones included) and the images of
+    # the pool that are not bases (orphans are left to fsck), and the bases
+    # of the creations (running or interrupted) without a domain yet.
+    _, disks, _ = _get_domains_index(conn)
+    disks.update(os.path.join(repository, x) for x in names
+                 if not x.startswith('_'))
+
+    used = set(x['kwargs'].get('base') for x in
+               _get_journal(repository).unfinished().values()
+               if x['operation'] == 'create')
+
+    for path in disks:
+        try:
+            used.add(os.path.basename(_get_image_backing(path)))
+        except (subprocess.CalledProcessError, VirtDeployException):
+            continue  # not an overlay (or not an image at all)
+
+    return [os.path.join(repository, x) for x in bases if x not in used]
+
+
+def _file_age(path):
+    try:
+        return time.time() - os.stat(path).st_mtime
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return 0
+
+
+def _release_ephemeral(conn, name):
+    path = _ephemeral_state_path(name)
+
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False  # already released
+
+    net = conn.networkLookupByName(state['network'])
+
+    with _network_lock():
+        _del_network_host(net, state['hostname'])
+        _del_network_dhcp_host(net, state['hostname'])
+
+    _remove_file(state['disk'])
+    _remove_file(path)
+
+    return True
+
+
+def _spawn_reaper(uri, name):
+    spawn_detached((sys.executable, '-m', 'virtdeploy.reaper',
+                    '--uri', uri, name))
+
+
+def _trash_file(path):
+    trash = os.path.join(os.path.dirname(path), TRASH_DIR)
+
+    try:
+        os.mkdir(trash, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # A unique name, the same disk path can be reused by a new instance
+    target = os.path.join(trash, '{0:010d}-{1}-{2}'.format(
+        int(time.time()), uuid.uuid4().hex, os.path.basename(path)))
+
+    try:
+        os.rename(path, target)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        if e.errno != errno.EXDEV:
+            raise
+        _remove_file(path)  # the trash is on another filesystem
+
+
+def _trash_age(name):
+    # The age of a trashed file from its name (and not from its mtime, kept
+    # by the move), the files of unknown names are expired.
+    try:
+        return time.time() - int(name.split('-', 1)[0])
+    except ValueError:
+        return float('inf')
+
+
+def _get_journal(repository):
+    return Journal(os.path.join(repository, JOURNAL_FILE))
+
+
+def _journal_options(kwargs):
+    # The options needed to resume a creation (the callbacks are not, the
+    # password must not be written in the pool)
+    return dict((k, v) for k, v in kwargs.items()
+                if k not in ('progress', 'cancel', 'password'))
+
+
+def _rollback_operation(journal, name, state):
+    journal.begin(name, state['operation'])
+    journal.end(name, 'rollback')
+
+
+def _rollback_create(conn, journal, name, state):
+    journal.begin(name, 'create')
+
+    # The same actions of the creation rollback. The process may have
+    # crashed after a stage and before recording it (e.g. while defining
+    # the domain), the removals are idempotent and always applied.
+    net = conn.networkLookupByName(state['kwargs']['network'])
+
+    rollback = Rollback()
+    rollback.add(journal.end, name, 'rollback')
+    rollback.add(_remove_file, state['path'])
+    rollback.add(_del_network_dhcp_host, net, state['hostname'])
+    rollback.add(_del_network_host, net, state['hostname'])
+    rollback.add(_remove_domain, conn, name)
+
+    rollback.rollback()
+
+
+def _list_directory(path):
+    try:
+        return os.listdir(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+
+
+def _get_trash_usage(repository):
+    trash = os.path.join(repository, TRASH_DIR)
+    usage = 0
+
+    for name in _list_directory(trash):
+        try:
+            usage += os.stat(os.path.join(trash, name)).st_blocks * 512
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    return usage
+
+
+def _shutdown_domain(dom):
+    try:
+        dom.shutdownFlags(
+            libvirt.VIR_DOMAIN_SHUTDOWN_GUEST_AGENT |
+            libvirt.VIR_DOMAIN_SHUTDOWN_ACPI_POWER_BTN
+        )
+    except libvirt.libvirtError as e:
+        if e.get_error_code() != libvirt.VIR_ERR_OPERATION_INVALID:
+            raise
+        return False
+
+    return True
+
+
+def _destroy_domain(dom):
+    try:
+        dom.destroy()
+    except libvirt.libvirtError as e:
+        if e.get_error_code() != libvirt.VIR_ERR_OPERATION_INVALID:
+            raise
+        return False
+
+    return True
+
+
+def _lookup_domain(conn, name):
+    try:
+        return conn.lookupByName(name)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+            raise
+        return None
+
+
+def _domain_active(dom):
+    # A transient domain doesn't exist anymore once stopped
+    try:
+        return dom.isActive()
+    except libvirt.libvirtError as e:
+        if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+            raise
+        return False
+
+
+def _undefine_flags():
+    # The managed save image and the snapshots go with the domain
+    return (libvirt.VIR_DOMAIN_UNDEFINE_MANAGED_SAVE |
+            libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA)
+
+
+def _remove_domain(conn, name):
+    try:
+        dom = conn.lookupByName(name)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+            return
+        raise
+
+    _destroy_domain(dom)
+    dom.undefineFlags(_undefine_flags())
+
+
+def _create_overlay(base, path, name, stage, options=None):
+    # The overlay is created aside and moved in place, the replacement of
+    # an existing one (reset) is atomic.
+    partial = '{0}.part'.format(path)
+    repository = os.path.dirname(path)
+
+    if options:
+        create = ('-o', ','.join('{0}={1}'.format(k, _qemu_option(v))
+                                 for k, v in sorted(options.items())))
+    else:
+        create = ()
+
+    with Rollback() as rollback:
+        rollback.add(_remove_file, partial)
+        _execute_stage(('qemu-img', 'create', '-f', 'qcow2', '-b', base,
+                        '-F', BASE_FORMAT) + create +
+                       (os.path.basename(partial),),
+                       name, 'overlay', cwd=repository, **stage)
+
+    os.rename(partial, path)
+
+
+def _customize_instance(path, fqdn, password, name, stage, copy_in=()):
+    _execute_stage(('virt-customize',
+                    '-a', path,
+                    '--hostname', fqdn,
+                    '--root-password', 'password:{0}'.format(password)) +
+                   tuple(copy_in),
+                   name, 'customize', **stage)
+
+
+def _copy_in_options(files):
+    # The files (or directories) are copied recursively in the directory
+    # of the image, created if missing.
+    for source, directory in parse_files(files):
+        yield '--mkdir'
+        yield directory
+        yield '--copy-in'
+        yield '{0}:{1}'.format(source, directory)
+
+
+def _get_image_backing(path):
+    stdout, _ = execute(('qemu-img', 'info', '--output=json', path),
+                        stdout=subprocess.PIPE)
+    backing = json.loads(stdout).get('backing-filename')
+
+    if backing is None:
+        raise VirtDeployException('No backing image for {0}'.format(path))
+
+    return backing
+
+
+def _get_source_options(template=None, arch=None):
+    # The mirror (urllib) is slow to import and most commands don't build
+    from ..mirror import Mirror
+    from ..mirror import UPSTREAM_FINGERPRINT
+
+    source = os.environ.get(MIRROR_ENV)
+
+    if source is None and template is not None:
+        mirror = Mirror()
+
+        if mirror.find(template, arch) is not None:
+            source = mirror.index_uri
+
+    if source is None:
+        return ()
+
+    # The mirrors keep the upstream index signed by the virt-builder key
+    return ('--source', source, '--fingerprint', UPSTREAM_FINGERPRINT)
+
+
+def _get_virt_templates():
+    stdout, _ = execute(('virt-builder', '-l', '--list-format', 'json') +
+                        _get_source_options(), stdout=subprocess.PIPE)
+    return json.loads(stdout)
+
+
+def _get_domain(conn, name):
+    try:
+        return conn.lookupByName(name)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+            raise InstanceNotFound(name)
+        raise
+
+
+def _get_tuning_profile(kwargs):
+    # The instance selection takes precedence over the template profile
+    name = kwargs['tuning'] or (kwargs['profile'] or {}).get('tuning')
+
+    if name is None:
+        name = 'default'
+
+    if name not in TUNING_PROFILES:
+        raise VirtDeployException('Unknown tuning profile {0}'.format(name))
+
+    tuning = dict(TUNING_PROFILES[name], name=name)
+    tuning.update((x, kwargs[x]) for x in IO_OPTIONS
+                  if kwargs.get(x) is not None)
+
+    if tuning.get('disk_bus', 'scsi') not in DISK_BUSES:
+        raise VirtDeployException(
+            'Unknown disk bus {0}'.format(tuning['disk_bus']))
+
+    # Native aio requires O_DIRECT (no host cache)
+    if tuning.get('io') == 'native' and tuning.get('cache') != 'none':
+        raise VirtDeployException('Native io requires cache none')
+
+    return tuning
+
+
+def _get_device_options(path, network, tuning, vcpus):
+    bus = tuning.get('disk_bus', 'scsi')
+    iothreads = tuning.get('iothreads')
+
+    disk = ['path={0}'.format(path), 'format=qcow2', 'bus={0}'.format(bus),
+            'discard=unmap']
+    options = []
+
+    for key in ('cache', 'io'):
+        if tuning.get(key):
+            disk.append('{0}={1}'.format(key, tuning[key]))
+
+    if tuning.get('l2_cache'):
+        disk.append('driver.metadata_cache.max_size={0}'.format(
+            tuning['l2_cache']))
+
+    if iothreads:
+        options.extend(('--iothreads', str(iothreads)))
+
+    if bus == 'scsi':
+        controller = 'scsi,model=virtio-scsi'
+
+        if iothreads:
+            controller += ',driver.iothread=1'
+
+        options.extend(('--controller', controller))
+    elif iothreads:
+        disk.append('driver.iothread=1')
+
+    queues = tuning.get('net_queues')
+
+    if queues is not None:
+        network += ',model=virtio,driver.name=vhost,driver.queues={0}'.format(
+            queues or vcpus)
+
+    options.extend(('--disk', ','.join(disk), '--network', network))
+
+    return options
+
+
+def _get_tuning_options(tuning, placement=None):
+    options = ['--cpu', tuning.get('cpu', DEFAULT_CPU_MODEL)]
+
+    if placement is not None and placement['vcpus']:
+        cputune = ['vcpupin{0}.vcpu={0},vcpupin{0}.cpuset={1}'.format(i, x)
+                   for i, x in enumerate(placement['vcpus'])]
+
+        if placement['emulator'] is not None:
+            cputune.append('emulatorpin.cpuset={0}'.format(
+                placement['emulator']))
+
+        options.extend(('--cputune', ','.join(cputune)))
+
+    if placement is not None and tuning.get('numa'):
+        options.extend(('--numatune',
+                        '{0},mode=strict'.format(placement['cell'])))
+
+    memorybacking = ['{0}=on'.format(x) for x in ('hugepages', 'locked')
+                     if tuning.get(x)]
+
+    if memorybacking:
+        options.extend(('--memorybacking', ','.join(memorybacking)))
+
+    return options
+
+
+def _parse_fio_result(out):
+    job = json.loads(out)['jobs'][0]
+    result = {}
+
+    for op in ('read', 'write'):
+        result['{0}_iops'.format(op)] = int(job[op]['iops'])
+        result['{0}_bw'.format(op)] = job[op]['bw']  # KiB/s
+        result['{0}_latency'.format(op)] = int(
+            job[op]['lat_ns']['mean'] / 1000)  # microseconds
+
+    return result
+
+
+def _get_host_topology(conn):
+    xmldesc = etree.fromstring(conn.getCapabilities())
+    cells = []
+
+    for cell in xmldesc.iterfind('./host/topology/cells/cell'):
+        cpus = [(int(x.get('socket_id', 0)), int(x.get('core_id', 0)),
+                 int(x.get('id'))) for x in cell.iterfind('./cpus/cpu')]
+        cells.append({'id': int(cell.get('id')), 'cpus': sorted(cpus)})
+
+    return cells
+
+
+def _parse_cpuset(cpuset):
+    cpus = set()
+    excluded = set()
+
+    for item in cpuset.split(','):
+        item = item.strip()
+        target = cpus
+
+        if item.startswith('^'):
+            item, target = item[1:], excluded
+
+        first, _, last = item.partition('-')
+        target.update(range(int(first), int(last or first) + 1))
+
+    return cpus - excluded
+
+
+def _get_pinned_cpus(conn):
+    pinned = set()
+
+    for dom in conn.listAllDomains(0):
+        xmldesc = etree.fromstring(dom.XMLDesc())
+
+        for pin in xmldesc.iterfind('./cputune/*[@cpuset]'):
+            pinned.update(_parse_cpuset(pin.get('cpuset')))
+
+    return pinned
+
+
+def _place_instance(cells, used, vcpus, tuning):
+    pinning = tuning.get('pinning')
+    needed = vcpus + (1 if pinning and tuning.get('emulator') else 0)
+
+    # The cell with most free cpus, it must host all the pinned ones
+    best, free = None, []
+
+    for cell in cells:
+        cellfree = [x for x in cell['cpus'] if x[2] not in used]
+
+        if best is None or len(cellfree) > len(free):
+            best, free = cell, cellfree
+
+    if best is None or (pinning and len(free) < needed):
+        raise VirtDeployException(
+            'No numa cell with {0} free cpus'.format(needed))
+
+    # Sorted by socket and core: the vcpus get sibling threads together
+    selected = [x[2] for x in free[:needed]] if pinning else []
+
+    return {
+        'cell': best['id'],
+        'vcpus': selected[:vcpus],
+        'emulator': selected[vcpus] if len(selected) > vcpus else None,
+        'pinned': set(selected),
+    }
+
+
+def _set_domain_metadata(dom, attrs, flags=None):
+    if flags is None:
+        flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+
+    instance = etree.Element('instance')
+
+    for key, value in sorted(attrs.items()):
+        instance.set(key, str(value))
+
+    dom.setMetadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+                    etree.tostring(instance).decode('utf-8'),
+                    METADATA_PREFIX, METADATA_URI, flags)
+
+
+def _get_domain_metadata(dom):
+    try:
+        metadata = dom.metadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+                                METADATA_URI)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN_METADATA:
+            return None
+        raise
+
+    return dict(etree.fromstring(metadata).attrib)
+
+
+def _get_domain_disk_path(dom):
+    xmldesc = etree.fromstring(dom.XMLDesc())
+
+    for disk in xmldesc.iterfind('./devices/disk[@device="disk"]/source'):
+        return disk.get('file')
+
+    raise VirtDeployException('No disk found for {0}'.format(dom.name()))
+
+
+def _get_domain_mac_addresses(dom):
+    return _get_xml_mac_addresses(dom.XMLDesc())
+
+
+def _get_xml_mac_addresses(xmldesc):
+    xmldesc = etree.fromstring(xmldesc)
+    netxpath = './devices/interface[@type="network"]'
+
+    for iface in xmldesc.iterfind(netxpath):
+        network = iface.find('./source').get('network')
+        mac = iface.find('./mac').get('address')
+
+        yield {'mac': mac, 'network': network}
+
+
+def _get_domain_macs_by_network(dom):
+    netmacs = {}
+
+    for x in _get_domain_mac_addresses(dom):
+        netmacs.setdefault(x['network'], []).append(x['mac'])
+
+    return netmacs
+
+
+def _get_pool_path(pool):
+    xmldesc = etree.fromstring(pool.XMLDesc())
+
+    for x in xmldesc.iterfind('.[@type="dir"]/target/path'):
+        return x.text
+
+    raise OSError(errno.ENOENT, 'Path not found for pool')
+
+
+def _get_network_domainname(net):
+    xmldesc = etree.fromstring(net.XMLDesc())
+
+    for domain in xmldesc.iterfind('./domain'):
+        return domain.get('name')
+
+
+def _get_network_fqdn(net, hostname):
+    domainname = _get_network_domainname(net)
+
+    if domainname is None:
+        return hostname
+
+    return '{0}.{1}'.format(hostname, domainname)
+
+
+def _update_network(net, command, section, xml):
+    # Both the persistent and the running network are updated
+    net.update(command, section, 0, etree.tostring(xml),
+               libvirt.VIR_NETWORK_UPDATE_AFFECT_CONFIG |
+               libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE)
+
+
+def _add_network_host(net, hostname, ipaddress):
+    xmlhost = etree.Element('host')
+    xmlhost.set('ip', ipaddress)
+    etree.SubElement(xmlhost, 'hostname').text = hostname
+
+    # Attempt to delete if present
+    _del_network_host(net, hostname)
+    _update_network(net, libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_LAST,
+                    libvirt.VIR_NETWORK_SECTION_DNS_HOST, xmlhost)
+
+
+def _del_network_host(net, hostname):
+    xmlhost = etree.Element('host')
+    etree.SubElement(xmlhost, 'hostname').text = hostname
+
+    try:
+        _update_network(net, libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
+                        libvirt.VIR_NETWORK_SECTION_DNS_HOST, xmlhost)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() != libvirt.VIR_ERR_OPERATION_INVALID:
+            raise
+
+
+def _add_network_dhcp_host(net, hostname, mac, ipaddress):
+    xmlhost = etree.Element('host')
+    xmlhost.set('mac', mac)
+    xmlhost.set('name', hostname)
+    xmlhost.set('ip', ipaddress)
+
+    # Attempt to delete if present
+    _del_network_dhcp_host(net, hostname)
+    _update_network(net, libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_LAST,
+                    libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST, xmlhost)
+
+
+def _del_network_dhcp_host(net, hostname):
+    xmlhost = etree.Element('host')
+    xmlhost.set('name', hostname)
+
+    try:
+        _update_network(net, libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
+                        libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST, xmlhost)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() != libvirt.VIR_ERR_OPERATION_INVALID:
+            raise
+
+
+def _get_network_dhcp_hosts(net):
+    xmldesc = etree.fromstring(net.XMLDesc())
+
+    for x in xmldesc.iterfind('./ip/dhcp/host'):
+        yield {'name': x.get('name'), 'mac': x.get('mac'),
+               'ip': x.get('ip')}
+
+
+def _get_network_dhcp_leases(net):
+    for x in _get_network_dhcp_hosts(net):
+        yield x
+
+    for x in net.DHCPLeases():
+        yield {'name': x['hostname'], 'mac': x['mac'],
+               'ip': x['ipaddr']}
+
+
+def _get_network_address_usage(net):
+    # The (used, total) addresses of the network, None without addresses
+    import netaddr
+
+    ip = etree.fromstring(net.XMLDesc()).find('./ip')
+
+    if ip is None or ip.get('netmask') is None:
+        return None
+
+    network = netaddr.IPNetwork('{0}/{1}'.format(ip.get('address'),
+                                                 ip.get('netmask')))
+    addresses = set(netaddr.IPAddress(x['ip'])
+                    for x in _get_network_dhcp_leases(net))
+    addresses.add(netaddr.IPAddress(ip.get('address')))
+
+    # The network and broadcast addresses are not usable
+    return (sum(1 for x in addresses
+                if network.first < x.value < network.last),
+            max(network.size - 2, 0))
+
+
+def _new_network_ipaddress(net):
+    # netaddr is slow to import and only needed to allocate new addresses
+    import netaddr
 
-def _new_network_ipaddress(net):
     xmldesc = etree.fromstring(net.XMLDesc())
 
     hosts = _get_network_dhcp_leases(net)
@@ -21,13 +21,25 @@
 from __future__ import absolute_import
 
 import errno
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import time
 import types
 import unittest
 
+from mock import ANY
 from mock import MagicMock
 from mock import patch
+from subprocess import CalledProcessError
 
+from ..errors import CommandTimeout
 from ..errors import VirtDeployException
+from ..journal import Journal
+from ..journal import NullJournal
+from ..mirror import UPSTREAM_FINGERPRINT
 
 
 class libvirtErrorMock(Exception):
@@ -47,6 +59,30 @@ class LibvirtMock(types.ModuleType, object):
     VIR_NETWORK_UPDATE_AFFECT_CONFIG = 2
     VIR_NETWORK_UPDATE_AFFECT_LIVE = 1
     VIR_ERR_OPERATION_INVALID = 55
+    VIR_ERR_AGENT_UNRESPONSIVE = 86
+    VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT = 1
+    VIR_DOMAIN_EVENT_ID_LIFECYCLE = 0
+    VIR_DOMAIN_EVENT_STOPPED = 5
+    VIR_DOMAIN_SHUTDOWN_GUEST_AGENT = 2
+    VIR_DOMAIN_SHUTDOWN_ACPI_POWER_BTN = 1
+    VIR_DOMAIN_XML_SECURE = 1
+    VIR_DOMAIN_XML_MIGRATABLE = 8
+    VIR_DOMAIN_SAVE_RUNNING = 2
+    VIR_DOMAIN_UNDEFINE_MANAGED_SAVE = 1
+    VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA = 2
+    VIR_DOMAIN_METADATA_ELEMENT = 2
+    VIR_DOMAIN_AFFECT_CONFIG = 2
+    VIR_DOMAIN_AFFECT_LIVE = 1
+    VIR_ERR_NO_DOMAIN = 42
+    VIR_ERR_NO_DOMAIN_METADATA = 80
+    VIR_DOMAIN_STATS_CPU_TOTAL = 2
+    VIR_DOMAIN_STATS_VCPU = 8
+    VIR_DOMAIN_STATS_BALLOON = 4
+    VIR_DOMAIN_STATS_INTERFACE = 16
+    VIR_DOMAIN_STATS_BLOCK = 32
+    VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE = 1
+    VIR_CONNECT_LIST_NETWORKS_ACTIVE = 2
+    VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE = 2
 
     libvirtError = libvirtErrorMock
 
@@ -59,9 +95,8 @@ def module_mock():
     global _driver
 
     if _driver is None:
-        with patch.dict('sys.modules', {'libvirt': libvirt_mock}):
-            _driver = __import__('libvirt', globals(), locals(),
-                                 ['libvirt'], 1)
+        _driver = __import__('libvirt', globals(), locals(), ['libvirt'], 1)
+        _driver.libvirt = libvirt_mock
 
     return _driver
 
@@ -83,8 +118,8 @@ class TestImageOS(unittest.TestCase):
             ('fedora-23', 'fedora23'),
         )
 
-        for image, os in image_oses:
-            self.assertEqual(os, module_mock()._get_image_os(image))
+        for image, image_os in image_oses:
+            self.assertEqual(image_os, module_mock()._get_image_os(image))
 
 
 class TestNetwork(unittest.TestCase):
@@ -426,3 +461,1790 @@ class TestVirtBuilderTemplates(unittest.TestCase):
 
             with self.assertRaises(VirtDeployException):
                 driver.template_list()
+
+    def test_source_options(self):
+        module = module_mock()
+        mirror = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, mirror)
+
+        with patch.dict(os.environ, clear=True), \
+                patch('virtdeploy.mirror.MIRROR_DIR', mirror):
+            self.assertEqual(module._get_source_options('fedora-21'), ())
+
+            with patch('virtdeploy.mirror.Mirror.find') as find_mock:
+                options = module._get_source_options('fedora-21', 'x86_64')
+
+            find_mock.assert_called_once_with('fedora-21', 'x86_64')
+            self.assertEqual(options, (
+                '--source', 'file://{0}/index'.format(mirror),
+                '--fingerprint', UPSTREAM_FINGERPRINT))
+
+            os.environ[module.MIRROR_ENV] = 'http://mirror:8100/index'
+
+            self.assertEqual(module._get_source_options(), (
+                '--source', 'http://mirror:8100/index',
+                '--fingerprint', UPSTREAM_FINGERPRINT))
+
+
+class TestCreateBase(unittest.TestCase):
+    PROFILE = {
+        'packages': ['qemu-guest-agent', 'fio'],
+        'files': ['/tmp/agent.conf:/etc/'],
+        'ssh_keys': ['ssh-rsa AAAA user@example.com'],
+    }
+
+    @patch('os.rename')
+    @patch('os.path.exists')
+    def test_create_base(self, exists_mock, rename_mock):
+        exists_mock.return_value = False
+
+        with patch.object(module_mock(), 'execute') as execute_mock:
+            name = module_mock()._create_base('fedora-21', 'x86_64', '/pool')
+
+        self.assertEqual(name, '_fedora-21-x86_64.qcow2')
+        self.assertEqual(execute_mock.call_count, 2)
+        rename_mock.assert_called_once_with(
+            '/pool/_fedora-21-x86_64.qcow2.part',
+            '/pool/_fedora-21-x86_64.qcow2')
+
+    @patch('os.rename')
+    @patch('os.path.exists')
+    def test_create_base_exists(self, exists_mock, rename_mock):
+        exists_mock.return_value = True
+
+        with patch.object(module_mock(), 'execute') as execute_mock:
+            name = module_mock()._create_base('fedora-21', 'x86_64', '/pool')
+
+        self.assertEqual(name, '_fedora-21-x86_64.qcow2')
+        self.assertFalse(execute_mock.called)
+        self.assertFalse(rename_mock.called)
+
+    @patch('os.rename')
+    @patch('os.path.exists')
+    def test_create_base_profile(self, exists_mock, rename_mock):
+        exists_mock.return_value = False
+
+        with patch.object(module_mock(), 'execute') as execute_mock:
+            with patch.object(module_mock(), 'profile_hash') as hash_mock:
+                hash_mock.return_value = '0123456789ab'
+                name = module_mock()._create_base('fedora-21', 'x86_64',
+                                                  '/pool', self.PROFILE)
+
+        self.assertEqual(name, '_fedora-21-x86_64-0123456789ab.qcow2')
+
+        builder_args = execute_mock.call_args_list[0][0][0]
+        self.assertIn('--install', builder_args)
+        self.assertIn('qemu-guest-agent,fio', builder_args)
+        self.assertIn('/tmp/agent.conf:/etc/', builder_args)
+
+        sysprep_args = execute_mock.call_args_list[1][0][0]
+        self.assertIn('defaults,-ssh-userdir', sysprep_args)
+
+    def test_profile_options(self):
+        options = module_mock()._get_profile_options({
+            'update': True,
+            'scripts': ['/tmp/setup.sh'],
+            'commands': ['systemctl enable qemu-guest-agent'],
+            'ssh_keys': ['ssh-rsa AAAA user@example.com'],
+        })
+
+        self.assertEqual(options, (
+            '--update',
+            '--run', '/tmp/setup.sh',
+            '--run-command', 'systemctl enable qemu-guest-agent',
+            '--ssh-inject', 'root:string:ssh-rsa AAAA user@example.com',
+            '--selinux-relabel',
+        ))
+
+    def test_profile_options_empty(self):
+        self.assertEqual(module_mock()._get_profile_options(None), ())
+
+
+class TestOverlay(unittest.TestCase):
+    def test_overlay_options_filesystem(self):
+        with patch.object(module_mock(), 'filesystem_type',
+                          return_value='xfs'):
+            options = module_mock()._get_overlay_options(
+                '/pool', {'cluster_size': '64k'})
+
+        self.assertEqual(options['cluster_size'], '64k')
+        self.assertEqual(options['preallocation'], 'metadata')
+
+    def test_overlay_options_default(self):
+        with patch.object(module_mock(), 'filesystem_type',
+                          return_value='nfs'):
+            self.assertEqual(module_mock()._get_overlay_options('/pool'),
+                             module_mock().OVERLAY_DEFAULTS)
+
+    def test_overlay_options_invalid(self):
+        with patch.object(module_mock(), 'filesystem_type',
+                          return_value=None):
+            for options in ({'size': '1G'}, {'preallocation': 'falloc'}):
+                with self.assertRaises(VirtDeployException):
+                    module_mock()._get_overlay_options('/pool', options)
+
+    @patch('os.rename')
+    def test_create_overlay(self, rename_mock):
+        with patch.object(module_mock(), 'execute') as execute_mock:
+            module_mock()._create_overlay(
+                '_base.qcow2', '/pool/test01.qcow2', 'test01',
+                module_mock()._stage_options({}),
+                {'extended_l2': True, 'preallocation': 'metadata'})
+
+        self.assertEqual(execute_mock.call_args[0][0], (
+            'qemu-img', 'create', '-f', 'qcow2', '-b', '_base.qcow2',
+            '-F', 'qcow2', '-o', 'extended_l2=on,preallocation=metadata',
+            'test01.qcow2.part'))
+
+    @patch('os.rename')
+    def test_shrink_base(self, rename_mock):
+        with patch.object(module_mock(), 'execute') as execute_mock:
+            module_mock()._shrink_base('_base.qcow2', '/pool/_base.part',
+                                       True, True,
+                                       module_mock()._stage_options({}))
+
+        commands = [x[0][0][:2] for x in execute_mock.call_args_list]
+
+        self.assertEqual(commands, [('virt-sparsify', '--in-place'),
+                                    ('qemu-img', 'convert')])
+        rename_mock.assert_called_once_with(
+            '/pool/_base.part.compressed', '/pool/_base.part')
+
+
+class TestTrash(unittest.TestCase):
+    POOL_XML = """
+        <pool type="dir">
+          <name>default</name>
+          <target><path>{0}</path></target>
+        </pool>
+    """
+
+    def setUp(self):
+        self.repository = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.repository)
+
+        self.pool = MagicMock()
+        self.pool.name.return_value = 'default'
+        self.pool.XMLDesc.return_value = self.POOL_XML.format(
+            self.repository)
+        self.pool.info.return_value = [2, 1000, 400, 600]
+
+        self.driver = module_mock().VirtDeployLibvirtDriver()
+        patcher = patch.object(self.driver, '_libvirt_open')
+        conn = patcher.start()
+        conn.return_value.storagePoolLookupByName.return_value = self.pool
+        self.addCleanup(patcher.stop)
+
+        patcher = patch.object(module_mock(), 'EPHEMERAL_STATE_DIR',
+                               os.path.join(self.repository, 'state'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # The network lock of the host is not shared with the tests
+        lockdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lockdir)
+
+        patcher = patch.object(module_mock(), 'NETWORK_LOCK_FILE',
+                               os.path.join(lockdir, 'network.lock'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _disk(self, name, size=8192):
+        path = os.path.join(self.repository, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def test_trash_file(self):
+        path = self._disk('test01.qcow2')
+
+        module_mock()._trash_file(path)
+        module_mock()._trash_file(path)  # already removed
+
+        self.assertFalse(os.path.exists(path))
+        trash = os.listdir(os.path.join(self.repository, '.trash'))
+        self.assertEqual(len(trash), 1)
+        self.assertTrue(trash[0].endswith('-test01.qcow2'))
+        self.assertLess(module_mock()._trash_age(trash[0]), 60)
+
+    def test_pool_info_gc(self):
+        module_mock()._trash_file(self._disk('test01.qcow2'))
+        module_mock()._trash_file(self._disk('test02.qcow2'))
+
+        info = self.driver.pool_info()
+        self.assertEqual(info['available'], 600)
+        self.assertGreaterEqual(info['trash'], 16384)
+
+        result = self.driver.pool_gc()
+        self.assertEqual(result['files'], 2)
+        self.assertEqual(result['bytes'], info['trash'])
+
+        self.assertEqual(self.driver.pool_info()['trash'], 0)
+
+    def test_pool_gc_age(self):
+        trash = os.path.join(self.repository, '.trash')
+        os.mkdir(trash)
+
+        for name in ('{0:010d}-{1}-test01.qcow2'.format(
+                int(time.time()) - 7200, 'a' * 32),
+                '{0:010d}-{1}-test02.qcow2'.format(int(time.time()),
+                                                   'b' * 32)):
+            with open(os.path.join(trash, name), 'wb') as f:
+                f.write(b'x' * 8192)
+
+        # The age comes from the trash name, the mtime is recent
+        result = self.driver.pool_gc(age=3600)
+
+        self.assertEqual(result['files'], 1)
+        self.assertEqual([x.rsplit('-', 1)[1] for x in os.listdir(trash)],
+                         ['test02.qcow2'])
+
+    def test_pool_gc_empty(self):
+        self.assertEqual(self.driver.pool_gc(),
+                         {'files': 0, 'bytes': 0, 'ephemeral': 0,
+                          'bases': 0})
+
+    def test_pool_gc_clone_bases(self):
+        old = time.time() - 2 * module_mock().RECONCILE_GRACE
+
+        for name in ('_clone-test01-20150101000000-aaaaaaaa.qcow2',
+                     '_clone-test01-20150101000000-bbbbbbbb.qcow2',
+                     '_clone-test01-20150101000000-cccccccc.qcow2.part',
+                     '_fedora-21-x86_64.qcow2'):
+            os.utime(self._disk(name), (old, old))
+
+        self._disk('_clone-test02-20150101000000-dddddddd.qcow2')  # recent
+        self._disk('test01-1.qcow2')
+
+        def backing(path):
+            if os.path.basename(path) != 'test01-1.qcow2':
+                raise module_mock().VirtDeployException('No backing image')
+            return os.path.join(self.repository, '_clone-test01-'
+                                '20150101000000-aaaaaaaa.qcow2')
+
+        with patch.object(module_mock(), '_get_image_backing',
+                          side_effect=backing):
+            result = self.driver.pool_gc(age=3600)
+
+        self.assertEqual(result['bases'], 2)
+        self.assertEqual(result['files'], 0)  # trashed just now
+        self.assertEqual(
+            sorted(x for x in os.listdir(self.repository)
+                   if x.startswith('_')),
+            ['_clone-test01-20150101000000-aaaaaaaa.qcow2',
+             '_clone-test02-20150101000000-dddddddd.qcow2',
+             '_fedora-21-x86_64.qcow2'])
+
+    def test_pool_gc_clone_base_creating(self):
+        old = time.time() - 2 * module_mock().RECONCILE_GRACE
+        name = '_clone-test01-20150101000000-aaaaaaaa.qcow2'
+        os.utime(self._disk(name), (old, old))
+
+        # A creation running before its overlay still needs the base
+        journal = module_mock()._get_journal(self.repository)
+        journal.begin('test01-1', 'create', vmid='test01-1',
+                      hostname='vm-test01-1', kwargs={'base': name})
+
+        self.assertEqual(self.driver.pool_gc()['bases'], 0)
+        self.assertTrue(os.path.exists(os.path.join(self.repository, name)))
+
+        journal.end('test01-1')
+        self.assertEqual(self.driver.pool_gc()['bases'], 1)
+
+
+class TestEphemeral(unittest.TestCase):
+    DOMAIN_XML = """
+        <domain>
+          <name>test01-fedora-21-x86_64</name>
+          <devices>
+            <interface type="network">
+              <mac address="52:54:00:00:00:01"/>
+              <source network="default"/>
+            </interface>
+          </devices>
+        </domain>
+    """
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.scratch)
+
+        patcher = patch.object(module_mock(), 'EPHEMERAL_STATE_DIR',
+                               os.path.join(self.scratch, 'state'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # The network lock of the host is not shared with the tests
+        lockdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lockdir)
+
+        patcher = patch.object(module_mock(), 'NETWORK_LOCK_FILE',
+                               os.path.join(lockdir, 'network.lock'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.conn = MagicMock()
+        self.net = self.conn.networkLookupByName.return_value
+        self.driver = module_mock().VirtDeployLibvirtDriver()
+
+        patcher = patch.object(self.driver, '_libvirt_open',
+                               return_value=self.conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _state(self, name='test01-fedora-21-x86_64'):
+        disk = os.path.join(self.scratch, '{0}.qcow2'.format(name))
+
+        with open(disk, 'wb') as f:
+            f.write(b'x')
+
+        module_mock()._save_ephemeral_state({'name': name,
+                                             'network': 'default',
+                                             'hostname': 'vm-test01',
+                                             'disk': disk})
+        return disk
+
+    def _execute(self, args, **kwargs):
+        if args[0] == 'virt-install':
+            self.assertIn('--print-xml', args)
+            return self.DOMAIN_XML.encode('utf-8'), None
+        return None, None
+
+    def test_instance_create(self):
+        with patch.multiple(module_mock(),
+                            execute=MagicMock(side_effect=self._execute),
+                            _get_pool_path=MagicMock(return_value='/pool'),
+                            _create_base=MagicMock(return_value='_b.qcow2'),
+                            _create_overlay=MagicMock(),
+                            _customize_instance=MagicMock(),
+                            _get_image_os=MagicMock(return_value='fedora21'),
+                            _get_network_domainname=MagicMock(),
+                            _new_network_ipaddress=MagicMock(
+                                return_value='192.168.122.2'),
+                            _add_network_host=MagicMock(),
+                            _add_network_dhcp_host=MagicMock(),
+                            _spawn_reaper=MagicMock()):
+            scratch = os.path.join(self.scratch, 'disks')
+            instance = self.driver.instance_create(
+                'test01', 'fedora-21', ephemeral=True, scratch=scratch,
+                labels={'env': 'test', 'template': 'other'})
+
+            path = os.path.join(scratch, 'test01-fedora-21-x86_64.qcow2')
+            module_mock()._create_overlay.assert_called_once_with(
+                '/pool/_b.qcow2', path, 'test01-fedora-21-x86_64', ANY, ANY)
+            module_mock()._spawn_reaper.assert_called_once_with(
+                'qemu:///system', 'test01-fedora-21-x86_64')
+
+        self.assertEqual(instance['mac'], '52:54:00:00:00:01')
+        self.conn.createXML.assert_called_once_with(self.DOMAIN_XML, 0)
+        self.assertFalse(self.conn.lookupByName.called)
+
+        # The labels are recorded but can't override the template
+        metadata = self.conn.createXML.return_value.setMetadata.call_args[0]
+        self.assertIn('env="test"', metadata[1])
+        self.assertIn('template="fedora-21"', metadata[1])
+
+        with open(module_mock()._ephemeral_state_path(
+                'test01-fedora-21-x86_64')) as f:
+            self.assertEqual(json.load(f)['disk'], path)
+
+        # Only qemu needs to reach the disks
+        self.assertEqual(os.stat(scratch).st_mode & 0o777, 0o711)
+        self.assertEqual(os.stat(module_mock().EPHEMERAL_STATE_DIR).st_mode &
+                         0o777, 0o700)
+
+    def test_network_lock(self):
+        # Held against the other processes (open files) of the host
+        with module_mock()._network_lock():
+            with open(module_mock().NETWORK_LOCK_FILE) as f:
+                with self.assertRaises(IOError):
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        with open(module_mock().NETWORK_LOCK_FILE) as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_release_ephemeral(self):
+        disk = self._state()
+
+        self.assertTrue(module_mock()._release_ephemeral(
+            self.conn, 'test01-fedora-21-x86_64'))
+        self.assertFalse(module_mock()._release_ephemeral(
+            self.conn, 'test01-fedora-21-x86_64'))
+
+        self.assertFalse(os.path.exists(disk))
+        self.assertEqual(os.listdir(module_mock().EPHEMERAL_STATE_DIR), [])
+        self.conn.networkLookupByName.assert_called_once_with('default')
+        self.assertEqual(self.net.update.call_count, 2)
+
+    def test_instance_reap(self):
+        disk = self._state()
+        dom = self.conn.lookupByName.return_value
+        dom.isActive.side_effect = [True, libvirtErrorMock(42)]
+
+        with patch.object(module_mock(), 'EVENT_RECHECK_INTERVAL', 0.01):
+            self.assertTrue(
+                self.driver.instance_reap('test01-fedora-21-x86_64'))
+
+        self.assertFalse(os.path.exists(disk))
+        self.conn.domainEventDeregisterAny.assert_called_once_with(ANY)
+
+    def test_instance_delete(self):
+        disk = self._state()
+        dom = self.conn.lookupByName.return_value
+        dom.isPersistent.return_value = False
+
+        self.driver.instance_delete('test01-fedora-21-x86_64')
+
+        dom.destroy.assert_called_once_with()
+        self.assertFalse(dom.undefineFlags.called)
+        self.assertFalse(os.path.exists(disk))
+
+    def test_instance_reset(self):
+        self.conn.lookupByName.return_value.isPersistent.return_value = False
+
+        with self.assertRaises(VirtDeployException):
+            self.driver.instance_reset('test01-fedora-21-x86_64')
+
+    def test_pool_gc(self):
+        self._state('test01-fedora-21-x86_64')
+        self._state('test02-fedora-21-x86_64')
+        self._state('test03-fedora-21-x86_64')
+
+        # Instances still being created have a recent state
+        for name in ('test01-fedora-21-x86_64', 'test02-fedora-21-x86_64'):
+            os.utime(module_mock()._ephemeral_state_path(name), (0, 0))
+
+        def lookup(name):
+            if not name.startswith('test02'):
+                raise libvirtErrorMock(42)
+            return MagicMock()
+
+        pool = self.conn.storagePoolLookupByName.return_value
+        pool.XMLDesc.return_value = TestTrash.POOL_XML.format(self.scratch)
+        self.conn.lookupByName.side_effect = lookup
+
+        self.assertEqual(self.driver.pool_gc()['ephemeral'], 1)
+        self.assertEqual(sorted(os.listdir(module_mock().EPHEMERAL_STATE_DIR)),
+                         ['test02-fedora-21-x86_64.json',
+                          'test03-fedora-21-x86_64.json'])
+
+
+class TestMetrics(unittest.TestCase):
+    NETWORK_XML = """
+        <network>
+          <ip address="192.168.122.1" netmask="255.255.255.248">
+            <dhcp>
+              <host mac="52:54:00:a0:b0:01" name="vm-test01"
+                    ip="192.168.122.2"/>
+            </dhcp>
+          </ip>
+        </network>
+    """
+
+    def setUp(self):
+        self.repository = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.repository)
+
+        for name in ('_fedora-21-x86_64.qcow2', '_fedora-21-x86_64.qcow2.part',
+                     '_fedora-21-x86_64-booted.qcow2', 'test01.qcow2'):
+            open(os.path.join(self.repository, name), 'w').close()
+
+        net = MagicMock()
+        net.name.return_value = 'default'
+        net.XMLDesc.return_value = self.NETWORK_XML
+        net.DHCPLeases.return_value = [
+            {'hostname': 'vm-test02', 'mac': '52:54:00:a0:b0:02',
+             'ipaddr': '192.168.122.3'}]
+
+        bridge = MagicMock()
+        bridge.XMLDesc.return_value = '<network><bridge name="br0"/></network>'
+
+        pool = MagicMock()
+        pool.name.return_value = 'default'
+        pool.info.return_value = [2, 1000, 400, 600]
+        pool.XMLDesc.return_value = TestTrash.POOL_XML.format(self.repository)
+
+        self.conn = MagicMock()
+        self.conn.listAllNetworks.return_value = [net, bridge]
+        self.conn.listAllStoragePools.return_value = [pool]
+
+        self.driver = module_mock().VirtDeployLibvirtDriver()
+        patcher = patch.object(self.driver, '_libvirt_open',
+                               return_value=self.conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_metrics_collect(self):
+        lines = self.driver.metrics_collect().splitlines()
+
+        for line in ('virtdeploy_network_addresses{network="default"} 6',
+                     'virtdeploy_network_addresses_used{network="default"} 3',
+                     'virtdeploy_pool_capacity_bytes{pool="default"} 1000',
+                     'virtdeploy_pool_available_bytes{pool="default"} 600',
+                     'virtdeploy_pool_base_images{pool="default"} 1',
+                     'virtdeploy_pool_snapshots{pool="default"} 1',
+                     'virtdeploy_pool_trash_bytes{pool="default"} 0'):
+            self.assertIn(line, lines)
+
+    def test_metrics_collect_iscsi(self):
+        iscsi = MagicMock()
+        iscsi.name.return_value = 'iscsi'
+        iscsi.info.return_value = [2, 1000, 0, 1000]
+        iscsi.XMLDesc.return_value = TestStorage.POOLXML_PATH_ISCSI
+        self.conn.listAllStoragePools.return_value.append(iscsi)
+
+        lines = self.driver.metrics_collect().splitlines()
+
+        self.assertIn('virtdeploy_pool_capacity_bytes{pool="iscsi"} 1000',
+                      lines)
+        self.assertNotIn('virtdeploy_pool_base_images{pool="iscsi"} 0',
+                         lines)
+
+    def test_operations(self):
+        operations = module_mock().OPERATIONS
+        dom = self.conn.lookupByName.return_value
+
+        success = operations.value(operation='instance_start',
+                                   result='success') or 0
+        self.driver.instance_start('test01')
+
+        dom.create.side_effect = libvirtErrorMock(1)
+        failure = operations.value(operation='instance_start',
+                                   result='failure') or 0
+
+        with self.assertRaises(libvirtErrorMock):
+            self.driver.instance_start('test01')
+
+        self.assertEqual(operations.value(operation='instance_start',
+                                          result='success'), success + 1)
+        self.assertEqual(operations.value(operation='instance_start',
+                                          result='failure'), failure + 1)
+
+    def test_stage_failures(self):
+        failures = module_mock().STAGE_FAILURES
+        before = failures.value(stage='customize') or 0
+
+        with patch.object(module_mock(), 'execute',
+                          side_effect=CalledProcessError(1, 'x')):
+            with self.assertRaises(CalledProcessError):
+                module_mock()._execute_stage(('virt-customize',), 'test01',
+                                             'customize')
+
+        self.assertEqual(failures.value(stage='customize'), before + 1)
+
+
+class TestFsck(unittest.TestCase):
+    NETWORK_XML = """
+        <network>
+          <name>default</name>
+          <dns>
+            <host ip="192.168.122.2"><hostname>vm-test01</hostname></host>
+            <host ip="192.168.122.3"><hostname>vm-test02</hostname></host>
+            <host ip="192.168.122.9"><hostname>router</hostname></host>
+          </dns>
+          <ip address="192.168.122.1" netmask="255.255.255.0">
+            <dhcp>
+              <host mac="52:54:00:00:00:01" name="vm-test01"
+                    ip="192.168.122.2"/>
+              <host mac="52:54:00:00:00:02" name="vm-test02"
+                    ip="192.168.122.3"/>
+              <host mac="52:54:00:00:00:03" name="vm-test03"
+                    ip="192.168.122.4"/>
+              <host mac="52:54:00:00:00:09" name="router"
+                    ip="192.168.122.9"/>
+            </dhcp>
+          </ip>
+        </network>
+    """
+
+    DOMAIN_XML = """
+        <domain>
+          <devices>
+            <disk type="file" device="disk">
+              <source file="{0}"/>
+            </disk>
+            <interface type="network">
+              <mac address="{1}"/>
+              <source network="default"/>
+            </interface>
+          </devices>
+        </domain>
+    """
+
+    def setUp(self):
+        self.repository = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.repository)
+
+        patcher = patch.object(module_mock(), 'EPHEMERAL_STATE_DIR',
+                               os.path.join(self.repository, 'state'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # The network lock of the host is not shared with the tests
+        lockdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lockdir)
+
+        patcher = patch.object(module_mock(), 'NETWORK_LOCK_FILE',
+                               os.path.join(lockdir, 'network.lock'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # test01 is fine, test02 lost its disk, test03 lost its domain
+        self.doms = [
+            self._domain('test01', '52:54:00:00:00:01', True),
+            self._domain('test02', '52:54:00:00:00:02', False),
+        ]
+
+        for name in ('test01.qcow2', 'test03.qcow2', 'test04.qcow2.part',
+                     'test05.qcow2', 'other.qcow2', '_base.qcow2'):
+            path = os.path.join(self.repository, name)
+            open(path, 'w').close()
+            os.utime(path, (0, 0))
+
+        open(os.path.join(self.repository, 'test06.qcow2'), 'w').close()
+
+        self.net = MagicMock()
+        self.net.name.return_value = 'default'
+        self.net.XMLDesc.return_value = self.NETWORK_XML
+
+        pool = MagicMock()
+        pool.XMLDesc.return_value = TestTrash.POOL_XML.format(self.repository)
+
+        self.conn = MagicMock()
+        self.conn.listAllDomains.return_value = self.doms
+        self.conn.listAllNetworks.return_value = [self.net]
+        self.conn.storagePoolLookupByName.return_value = pool
+
+        self.driver = module_mock().VirtDeployLibvirtDriver()
+        patcher = patch.object(self.driver, '_libvirt_open',
+                               return_value=self.conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _domain(self, name, mac, exists):
+        dom = MagicMock()
+        dom.name.return_value = '{0}-fedora-21-x86_64'.format(name)
+        dom.isActive.return_value = False
+        dom.metadata.return_value = '<instance template="fedora-21"/>'
+        dom.XMLDesc.return_value = self.DOMAIN_XML.format(
+            os.path.join(self.repository, '{0}.qcow2'.format(
+                name if exists else name + '-missing')), mac)
+        return dom
+
+    def _backing(self, path):
+        if os.path.basename(path).startswith('other'):
+            raise VirtDeployException('No backing image')
+        return '_base.qcow2'
+
+    def _fsck(self, repair):
+        with patch.object(module_mock(), '_get_image_backing',
+                          side_effect=self._backing):
+            return self.driver.pool_fsck(repair=repair)
+
+    def test_fsck(self):
+        result = self._fsck(False)
+
+        self.assertEqual(result['domains'], ['test02-fedora-21-x86_64'])
+        self.assertEqual(result['hosts'], [{
+            'network': 'default', 'name': 'vm-test03',
+            'mac': '52:54:00:00:00:03', 'ip': '192.168.122.4'}])
+        self.assertEqual(result['dns'], [])
+        self.assertEqual(result['images'], [
+            os.path.join(self.repository, x) for x in
+            ('test03.qcow2', 'test04.qcow2.part', 'test05.qcow2')])
+
+        self.assertFalse(self.net.update.called)
+        self.assertFalse(self.doms[1].undefineFlags.called)
+
+    def test_fsck_ephemeral(self):
+        module_mock()._save_ephemeral_state({
+            'name': 'test03-fedora-21-x86_64', 'network': 'default',
+            'hostname': 'vm-test03', 'disk': '/dev/shm/test03.qcow2'})
+
+        self.assertEqual(self._fsck(False)['hosts'], [])
+
+    def test_fsck_repair(self):
+        self.net.XMLDesc.return_value = self.NETWORK_XML.replace(
+            'name="vm-test02"', 'name="vm-test02x"')
+
+        result = self._fsck(True)
+
+        # The dns host doesn't match the (renamed) dhcp host anymore
+        self.assertEqual([x['name'] for x in result['hosts']], ['vm-test03'])
+        self.assertEqual(result['dns'], [{'network': 'default',
+                                          'name': 'vm-test02'}])
+        self.assertEqual(self.net.update.call_count, 2)
+        self.doms[1].undefineFlags.assert_called_once_with(
+            module_mock()._undefine_flags())
+
+        self.assertEqual(sorted(os.listdir(self.repository)), [
+            '.trash', '_base.qcow2', 'other.qcow2', 'test01.qcow2',
+            'test06.qcow2'])
+
+
+class TestStageCallback(unittest.TestCase):
+    def test_stage_callback(self):
+        events = []
+        callback = module_mock()._stage_callback(events.append, 'test01',
+                                                 'customize')
+
+        callback('[   1.0] Examining the guest ...')
+        callback('some other output')
+
+        self.assertEqual(events, [{
+            'elapsed': 1.0,
+            'message': 'Examining the guest ...',
+            'instance': 'test01',
+            'stage': 'customize',
+        }])
+
+    def test_stage_callback_none(self):
+        callback = module_mock()._stage_callback(None, 'test01', 'x')
+        self.assertIsNotNone(callback)
+        callback('[   1.0] Examining the guest ...')
+
+
+class TestInstanceCreate(unittest.TestCase):
+    def _execute(self, args, **kwargs):
+        if args[0] == self.failing:
+            raise CalledProcessError(1, args)
+        return None, None
+
+    @patch('os.rename')
+    @patch('os.path.exists')
+    def test_instance_create_rollback(self, exists_mock, rename_mock):
+        exists_mock.return_value = False
+        self.failing = 'virt-install'
+
+        driver = module_mock().VirtDeployLibvirtDriver()
+        conn = MagicMock()
+        conn.lookupByName.side_effect = libvirtErrorMock(
+            libvirt_mock.VIR_ERR_NO_DOMAIN)
+
+        with patch.multiple(module_mock(),
+                            execute=MagicMock(side_effect=self._execute),
+                            _get_pool_path=MagicMock(return_value='/pool'),
+                            _create_base=MagicMock(return_value='_b.qcow2'),
+                            _get_network_domainname=MagicMock(),
+                            _remove_file=MagicMock(),
+                            _remove_domain=MagicMock(),
+                            _get_journal=MagicMock(
+                                return_value=NullJournal())):
+            with patch.object(driver, '_libvirt_open', return_value=conn):
+                with self.assertRaises(CalledProcessError):
+                    driver.instance_create('test01', 'fedora-21')
+
+            module_mock()._remove_domain.assert_called_once_with(
+                conn, 'test01-fedora-21-x86_64')
+            module_mock()._remove_file.assert_called_once_with(
+                '/pool/test01-fedora-21-x86_64.qcow2')
+
+    @patch('os.path.exists', return_value=False)
+    def test_instance_create_domain_exists(self, exists_mock):
+        driver = module_mock().VirtDeployLibvirtDriver()
+        conn = MagicMock()
+
+        with patch.multiple(module_mock(),
+                            execute=MagicMock(),
+                            _get_pool_path=MagicMock(return_value='/pool'),
+                            _remove_domain=MagicMock(),
+                            _get_journal=MagicMock(
+                                return_value=NullJournal())):
+            with patch.object(driver, '_libvirt_open', return_value=conn):
+                with self.assertRaises(VirtDeployException):
+                    driver.instance_create('test01', 'fedora-21')
+
+            # Nothing else ran, the domain is left alone
+            self.assertFalse(module_mock().execute.called)
+            self.assertFalse(module_mock()._remove_domain.called)
+
+    def test_stage_timeouts(self):
+        options = module_mock()._stage_options({'timeouts': {'build': 1}})
+
+        self.assertEqual(options['timeouts']['build'], 1)
+        self.assertEqual(options['timeouts']['install'],
+                         module_mock().STAGE_TIMEOUTS['install'])
+
+
+class TestInstanceReset(unittest.TestCase):
+    DOMAIN_XML = """
+        <domain>
+          <name>test01-fedora-21-x86_64</name>
+          <devices>
+            <disk type="file" device="cdrom"/>
+            <disk type="file" device="disk">
+              <source file="/pool/test01-fedora-21-x86_64.qcow2"/>
+            </disk>
+            <interface type="network">
+              <mac address="52:54:00:a0:b0:01"/>
+              <source network="default"/>
+            </interface>
+          </devices>
+        </domain>
+    """
+
+    NETWORK_XML = """
+        <network>
+          <domain name="example.com"/>
+          <ip address="192.168.122.1" netmask="255.255.255.0">
+            <dhcp>
+              <host mac="52:54:00:a0:b0:01" name="vm-test01"
+                    ip="192.168.122.2"/>
+            </dhcp>
+          </ip>
+        </network>
+    """
+
+    def setUp(self):
+        self.driver = module_mock().VirtDeployLibvirtDriver()
+
+        self.dom = MagicMock()
+        self.dom.name.return_value = 'test01-fedora-21-x86_64'
+        self.dom.XMLDesc.return_value = self.DOMAIN_XML
+        self.dom.hasManagedSaveImage.return_value = False
+
+        self.net = MagicMock()
+        self.net.XMLDesc.return_value = self.NETWORK_XML
+
+        self.conn = MagicMock()
+        self.conn.lookupByName.return_value = self.dom
+        self.conn.networkLookupByName.return_value = self.net
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.journal = Journal(os.path.join(tmpdir, 'journal'))
+
+        patcher = patch.object(module_mock(), '_get_journal',
+                               return_value=self.journal)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _reset(self, active):
+        self.dom.destroy.side_effect = None if active else libvirtErrorMock(
+            libvirt_mock.VIR_ERR_OPERATION_INVALID)
+
+        execute_mock = MagicMock(return_value=(
+            '{"backing-filename": "_fedora-21-x86_64.qcow2"}', None))
+
+        with patch.object(module_mock(), 'execute', execute_mock):
+            with patch.object(self.driver, '_libvirt_open',
+                              return_value=self.conn):
+                with patch('os.rename') as rename_mock:
+                    result = self.driver.instance_reset(
+                        'test01-fedora-21-x86_64', password='secret')
+
+        rename_mock.assert_any_call(
+            '/pool/test01-fedora-21-x86_64.qcow2.part',
+            '/pool/test01-fedora-21-x86_64.qcow2')
+
+        commands = [x[0][0] for x in execute_mock.call_args_list]
+
+        self.assertEqual(commands[1][:6], (
+            'qemu-img', 'create', '-f', 'qcow2',
+            '-b', '_fedora-21-x86_64.qcow2'))
+        self.assertEqual(commands[2], (
+            'virt-customize', '-a', '/pool/test01-fedora-21-x86_64.qcow2',
+            '--hostname', 'vm-test01.example.com',
+            '--root-password', 'password:secret'))
+
+        return result
+
+    def test_instance_reset(self):
+        result = self._reset(active=True)
+
+        self.assertEqual(result, {
+            'name': 'test01-fedora-21-x86_64',
+            'password': 'secret',
+            'mac': '52:54:00:a0:b0:01',
+            'hostname': 'vm-test01.example.com',
+            'ipaddress': '192.168.122.2',
+        })
+        self.dom.create.assert_called_once_with()
+        self.assertFalse(self.net.update.called)
+        self.assertFalse(self.dom.undefine.called)
+
+    def test_instance_reset_stopped(self):
+        self._reset(active=False)
+        self.assertFalse(self.dom.create.called)
+
+    def test_instance_reset_suspended(self):
+        self.dom.hasManagedSaveImage.return_value = True
+
+        self._reset(active=False)
+
+        self.dom.managedSaveRemove.assert_called_once_with(0)
+        self.dom.create.assert_called_once_with()
+
+    def test_instance_copy_in(self):
+        self.dom.isActive.return_value = False
+
+        with patch.object(module_mock(), 'execute') as execute_mock:
+            with patch.object(self.driver, '_libvirt_open',
+                              return_value=self.conn):
+                self.driver.instance_copy_in('test01-fedora-21-x86_64',
+                                             ['/srv/rpms:/opt/rpms'])
+
+                self.dom.hasManagedSaveImage.return_value = True
+
+                with self.assertRaises(VirtDeployException):
+                    self.driver.instance_copy_in('test01-fedora-21-x86_64',
+                                                 ['/srv/rpms:/opt/rpms'])
+
+        execute_mock.assert_called_once_with(
+            ('virt-customize', '-a', '/pool/test01-fedora-21-x86_64.qcow2',
+             '--mkdir', '/opt/rpms', '--copy-in', '/srv/rpms:/opt/rpms'),
+            cwd=None, callback=ANY, timeout=ANY, cancel=None)
+
+    def test_copy_in_options_invalid(self):
+        for files in (['/srv/rpms'], ['/srv/rpms:'], [':/opt']):
+            with self.assertRaises(VirtDeployException):
+                list(module_mock()._copy_in_options(files))
+
+    def _interrupt(self, name, operation, **stages):
+        # An operation left pending (not running anymore)
+        self.journal.begin(name, operation)
+
+        for stage, data in sorted(stages.items()):
+            self.journal.record(name, stage, **data)
+
+        self.journal.release(name)
+
+    def test_instance_reset_resumed(self):
+        self._interrupt('test01-fedora-21-x86_64', 'reset',
+                        overlay={}, stop={'active': True})
+        self.dom.destroy.side_effect = libvirtErrorMock(
+            libvirt_mock.VIR_ERR_OPERATION_INVALID)
+
+        with patch.object(module_mock(), 'execute') as execute_mock:
+            with patch.object(self.driver, '_libvirt_open',
+                              return_value=self.conn):
+                self.driver.instance_reset('test01-fedora-21-x86_64')
+
+        # The overlay is not created again and the instance is restarted
+        self.assertEqual(execute_mock.call_count, 1)
+        self.assertEqual(execute_mock.call_args[0][0][0], 'virt-customize')
+        self.dom.create.assert_called_once_with()
+        self.assertEqual(self.journal.pending(), {})
+
+    def test_instance_reset_interrupted(self):
+        execute_mock = MagicMock(side_effect=[
+            ('{"backing-filename": "_fedora-21-x86_64.qcow2"}', None),
+            (None, None), CalledProcessError(1, 'virt-customize')])
+
+        with patch.object(module_mock(), 'execute', execute_mock):
+            with patch.object(self.driver, '_libvirt_open',
+                              return_value=self.conn):
+                with patch('os.rename'):
+                    with self.assertRaises(CalledProcessError):
+                        self.driver.instance_reset('test01-fedora-21-x86_64')
+
+        # Left pending for a later run, that skips the overlay
+        self.assertEqual(
+            self.journal.pending()['test01-fedora-21-x86_64']['stages'],
+            ['stop', 'overlay'])
+
+    def test_journal_recover(self):
+        self._interrupt('test01-fedora-21-x86_64', 'reset')
+        self._interrupt('test02-fedora-21-x86_64', 'reset')
+
+        with patch.object(self.driver, '_libvirt_open',
+                          return_value=self.conn):
+            with patch.multiple(module_mock(),
+                                _get_pool_path=MagicMock(),
+                                _lookup_domain=MagicMock(
+                                    side_effect=[self.dom, None])):
+                with patch.object(self.driver, 'instance_reset') as reset:
+                    result = self.driver.journal_recover()
+
+        reset.assert_called_once_with('test01-fedora-21-x86_64')
+        self.assertEqual(result['rolledback'], ['test02-fedora-21-x86_64'])
+        self.assertEqual(list(self.journal.pending()),
+                         ['test01-fedora-21-x86_64'])
+
+    def test_journal_recover_create(self):
+        self.journal.begin('test01-fedora-21-x86_64', 'create', vmid='test01',
+                           template='fedora-21', hostname='vm-test01',
+                           path='/pool/test01-fedora-21-x86_64.qcow2',
+                           kwargs={'network': 'default', 'cpus': 4})
+        self.journal.release('test01-fedora-21-x86_64')
+
+        with patch.object(self.driver, '_libvirt_open',
+                          return_value=self.conn):
+            with patch.object(module_mock(), '_get_pool_path'):
+                with patch.object(self.driver, 'instance_create') as create:
+                    self.driver.journal_recover()
+
+        create.assert_called_once_with('test01', 'fedora-21',
+                                       network='default', cpus=4)
+
+    def test_journal_options(self):
+        options = module_mock()._journal_options({
+            'cpus': 4, 'password': 'secret', 'progress': MagicMock(),
+            'cancel': None})
+
+        self.assertEqual(options, {'cpus': 4})
+
+    def test_journal_recover_rollback(self):
+        self.journal.begin('test01-fedora-21-x86_64', 'create', vmid='test01',
+                           template='fedora-21', hostname='vm-test01',
+                           path='/pool/test01-fedora-21-x86_64.qcow2',
+                           kwargs={'network': 'default'})
+        # Crashed while defining the domain (not recorded)
+        self.journal.record('test01-fedora-21-x86_64', 'overlay')
+        self.journal.release('test01-fedora-21-x86_64')
+
+        with patch.object(self.driver, '_libvirt_open',
+                          return_value=self.conn):
+            with patch.multiple(module_mock(),
+                                _get_pool_path=MagicMock(),
+                                _remove_file=MagicMock(),
+                                _remove_domain=MagicMock(),
+                                _del_network_host=MagicMock(),
+                                _del_network_dhcp_host=MagicMock()):
+                result = self.driver.journal_recover(rollback=True)
+
+                module_mock()._remove_domain.assert_called_once_with(
+                    self.conn, 'test01-fedora-21-x86_64')
+                module_mock()._del_network_host.assert_called_once_with(
+                    self.net, 'vm-test01')
+                module_mock()._remove_file.assert_called_once_with(
+                    '/pool/test01-fedora-21-x86_64.qcow2')
+
+        self.assertEqual(result['rolledback'], ['test01-fedora-21-x86_64'])
+        self.assertEqual(self.journal.pending(), {})
+
+    def test_image_backing_missing(self):
+        with patch.object(module_mock(), 'execute',
+                          return_value=('{"format": "qcow2"}', None)):
+            with self.assertRaises(VirtDeployException):
+                module_mock()._get_image_backing('/pool/base.qcow2')
+
+
+class TestClone(unittest.TestCase):
+    DOMAIN_XML = TestInstanceReset.DOMAIN_XML
+
+    def setUp(self):
+        self.driver = module_mock().VirtDeployLibvirtDriver()
+
+        self.dom = MagicMock()
+        self.dom.name.return_value = 'test01-fedora-21-x86_64'
+        self.dom.XMLDesc.return_value = self.DOMAIN_XML
+        self.dom.info.return_value = [1, 2097152, 2097152, 4, 0]
+        self.dom.metadata.return_value = (
+            '<instance arch="x86_64" template="fedora-21" tuning="default"/>')
+
+        self.conn = MagicMock()
+        self.conn.lookupByName.return_value = self.dom
+
+        patcher = patch.object(self.driver, '_libvirt_open',
+                               return_value=self.conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _clone_base(self, active):
+        self.dom.isActive.return_value = active
+
+        with patch.multiple(module_mock(), execute=MagicMock(),
+                            _agent_ping=MagicMock(return_value=True)):
+            with patch('os.rename') as rename_mock:
+                name = module_mock()._create_clone_base(
+                    self.dom, '/pool', module_mock()._stage_options({}))
+
+            commands = [x[0][0] for x in
+                        module_mock().execute.call_args_list]
+
+        self.assertTrue(name.startswith('_clone-test01-fedora-21-x86_64-'))
+        rename_mock.assert_called_once_with(
+            '/pool/{0}.part'.format(name), '/pool/{0}'.format(name))
+        self.assertEqual(commands[0][:4], ('qemu-img', 'convert', '-U', '-O'))
+        self.assertEqual(commands[0][5], '/pool/test01-fedora-21-x86_64.qcow2')
+        self.assertEqual(commands[1][0], 'virt-sysprep')
+
+    def test_create_clone_base_running(self):
+        self._clone_base(True)
+
+        self.assertEqual([x[0] for x in self.dom.method_calls
+                          if x[0] not in ('isActive', 'name', 'XMLDesc')],
+                         ['fsFreeze', 'suspend', 'resume', 'fsThaw'])
+
+    def test_domain_quiesce_failure(self):
+        self.dom.isActive.return_value = True
+
+        with patch.object(module_mock(), '_agent_ping', return_value=True):
+            self.dom.suspend.side_effect = libvirtErrorMock(
+                libvirt_mock.VIR_ERR_OPERATION_INVALID)
+
+            with self.assertRaises(libvirt_mock.libvirtError):
+                with module_mock()._DomainQuiesce(self.dom):
+                    pass
+
+            self.dom.fsThaw.assert_called_once_with()
+
+            self.dom.suspend.side_effect = None
+            self.dom.resume.side_effect = libvirtErrorMock(
+                libvirt_mock.VIR_ERR_OPERATION_INVALID)
+
+            with self.assertRaises(libvirt_mock.libvirtError):
+                with module_mock()._DomainQuiesce(self.dom):
+                    pass
+
+            self.assertEqual(self.dom.fsThaw.call_count, 2)
+
+    def test_create_clone_base_stopped(self):
+        self._clone_base(False)
+
+        self.assertFalse(self.dom.suspend.called)
+        self.assertFalse(self.dom.fsFreeze.called)
+
+    def _clone(self, side_effect):
+        with patch.multiple(module_mock(),
+                            _get_pool_path=MagicMock(return_value='/pool'),
+                            _create_clone_base=MagicMock(
+                                return_value='_base.qcow2'),
+                            _remove_file=MagicMock()):
+            with patch.object(self.driver, 'instance_create',
+                              side_effect=side_effect) as create_mock:
+                result = self.driver.instance_clone(
+                    'test01-fedora-21-x86_64', 3, workers=1)
+
+            removed = module_mock()._remove_file.call_args_list
+
+        return result, create_mock, removed
+
+    def test_instance_clone(self):
+        def create(vmid, template, **kwargs):
+            if vmid == 'test01-2':
+                raise VirtDeployException('failure')
+            return {'name': '{0}-{1}-x86_64'.format(vmid, template)}
+
+        result, create_mock, removed = self._clone(create)
+
+        create_mock.assert_any_call(
+            'test01-1', 'fedora-21', base='_base.qcow2', cpus=4,
+            memory=2048, arch='x86_64', tuning='default', network='default')
+        self.assertEqual(result, {
+            'base': '_base.qcow2',
+            'instances': [{'name': 'test01-1-fedora-21-x86_64'},
+                          {'name': 'test01-3-fedora-21-x86_64'}],
+            'errors': {'test01-2': 'failure'},
+        })
+        self.assertEqual(removed, [])
+
+    def test_instance_clone_failed(self):
+        result, _, removed = self._clone(VirtDeployException('failure'))
+
+        self.assertEqual(result['instances'], [])
+        self.assertEqual(len(result['errors']), 3)
+        self.assertEqual(removed, [((os.path.join('/pool', '_base.qcow2'),),)])
+
+    def test_instance_clone_unknown(self):
+        self.dom.metadata.side_effect = libvirtErrorMock(
+            libvirt_mock.VIR_ERR_NO_DOMAIN_METADATA)
+
+        with self.assertRaises(VirtDeployException):
+            self.driver.instance_clone('test01-fedora-21-x86_64', 2)
+
+
+class TestSuspend(unittest.TestCase):
+    def setUp(self):
+        self.driver = module_mock().VirtDeployLibvirtDriver()
+        self.dom = MagicMock()
+        self.conn = MagicMock()
+        self.conn.lookupByName.return_value = self.dom
+
+        patcher = patch.object(self.driver, '_libvirt_open',
+                               return_value=self.conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_instance_suspend(self):
+        self.driver.instance_suspend('test01')
+        self.dom.managedSave.assert_called_once_with(0)
+
+    def test_instance_suspend_inactive(self):
+        self.dom.managedSave.side_effect = libvirtErrorMock(
+            libvirt_mock.VIR_ERR_OPERATION_INVALID)
+        self.driver.instance_suspend('test01')
+
+    def test_instance_resume(self):
+        self.dom.isActive.return_value = False
+        self.dom.hasManagedSaveImage.return_value = True
+
+        self.driver.instance_resume('test01')
+
+        self.dom.create.assert_called_once_with()
+
+    def test_instance_resume_not_suspended(self):
+        self.dom.isActive.return_value = False
+        self.dom.hasManagedSaveImage.return_value = False
+
+        with self.assertRaises(VirtDeployException):
+            self.driver.instance_resume('test01')
+
+        self.assertFalse(self.dom.create.called)
+
+    def test_instance_cpu_stats(self):
+        managed = MagicMock()
+        managed.name.return_value = 'test01'
+        managed.metadata.return_value = '<instance template="fedora-21"/>'
+
+        foreign = MagicMock()
+        foreign.metadata.side_effect = libvirtErrorMock(
+            libvirt_mock.VIR_ERR_NO_DOMAIN_METADATA)
+
+        self.conn.getAllDomainStats.return_value = [
+            (managed, {'cpu.time': 1000, 'vcpu.current': 2}),
+            (foreign, {'cpu.time': 2000, 'vcpu.current': 1}),
+        ]
+
+        self.assertEqual(self.driver.instance_cpu_stats(),
+                         {'test01': {'cpu_time': 1000, 'vcpus': 2}})
+
+    @patch.object(module_mock(), '_get_journal')
+    def test_instance_list(self, journal_mock):
+        journal_mock.return_value.pending.return_value = {
+            'test01': {'operation': 'create', 'stages': ['overlay']}}
+
+        managed = MagicMock()
+        managed.name.return_value = 'test01'
+        managed.isActive.return_value = 1
+        managed.XMLDesc.return_value = TestInstanceReset.DOMAIN_XML
+        managed.metadata.return_value = (
+            '<instance env="test" template="fedora-21"/>')
+
+        foreign = MagicMock()
+        foreign.metadata.side_effect = libvirtErrorMock(
+            libvirt_mock.VIR_ERR_NO_DOMAIN_METADATA)
+
+        self.conn.listAllDomains.return_value = [foreign, managed]
+
+        self.assertEqual(self.driver.instance_list(), [
+            {'name': 'test01', 'active': True, 'saved': False, 'env': 'test',
+             'template': 'fedora-21', 'pending': 'create'}])
+        journal_mock.assert_called_once_with('/pool')
+
+    def test_instance_stats(self):
+        managed = MagicMock()
+        managed.name.return_value = 'test01'
+        managed.metadata.return_value = '<instance template="fedora-21"/>'
+
+        self.conn.getAllDomainStats.return_value = [
+            (managed, {
+                'cpu.time': 1000, 'vcpu.current': 2,
+                'balloon.current': 1024, 'balloon.rss': 512,
+                'block.count': 2,
+                'block.0.rd.bytes': 100, 'block.0.wr.bytes': 200,
+                'block.0.rd.reqs': 1, 'block.0.wr.reqs': 2,
+                'block.1.rd.bytes': 10,
+                'net.count': 1,
+                'net.0.rx.bytes': 300, 'net.0.tx.bytes': 400,
+            }),
+        ]
+
+        self.assertEqual(self.driver.instance_stats(), {'test01': {
+            'cpu_time': 1000, 'vcpus': 2,
+            'memory': 1048576, 'memory_used': 524288,
+            'block_rd_bytes': 110, 'block_wr_bytes': 200,
+            'block_rd_reqs': 1, 'block_wr_reqs': 2,
+            'net_rx_bytes': 300, 'net_tx_bytes': 400,
+        }})
+        self.assertEqual(self.conn.getAllDomainStats.call_count, 1)
+
+    def test_parse_domain_stats_guest_memory(self):
+        stats = module_mock()._parse_domain_stats({
+            'balloon.current': 1024, 'balloon.rss': 1000,
+            'balloon.available': 1000, 'balloon.unused': 600})
+
+        self.assertEqual(stats['memory_used'], 400 * 1024)
+        self.assertEqual(stats['block_rd_bytes'], 0)
+
+    def test_domain_metadata(self):
+        dom = MagicMock()
+
+        module_mock()._set_domain_metadata(dom, {'template': 'fedora-21',
+                                                 'arch': 'x86_64'})
+
+        dom.setMetadata.assert_called_once_with(
+            libvirt_mock.VIR_DOMAIN_METADATA_ELEMENT,
+            '<instance arch="x86_64" template="fedora-21"/>',
+            module_mock().METADATA_PREFIX, module_mock().METADATA_URI,
+            libvirt_mock.VIR_DOMAIN_AFFECT_CONFIG)
+
+
+class TestTuning(unittest.TestCase):
+    CAPABILITIES = """
+        <capabilities>
+          <host>
+            <topology>
+              <cells num="2">
+                <cell id="0">
+                  <cpus num="4">
+                    <cpu id="0" socket_id="0" core_id="0" siblings="0,2"/>
+                    <cpu id="1" socket_id="0" core_id="1" siblings="1,3"/>
+                    <cpu id="2" socket_id="0" core_id="0" siblings="0,2"/>
+                    <cpu id="3" socket_id="0" core_id="1" siblings="1,3"/>
+                  </cpus>
+                </cell>
+                <cell id="1">
+                  <cpus num="4">
+                    <cpu id="4" socket_id="1" core_id="0" siblings="4,6"/>
+                    <cpu id="5" socket_id="1" core_id="1" siblings="5,7"/>
+                    <cpu id="6" socket_id="1" core_id="0" siblings="4,6"/>
+                    <cpu id="7" socket_id="1" core_id="1" siblings="5,7"/>
+                  </cpus>
+                </cell>
+              </cells>
+            </topology>
+          </host>
+        </capabilities>
+    """
+
+    PINNED_XML = """
+        <domain>
+          <cputune>
+            <vcpupin vcpu="0" cpuset="4"/>
+            <emulatorpin cpuset="5-7,^6"/>
+          </cputune>
+        </domain>
+    """
+
+    def setUp(self):
+        dom = MagicMock()
+        dom.XMLDesc.return_value = self.PINNED_XML
+
+        self.conn = MagicMock()
+        self.conn.getCapabilities.return_value = self.CAPABILITIES
+        self.conn.listAllDomains.return_value = [dom]
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        patcher = patch.object(module_mock(), 'PLACEMENT_FILE',
+                               os.path.join(self.tmpdir, 'placement.json'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_tuning_profile(self):
+        kwargs = dict(module_mock().INSTANCE_DEFAULTS,
+                      profile={'tuning': 'throughput'})
+
+        self.assertEqual(module_mock()._get_tuning_profile(kwargs)['name'],
+                         'throughput')
+
+        kwargs['tuning'] = 'latency'
+        self.assertEqual(module_mock()._get_tuning_profile(kwargs)['name'],
+                         'latency')
+
+        kwargs['tuning'] = 'unknown'
+        with self.assertRaises(VirtDeployException):
+            module_mock()._get_tuning_profile(kwargs)
+
+    def test_tuning_options_default(self):
+        self.assertEqual(module_mock()._get_tuning_options({}),
+                         ['--cpu', module_mock().DEFAULT_CPU_MODEL])
+
+    def test_device_options_default(self):
+        options = module_mock()._get_device_options(
+            '/pool/test01.qcow2', 'network=default', {}, 2)
+
+        self.assertEqual(options, [
+            '--controller', 'scsi,model=virtio-scsi',
+            '--disk', 'path=/pool/test01.qcow2,format=qcow2,bus=scsi,'
+                      'discard=unmap',
+            '--network', 'network=default',
+        ])
+
+    def test_device_options_latency(self):
+        options = module_mock()._get_device_options(
+            '/pool/test01.qcow2', 'network=default',
+            module_mock().TUNING_PROFILES['latency'], 2)
+
+        self.assertEqual(options, [
+            '--iothreads', '1',
+            '--disk', 'path=/pool/test01.qcow2,format=qcow2,bus=virtio,'
+                      'discard=unmap,cache=none,io=io_uring,'
+                      'driver.metadata_cache.max_size=4194304,'
+                      'driver.iothread=1',
+            '--network', 'network=default,model=virtio,driver.name=vhost,'
+                         'driver.queues=2',
+        ])
+
+    def test_device_options_scsi_iothread(self):
+        options = module_mock()._get_device_options(
+            '/pool/test01.qcow2', 'network=default',
+            {'iothreads': 2, 'net_queues': 4}, 2)
+
+        self.assertEqual(options[:4], [
+            '--iothreads', '2',
+            '--controller', 'scsi,model=virtio-scsi,driver.iothread=1'])
+        self.assertTrue(options[-1].endswith('driver.queues=4'))
+
+    def test_tuning_io_options(self):
+        kwargs = dict(module_mock().INSTANCE_DEFAULTS, tuning='throughput',
+                      disk_bus='virtio', iothreads=4)
+        tuning = module_mock()._get_tuning_profile(kwargs)
+
+        self.assertEqual(tuning['disk_bus'], 'virtio')
+        self.assertEqual(tuning['iothreads'], 4)
+        self.assertEqual(tuning['io'], 'native')
+
+        for invalid in ({'disk_bus': 'ide'}, {'io': 'native'}):
+            kwargs = dict(module_mock().INSTANCE_DEFAULTS, **invalid)
+
+            with self.assertRaises(VirtDeployException):
+                module_mock()._get_tuning_profile(kwargs)
+
+    def test_parse_cpuset(self):
+        self.assertEqual(module_mock()._parse_cpuset('0-3,^2,8'),
+                         set([0, 1, 3, 8]))
+
+    def test_pinned_cpus(self):
+        self.assertEqual(module_mock()._get_pinned_cpus(self.conn),
+                         set([4, 5, 7]))
+
+    def test_placement_latency(self):
+        tuning = module_mock().TUNING_PROFILES['latency']
+        tracker = module_mock()._PlacementTracker()
+
+        # Cell 1 has a single free cpu, the instance goes on cell 0
+        placement = tracker.place(self.conn, 'test01', 2, tuning)
+
+        self.assertEqual(placement['cell'], 0)
+        self.assertEqual(placement['vcpus'], [0, 2])
+        self.assertEqual(placement['emulator'], 1)
+
+        options = module_mock()._get_tuning_options(tuning, placement)
+
+        self.assertEqual(options, [
+            '--cpu', 'host-passthrough',
+            '--cputune', 'vcpupin0.vcpu=0,vcpupin0.cpuset=0,'
+                         'vcpupin1.vcpu=1,vcpupin1.cpuset=2,'
+                         'emulatorpin.cpuset=1',
+            '--numatune', '0,mode=strict',
+            '--memorybacking', 'hugepages=on,locked=on',
+        ])
+
+        # The cpus of the instance being created are not available
+        with self.assertRaises(VirtDeployException):
+            tracker.place(self.conn, 'test02', 2, tuning)
+
+        tracker.release('test01')
+        self.assertEqual(tracker.place(self.conn, 'test02', 2,
+                                       tuning)['vcpus'], [0, 2])
+
+    def test_placement_processes(self):
+        tuning = module_mock().TUNING_PROFILES['latency']
+        first = module_mock()._PlacementTracker()
+        second = module_mock()._PlacementTracker()
+
+        # The reservations are shared with the other processes
+        first.place(self.conn, 'test01', 2, tuning)
+
+        with self.assertRaises(VirtDeployException):
+            second.place(self.conn, 'test02', 2, tuning)
+
+        # Unless the process holding them died
+        with patch('os.kill', side_effect=OSError(errno.ESRCH, 'dead')):
+            self.assertEqual(second.place(self.conn, 'test02', 2,
+                                          tuning)['vcpus'], [0, 2])
+
+    def test_placement_release_none(self):
+        module_mock()._PlacementTracker().release('test01')
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_placement_numa_only(self):
+        tuning = module_mock().TUNING_PROFILES['throughput']
+        placement = module_mock()._PlacementTracker().place(
+            self.conn, 'test01', 8, tuning)
+
+        self.assertEqual(placement['cell'], 0)
+        self.assertEqual(placement['vcpus'], [])
+
+    def test_placement_default(self):
+        self.assertIsNone(module_mock()._PlacementTracker().place(
+            self.conn, 'test01', 2, module_mock().TUNING_PROFILES['default']))
+
+
+class TestBenchmark(unittest.TestCase):
+    FIO_OUTPUT = json.dumps({'jobs': [{
+        'read': {'iops': 10000.5, 'bw': 40002,
+                 'lat_ns': {'mean': 3100000.0}},
+        'write': {'iops': 9000.2, 'bw': 36000,
+                  'lat_ns': {'mean': 3500000.0}},
+    }]})
+
+    def test_instance_benchmark(self):
+        driver = module_mock().VirtDeployLibvirtDriver()
+        dom = MagicMock()
+        dom.metadata.return_value = '<instance tuning="latency"/>'
+
+        with patch.object(driver, '_libvirt_open') as open_mock:
+            open_mock.return_value.lookupByName.return_value = dom
+
+            with patch.object(module_mock(), '_agent_exec') as exec_mock:
+                exec_mock.return_value = (0, self.FIO_OUTPUT)
+                result = driver.instance_benchmark('test01', 10)
+
+        self.assertIn('--runtime=10', exec_mock.call_args[0][2])
+        self.assertEqual(result, {
+            'tuning': 'latency',
+            'read_iops': 10000, 'read_bw': 40002, 'read_latency': 3100,
+            'write_iops': 9000, 'write_bw': 36000, 'write_latency': 3500,
+        })
+
+    def test_instance_benchmark_failure(self):
+        driver = module_mock().VirtDeployLibvirtDriver()
+
+        with patch.object(driver, '_libvirt_open'):
+            with patch.object(module_mock(), '_agent_exec',
+                              return_value=(1, 'fio: not found')):
+                with self.assertRaises(VirtDeployException):
+                    driver.instance_benchmark('test01')
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.driver = module_mock().VirtDeployLibvirtDriver()
+        self.kwargs = dict(module_mock().INSTANCE_DEFAULTS)
+
+        self.conn = MagicMock()
+        self.dom = self.conn.lookupByName.return_value
+        self.dom.isActive.side_effect = [True, False]
+
+        patcher = patch.object(self.driver, '_libvirt_open',
+                               return_value=self.conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _create_snapshot(self):
+        return self.driver._create_snapshot(
+            'fedora-21', '_fedora-21-x86_64.qcow2', '/pool', self.kwargs,
+            module_mock()._stage_options(self.kwargs),
+            module_mock()._get_tuning_profile(self.kwargs))
+
+    @patch('os.path.exists', return_value=True)
+    def test_create_snapshot_exists(self, exists_mock):
+        self.assertEqual(self._create_snapshot(),
+                         '_fedora-21-x86_64-booted.qcow2')
+        self.assertFalse(self.driver._libvirt_open.called)
+
+    @patch('os.rename')
+    @patch('os.path.exists', return_value=False)
+    def test_create_snapshot(self, exists_mock, rename_mock):
+        with patch.multiple(module_mock(), _execute_stage=MagicMock(),
+                            _create_overlay=MagicMock(),
+                            _wait_domain_ready=MagicMock(),
+                            _remove_domain=MagicMock()):
+            with patch.object(self.driver, '_install_domain') as install:
+                disk = self._create_snapshot()
+
+            commands = [x[0][0] for x in
+                        module_mock()._execute_stage.call_args_list]
+            module_mock()._remove_domain.assert_called_once_with(
+                self.conn, '_fedora-21-x86_64-booted')
+
+        partial = '/pool/_fedora-21-x86_64-booted.qcow2.part'
+
+        self.assertEqual(disk, '_fedora-21-x86_64-booted.qcow2')
+        self.assertEqual(install.call_args[0][:2],
+                         ('_fedora-21-x86_64-booted', partial))
+
+        # Booted, shut down cleanly and cleaned before it's used
+        self.assertEqual([x[0] for x in self.dom.method_calls
+                          if x[0] != 'isActive'],
+                         ['create', 'shutdownFlags'])
+        self.assertEqual(commands[-1][:3], ('virt-sysprep', '-a', partial))
+        rename_mock.assert_called_once_with(
+            partial, '/pool/_fedora-21-x86_64-booted.qcow2')
+
+    def test_wait_domain_stopped_timeout(self):
+        dom = MagicMock()
+        dom.isActive.return_value = True
+
+        with patch.object(module_mock(), 'READY_INTERVAL', 0.01):
+            with self.assertRaises(CommandTimeout):
+                module_mock()._wait_domain_stopped(dom, 0.05)
+
+
+class TestGuestAgent(unittest.TestCase):
+    AGENT_IFACES = {
+        'lo': {
+            'hwaddr': '00:00:00:00:00:00',
+            'addrs': [{'addr': '127.0.0.1', 'prefix': 8, 'type': 0}],
+        },
+        'eth0': {
+            'hwaddr': '52:54:00:a0:b0:01',
+            'addrs': [
+                {'addr': '192.168.122.2', 'prefix': 24, 'type': 0},
+                {'addr': '10.0.0.2', 'prefix': 8, 'type': 0},
+                {'addr': 'fe80::5054:ff:fea0:b001', 'prefix': 64, 'type': 1},
+            ],
+        },
+    }
+
+    NETMACS = {'default': ['52:54:00:a0:b0:01']}
+
+    def test_agent_command(self):
+        libvirt_qemu = MagicMock()
+        libvirt_qemu.qemuAgentCommand.return_value = '{"return": {}}'
+        dom = MagicMock()
+
+        with patch.dict('sys.modules', {'libvirt_qemu': libvirt_qemu}):
+            result = module_mock()._agent_command(dom, 'guest-ping',
+                                                  timeout=1)
+
+        self.assertEqual(result, {})
+        libvirt_qemu.qemuAgentCommand.assert_called_once_with(
+            dom, '{"execute": "guest-ping"}', 1, 0)
+
+    def test_agent_exec(self):
+        responses = [
+            {'pid': 42},
+            {'exited': False},
+            {'exited': True, 'exitcode': 0, 'out-data': 'cnVubmluZwo='},
+        ]
+
+        with patch.object(module_mock(), '_agent_command') as command_mock:
+            command_mock.side_effect = responses
+
+            with patch('time.sleep'):
+                result = module_mock()._agent_exec(
+                    None, '/usr/bin/systemctl', ['is-system-running'])
+
+        self.assertEqual(result, (0, 'running\n'))
+
+    def test_agent_addresses(self):
+        dom = MagicMock()
+        dom.interfaceAddresses.return_value = self.AGENT_IFACES
+
+        with patch.object(module_mock(), '_agent_ping', return_value=True):
+            addresses = module_mock()._get_agent_addresses(dom, self.NETMACS)
+
+        self.assertEqual(addresses, ['192.168.122.2', '10.0.0.2'])
+
+    def test_agent_addresses_unavailable(self):
+        dom = MagicMock()
+
+        with patch.object(module_mock(), '_agent_ping', return_value=False):
+            addresses = module_mock()._get_agent_addresses(dom, self.NETMACS)
+
+        self.assertIs(addresses, None)
+        self.assertFalse(dom.interfaceAddresses.called)
+
+    def _instance_ready(self, ping, execute):
+        driver = module_mock().VirtDeployLibvirtDriver()
+
+        with patch.multiple(module_mock(),
+                            _get_domain=MagicMock(),
+                            _agent_ping=MagicMock(return_value=ping),
+                            _agent_exec=MagicMock(side_effect=execute)):
+            with patch.object(driver, '_libvirt_open'):
+                return driver.instance_ready('test01')
+
+    def test_instance_ready(self):
+        self.assertTrue(self._instance_ready(True, [(0, 'running\n')]))
+        self.assertTrue(self._instance_ready(True, [(1, 'degraded\n')]))
+        self.assertFalse(self._instance_ready(True, [(1, 'starting\n')]))
+        self.assertFalse(self._instance_ready(False, []))
+
+    def test_instance_ready_exec_failure(self):
+        self.assertFalse(self._instance_ready(True, libvirtErrorMock(1)))
+        self.assertFalse(self._instance_ready(True, KeyError('pid')))
+        self.assertFalse(self._instance_ready(True, ValueError('garbage')))
+
+    def test_instance_ready_exec_timeout(self):
+        self.assertFalse(self._instance_ready(
+            True, CommandTimeout('/usr/bin/systemctl', 10)))
+
+    def test_agent_ping_failures(self):
+        for error in (libvirtErrorMock(1), ImportError('libvirt_qemu'),
+                      KeyError('return'), ValueError('garbage')):
+            with patch.object(module_mock(), '_agent_command',
+                              side_effect=error):
+                self.assertFalse(module_mock()._agent_ping(None))
+
+
+class TestLibvirtOpen(unittest.TestCase):
+    def _event_loop_start(self):
+        module_mock()._event_loop = MagicMock()
+
+    @patch.object(libvirt_mock, 'registerErrorHandler', create=True)
+    @patch.object(libvirt_mock, 'open', create=True)
+    def test_libvirt_open_events(self, open_mock, handler_mock):
+        driver = module_mock().VirtDeployLibvirtDriver()
+
+        with patch.object(module_mock(), '_event_loop', None):
+            with patch.object(module_mock(), '_event_loop_start',
+                              side_effect=self._event_loop_start) as start:
+                # The event loop is started only to wait for events
+                driver._libvirt_open()
+                self.assertFalse(start.called)
+
+                # The connection is reopened after registering the loop
+                driver._libvirt_open(events=True)
+                driver._libvirt_open(events=True)
+                driver._libvirt_open()
+
+        start.assert_called_once_with()
+        self.assertEqual(open_mock.call_count, 2)
+
+
+class TestInstanceStopWait(unittest.TestCase):
+    def setUp(self):
+        self.callbacks = []
+        self.conn = MagicMock()
+        self.conn.domainEventRegisterAny.side_effect = self._register
+
+        self.doms = {}
+
+        for name in ('test01', 'test02', 'test03'):
+            dom = self.doms[name] = MagicMock()
+            dom.name.return_value = name
+            dom.isActive.return_value = True
+
+        # test01 shuts down, test02 ignores the request, test03 is off
+        self.doms['test01'].shutdownFlags.side_effect = \
+            lambda flags: self._stopped('test01')
+        self.doms['test03'].shutdownFlags.side_effect = libvirtErrorMock(55)
+
+    def _register(self, dom, event, callback, opaque):
+        self.callbacks.append(callback)
+        return len(self.callbacks)
+
+    def _stopped(self, name):
+        for cb in self.callbacks:
+            cb(self.conn, self.doms[name], 5, 0, None)
+
+    def test_instance_stop_wait(self):
+        driver = module_mock().VirtDeployLibvirtDriver()
+
+        with patch.object(module_mock(), '_get_domain',
+                          side_effect=lambda conn, x: self.doms[x]):
+            with patch.object(driver, '_libvirt_open',
+                              return_value=self.conn):
+                result = driver.instance_stop_wait(
+                    ['test01', 'test02', 'test03'], grace=0.1)
+
+        self.assertEqual(result, {
+            'test01': 'shutdown',
+            'test02': 'destroyed',
+            'test03': 'stopped',
+        })
+        self.doms['test02'].destroy.assert_called_once_with()
+        self.assertFalse(self.doms['test01'].destroy.called)
+        self.conn.domainEventDeregisterAny.assert_called_once_with(1)
+
+    def test_instance_stop_wait_lost_event(self):
+        driver = module_mock().VirtDeployLibvirtDriver()
+        self.doms['test02'].isActive.return_value = False
+
+        with patch.object(module_mock(), '_get_domain',
+                          side_effect=lambda conn, x: self.doms[x]):
+            with patch.object(driver, '_libvirt_open',
+                              return_value=self.conn):
+                with patch.object(module_mock(), 'EVENT_RECHECK_INTERVAL',
+                                  0.01):
+                    result = driver.instance_stop_wait(['test02'], grace=5)
+
+        self.assertEqual(result, {'test02': 'shutdown'})
+        self.assertFalse(self.doms['test02'].destroy.called)
@@ -0,0 +1,283 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import re
+
+from . import profiles
+from .errors import InvalidEnvironment
+from .utils import PARALLEL_WORKERS
+from .utils import parallel
+from .utils import parallel_graph
+
+# An environment is a named list of instances:
+#
+#   {
+#     "name": "test",
+#     "instances": [
+#       {"id": "db01", "template": "fedora-21", "memory": 2048},
+#       {"id": "web01", "template": "fedora-21", "depends": ["db01"]}
+#     ]
+#   }
+#
+# The instances are labelled with the environment name, their id and a
+# hash of their definition (spec): applying the environment again creates
+# (or recreates) only the instances whose definition changed. The
+# instances are named after the environment and their id (test-db01), so
+# that the same id can be used in different environments.
+#
+# On python 2 json strings are unicode and yaml ones are str (ascii)
+_STRING = (str, type(u''))
+
+INSTANCE_KEYS = {
+    'id': _STRING,
+    'template': _STRING,
+    'arch': _STRING,
+    'cpus': int,
+    'memory': int,
+    'network': _STRING,
+    'pool': _STRING,
+    'tuning': _STRING,
+    'profile': _STRING,
+    'snapshot': bool,
+    'depends': list,
+}
+
+_REQUIRED_KEYS = ('id', 'template')
+
+# Keys that are not part of the instance definition (spec)
+_PLAN_KEYS = ('id', 'depends')
+
+DEFAULT_ARCH = 'x86_64'
+
+SPEC_HASH_SIZE = 12
+
+# The environment name and the ids are part of the instance hostnames
+_NAME_RE = re.compile(r'^[a-zA-Z0-9]([a-zA-Z0-9-]*[a-zA-Z0-9])?$')
+
+
+def load_environment(path):
+    try:
+        with open(path) as f:
+            if os.path.splitext(path)[1] in ('.yaml', '.yml'):
+                environment = _load_yaml(f)
+            else:
+                environment = json.load(f)
+    except (IOError, ValueError) as e:
+        raise InvalidEnvironment(path, e)
+
+    # The profiles are relative to the environment file
+    for instance in environment.get('instances', ()):
+        if isinstance(instance, dict) and instance.get('profile'):
+            instance['profile'] = os.path.join(os.path.dirname(path),
+                                               instance['profile'])
+
+    return validate_environment(environment, path)
+
+
+def _load_yaml(f):
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError('yaml support requires PyYAML')
+
+    try:
+        return yaml.safe_load(f)
+    except yaml.YAMLError as e:
+        raise ValueError(e)
+
+
+def validate_environment(environment, name='environment'):
+    if not isinstance(environment, dict):
+        raise InvalidEnvironment(name, 'not an object')
+
+    if not isinstance(environment.get('name'), _STRING):
+        raise InvalidEnvironment(name, 'missing name')
+
+    if not _NAME_RE.match(environment['name']):
+        raise InvalidEnvironment(name, 'invalid name')
+
+    instances = environment.get('instances')
+
+    if not isinstance(instances, list):
+        raise InvalidEnvironment(name, 'missing instances')
+
+    for instance in instances:
+        if not isinstance(instance, dict):
+            raise InvalidEnvironment(name, 'instances must be objects')
+
+        for key, value in instance.items():
+            if key not in INSTANCE_KEYS:
+                raise InvalidEnvironment(name, 'unknown key {0}'.format(key))
+
+            if not isinstance(value, INSTANCE_KEYS[key]):
+                raise InvalidEnvironment(
+                    name, 'wrong type for {0}'.format(key))
+
+        for key in _REQUIRED_KEYS:
+            if key not in instance:
+                raise InvalidEnvironment(name, 'missing {0}'.format(key))
+
+        if not _NAME_RE.match(instance['id']):
+            raise InvalidEnvironment(
+                name, 'invalid instance id {0}'.format(instance['id']))
+
+    ids = [x['id'] for x in instances]
+
+    if len(set(ids)) != len(ids):
+        raise InvalidEnvironment(name, 'duplicate instance id')
+
+    for instance in instances:
+        for x in instance.get('depends', ()):
+            if x not in ids:
+                raise InvalidEnvironment(
+                    name, 'unknown dependency {0}'.format(x))
+
+    depends = dict((x['id'], x.get('depends', ())) for x in instances)
+
+    for vmid in ids:
+        if _has_cycle(depends, vmid, set()):
+            raise InvalidEnvironment(
+                name, 'dependency cycle on {0}'.format(vmid))
+
+    return environment
+
+
+def _has_cycle(depends, vmid, visiting):
+    if vmid in visiting:
+        return True
+
+    visiting.add(vmid)
+    cycle = any(_has_cycle(depends, x, visiting) for x in depends[vmid])
+    visiting.discard(vmid)
+
+    return cycle
+
+
+def instance_spec(instance):
+    spec = dict((k, v) for k, v in instance.items() if k not in _PLAN_KEYS)
+    spec.setdefault('arch', DEFAULT_ARCH)
+
+    # The content of the profile, and not its path, is part of the spec
+    if spec.get('profile'):
+        spec['profile'] = profiles.profile_hash(
+            profiles.load_profile(spec['profile']))
+
+    digest = hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()[:SPEC_HASH_SIZE]
+
+
+def instance_vmid(env, instance):
+    return '{0}-{1}'.format(env, instance['id'])
+
+
+def instance_name(env, instance):
+    return '{0}-{1}-{2}'.format(instance_vmid(env, instance),
+                                instance['template'],
+                                instance.get('arch', DEFAULT_ARCH))
+
+
+def plan_environment(environment, instances, reset=False):
+    # The actions (create, recreate, reset, delete or keep) bringing the
+    # instances of the environment (driver instance_list) to the desired
+    # state, in the order of the environment file.
+    current = dict((x['instance'], x) for x in instances
+                   if x.get('env') == environment['name'] and
+                   x.get('instance'))
+    plan = []
+
+    for instance in environment['instances']:
+        existing = current.pop(instance['id'], None)
+        spec = instance_spec(instance)
+
+        # The interrupted operations (pending) are resumed
+        if existing is None or existing.get('pending') == 'create':
+            action = 'create'
+        elif existing.get('spec') != spec:
+            action = 'recreate'
+        elif reset or existing.get('pending') == 'reset':
+            action = 'reset'
+        else:
+            action = 'keep'
+
+        plan.append({'action': action, 'id': instance['id'],
+                     'name': instance_name(environment['name'], instance),
+                     'spec': spec,
+                     'existing': existing and existing['name']})
+
+    for vmid, existing in sorted(current.items()):
+        plan.append({'action': 'delete', 'id': vmid, 'name': None,
+                     'spec': None, 'existing': existing['name']})
+
+    return plan
+
+
+def apply_plan(get_driver, environment, plan, workers=PARALLEL_WORKERS,
+               **kwargs):
+    # The instances no longer in the environment are deleted first, the
+    # others are created (or reset) after the ones they depend on. Each
+    # worker gets its own driver (get_driver). Returns the (result,
+    # exception) of each action by instance id.
+    definitions = dict((x['id'], x) for x in environment['instances'])
+    actions = dict((x['id'], x) for x in plan if x['action'] != 'keep')
+
+    def delete(vmid):
+        return get_driver().instance_delete(actions[vmid]['existing'])
+
+    removed = [x for x in actions if actions[x]['action'] == 'delete']
+    results = dict(zip(removed, parallel(delete, removed, workers)))
+
+    def execute(vmid):
+        action, driver = actions[vmid], get_driver()
+
+        if action['action'] == 'reset':
+            return driver.instance_reset(action['existing'], **kwargs)
+
+        if action['action'] == 'recreate':
+            driver.instance_delete(action['existing'])
+
+        return driver.instance_create(
+            instance_vmid(environment['name'], definitions[vmid]),
+            **_create_options(definitions[vmid], environment['name'],
+                              action['spec'], kwargs))
+
+    depends = dict((x, definitions[x].get('depends', ()))
+                   for x in actions if x not in removed)
+    results.update(parallel_graph(execute, depends, workers))
+
+    return results
+
+
+def _create_options(instance, env, spec, kwargs):
+    options = dict(kwargs)
+    options.update((k, v) for k, v in instance.items()
+                   if k not in _PLAN_KEYS)
+
+    if options.get('profile'):
+        options['profile'] = profiles.load_profile(options['profile'])
+
+    options['labels'] = {'env': env, 'instance': instance['id'],
+                         'spec': spec}
+
+    return options
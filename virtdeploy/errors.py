@@ -33,3 +33,33 @@ class InstanceNotFound(VirtDeployException):
     def __init__(self, name):
         super(InstanceNotFound, self).__init__(
             'No such instance: {0}'.format(name))
+
+
+class InvalidProfile(VirtDeployException):
+    def __init__(self, name, reason):
+        super(InvalidProfile, self).__init__(
+            'Invalid profile {0}: {1}'.format(name, reason))
+
+
+class CommandTimeout(VirtDeployException):
+    def __init__(self, command, timeout):
+        super(CommandTimeout, self).__init__(
+            'Command {0} timed out after {1} seconds'.format(command, timeout))
+
+
+class OperationCancelled(VirtDeployException):
+    def __init__(self, command):
+        super(OperationCancelled, self).__init__(
+            'Command {0} cancelled'.format(command))
+
+
+class InvalidEnvironment(VirtDeployException):
+    def __init__(self, name, reason):
+        super(InvalidEnvironment, self).__init__(
+            'Invalid environment {0}: {1}'.format(name, reason))
+
+
+class OperationInProgress(VirtDeployException):
+    def __init__(self, name, operation):
+        super(OperationInProgress, self).__init__(
+            'Operation {0} in progress on {1}'.format(operation, name))
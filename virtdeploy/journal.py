@@ -0,0 +1,227 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import fcntl
+import json
+import os
+import threading
+import time
+
+from .errors import OperationInProgress
+from .utils import process_alive
+
+# The journal records the stages of the operations (one json object per
+# line, appended) so that an operation interrupted by a crash can be
+# resumed, or rolled back, by a later run:
+#
+#   {"name": "...", "stage": "begin", "operation": "create", "pid": ...}
+#   {"name": "...", "stage": "overlay"}
+#   {"name": "...", "stage": "done"}
+#
+# An operation is pending until its final stage (done or rollback) and
+# it's resumed only when the process that began it is gone. The journal
+# is rewritten without the completed operations when one ends.
+FINAL_STAGES = ('done', 'rollback')
+
+# The operations running in this process, the pid doesn't tell them apart
+_RUNNING = set()
+_RUNNING_LOCK = threading.Lock()
+
+
+class Journal(object):
+    def __init__(self, path):
+        self._path = path
+
+    def begin(self, name, operation, **data):
+        # Returns the state of the pending operation being resumed (if any)
+        with self._locked() as f:
+            state = _replay(f).get(name)
+
+            if state is not None and self._is_running(name, state):
+                raise OperationInProgress(name, state['operation'])
+
+            if state is not None and state['operation'] != operation:
+                raise OperationInProgress(name, state['operation'])
+
+            if state is None:
+                _append(f, dict(data, name=name, stage='begin',
+                                operation=operation, pid=os.getpid()))
+            else:
+                _append(f, {'name': name, 'stage': 'resume',
+                            'pid': os.getpid()})
+
+            with _RUNNING_LOCK:
+                _RUNNING.add((self._path, name))
+
+        return state
+
+    def record(self, name, stage, **data):
+        with self._locked() as f:
+            _append(f, dict(data, name=name, stage=stage))
+
+    def end(self, name, stage='done'):
+        self.record(name, stage)
+        self.release(name)
+        self.compact()
+
+    def release(self, name):
+        # The operation (if not ended) is left pending, for a later resume
+        with _RUNNING_LOCK:
+            _RUNNING.discard((self._path, name))
+
+    def pending(self):
+        if not os.path.exists(self._path):
+            return {}
+
+        with self._locked() as f:
+            return dict((k, v) for k, v in _replay(f).items()
+                        if not self._is_running(k, v))
+
+    def unfinished(self):
+        # The pending operations and the running ones
+        if not os.path.exists(self._path):
+            return {}
+
+        with self._locked() as f:
+            return _replay(f)
+
+    def compact(self):
+        with self._locked() as f:
+            f.seek(0)
+            states = _replay(f)
+            partial = '{0}.part'.format(self._path)
+
+            with open(partial, 'wb') as new:
+                os.chmod(partial, 0o600)
+
+                f.seek(0)
+                for line in f:
+                    try:
+                        if json.loads(line.decode('utf-8'))['name'] in states:
+                            new.write(line)
+                    except (ValueError, KeyError):
+                        continue
+
+                new.flush()
+                os.fsync(new.fileno())
+
+            os.rename(partial, self._path)
+
+    def _is_running(self, name, state):
+        with _RUNNING_LOCK:
+            if (self._path, name) in _RUNNING:
+                return True
+
+        return state['pid'] != os.getpid() and process_alive(state['pid'])
+
+    def _locked(self):
+        return _LockedFile(self._path)
+
+
+class NullJournal(object):
+    # Operations that leave nothing to resume (e.g. ephemeral instances)
+    def begin(self, name, operation, **data):
+        return None
+
+    def record(self, name, stage, **data):
+        pass
+
+    def end(self, name, stage='done'):
+        pass
+
+    def release(self, name):
+        pass
+
+    def pending(self):
+        return {}
+
+    def unfinished(self):
+        return {}
+
+
+class _LockedFile(object):
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    def __enter__(self):
+        while True:
+            fd = os.open(self._path, os.O_RDWR | os.O_CREAT | os.O_APPEND,
+                         0o600)
+            self._file = os.fdopen(fd, 'ab+')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+
+            # Replaced meanwhile (compact), the lock is on the old file
+            if os.fstat(fd).st_ino == os.stat(self._path).st_ino:
+                self._file.seek(0)
+                return self._file
+
+            self._file.close()
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self._file.close()
+
+
+def _append(f, record):
+    record['time'] = int(time.time())
+
+    # Terminates the partial line left by a crashed process (if any)
+    f.seek(0, os.SEEK_END)
+
+    if f.tell() > 0:
+        f.seek(-1, os.SEEK_END)
+
+        if f.read(1) != b'\n':
+            f.write(b'\n')
+
+    f.write(json.dumps(record, sort_keys=True).encode('utf-8') + b'\n')
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _replay(f):
+    # The state of the pending operations: the data of their records and
+    # the list of the completed stages.
+    states = {}
+
+    for line in f:
+        try:
+            record = json.loads(line.decode('utf-8'))
+            name, stage = record.pop('name'), record.pop('stage')
+        except (ValueError, KeyError):
+            continue  # a partial line, written by a crashed process
+
+        record.pop('time', None)
+
+        if stage == 'begin':
+            states[name] = dict(record, stages=[])
+        elif name not in states:
+            continue
+        elif stage in FINAL_STAGES:
+            del states[name]
+        elif stage == 'resume':
+            states[name]['pid'] = record['pid']
+        else:
+            states[name].update(record)
+            states[name]['stages'].append(stage)
+
+    return states
@@ -0,0 +1,217 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import contextlib
+import threading
+import timeit
+
+# Seconds, from a single command up to a complete template build
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800,
+                   3600)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def register(self, metric):
+        # A module loaded again replaces the metrics it registered
+        with self._lock:
+            self._metrics = [x for x in self._metrics
+                             if x.name != metric.name]
+            self._metrics.append(metric)
+
+    def metrics(self):
+        with self._lock:
+            return sorted(self._metrics, key=lambda x: x.name)
+
+
+REGISTRY = Registry()
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, description, labels=(), registry=None):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels):
+        if sorted(labels) != sorted(self.labels):
+            raise ValueError('Wrong labels for {0}: {1}'.format(
+                self.name, ', '.join(sorted(labels))))
+
+        return tuple(str(labels[x]) for x in self.labels)
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def samples(self):
+        # (name suffix, labels, value) of each exposed sample
+        with self._lock:
+            values = sorted(self._values.items())
+
+        for key, value in values:
+            yield '', dict(zip(self.labels, key)), value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), registry=None,
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0))
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+
+            counts[-1] += 1  # +Inf
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = timeit.default_timer()
+
+        try:
+            yield
+        finally:
+            self.observe(timeit.default_timer() - start, **labels)
+
+    def samples(self):
+        for _, labels, (counts, total) in super(Histogram, self).samples():
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                yield '_bucket', dict(labels, le=_format_value(bound)), count
+
+            yield '_count', labels, counts[-1]
+            yield '_sum', labels, total
+
+
+def _format_value(value):
+    if isinstance(value, float) and value == int(value):
+        value = int(value)
+    return str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    def escape(value):
+        return (value.replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n'))
+
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(k, escape(v)) for k, v in sorted(labels.items())))
+
+
+def render(registry=None):
+    # Prometheus text exposition format
+    lines = []
+
+    for metric in (registry or REGISTRY).metrics():
+        lines.append('# HELP {0} {1}'.format(metric.name, metric.description))
+        lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+
+        for suffix, labels, value in metric.samples():
+            lines.append('{0}{1}{2} {3}'.format(
+                metric.name, suffix, _format_labels(labels),
+                _format_value(value)))
+
+    return '\n'.join(lines) + '\n'
+
+
+def make_server(address, collect=render):
+    # The http server is slow to import and only needed by the daemon
+    try:
+        from http import server as httpserver
+        import socketserver
+    except ImportError:  # pragma: no cover
+        import BaseHTTPServer as httpserver
+        import SocketServer as socketserver
+
+    class MetricsHandler(httpserver.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+
+            try:
+                body = collect().encode('utf-8')
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scraped every few seconds, not worth a log line
+
+    class MetricsServer(socketserver.ThreadingMixIn, httpserver.HTTPServer):
+        daemon_threads = True
+
+    return MetricsServer(address, MetricsHandler)
@@ -0,0 +1,374 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import errno
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+from .errors import VirtDeployException
+from .utils import Rollback
+from .utils import execute
+
+try:
+    from urllib.parse import urljoin
+    from urllib.request import urlopen
+except ImportError:  # pragma: no cover
+    from urllib2 import urlopen
+    from urlparse import urljoin
+
+# The template images of the virt-builder index are kept in a content
+# addressed store (named after their sha512 checksum) and linked under
+# their upstream names next to the upstream index, kept as signed, the
+# virt-builder source of the instances creations. The mirror can be
+# shared with other hosts over http (serve).
+MIRROR_DIR = '/var/lib/virt-deploy/mirror'
+MIRROR_PORT = 8100
+UPSTREAM_INDEX = 'https://builder.libguestfs.org/index.asc'
+
+# The key signing the upstream index (shipped with virt-builder)
+UPSTREAM_KEY = '/etc/virt-builder/repos.d/libguestfs.gpg'
+UPSTREAM_FINGERPRINT = 'F7774FB1AD074A7E8C8767EA91738F73E1B768A0'
+
+PGP_SIGNED_HEADER = '-----BEGIN PGP SIGNED MESSAGE-----'
+
+INDEX_NAME = 'index'
+OBJECTS_DIR = 'objects'
+CHECKSUM_KEY = 'checksum[sha512]'
+
+DOWNLOAD_CHUNK = 1048576
+
+
+def parse_index(text):
+    # The entries of a virt-builder index (optionally clear signed), each
+    # with its fields in order. The lines starting with a space continue
+    # the value of the previous field (notes).
+    entries = []
+    entry = None
+
+    for line in _strip_signature(text.splitlines()):
+        if line.startswith(' ') and entry and entry['fields']:
+            key, value = entry['fields'][-1]
+            entry['fields'][-1] = (key, '{0}\n{1}'.format(value, line[1:]))
+        elif not line.strip() or line.startswith('#'):
+            continue
+        elif line.startswith('[') and line.rstrip().endswith(']'):
+            entry = {'id': line.strip()[1:-1], 'fields': []}
+            entries.append(entry)
+        elif '=' in line and entry is not None:
+            key, _, value = line.partition('=')
+            entry['fields'].append((key, value))
+        else:
+            raise VirtDeployException('Invalid index line: {0}'.format(line))
+
+    return entries
+
+
+def render_index(entries):
+    lines = []
+
+    for entry in entries:
+        lines.append('[{0}]'.format(entry['id']))
+        lines.extend('{0}={1}'.format(k, v.replace('\n', '\n '))
+                     for k, v in entry['fields'])
+        lines.append('')
+
+    return '\n'.join(lines)
+
+
+def _strip_signature(lines):
+    if not lines or lines[0] != PGP_SIGNED_HEADER:
+        return lines
+
+    # The armor headers (Hash) end with the first empty line
+    start = lines.index('') + 1
+
+    try:
+        end = lines.index('-----BEGIN PGP SIGNATURE-----')
+    except ValueError:
+        end = len(lines)
+
+    # Dash escaped lines of the signed text
+    return [x[2:] if x.startswith('- ') else x for x in lines[start:end]]
+
+
+def get_field(entry, key, default=None):
+    for k, v in entry['fields']:
+        if k == key:
+            return v
+
+    return default
+
+
+def verify_index(text, key=None, fingerprint=None):
+    # Returns the text signed (clear signed) by the key with the given
+    # fingerprint, anything outside of the signed part is discarded.
+    fingerprint = (fingerprint or UPSTREAM_FINGERPRINT).replace(' ', '')
+    home = tempfile.mkdtemp()
+
+    try:
+        signed = os.path.join(home, 'index.asc')
+        plain = os.path.join(home, 'index')
+
+        with open(signed, 'wb') as f:
+            f.write(text.encode('utf-8'))
+
+        gpg = ('gpg', '--batch', '--no-tty', '--homedir', home)
+
+        try:
+            execute(gpg + ('--import', key or UPSTREAM_KEY),
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            status, _ = execute(gpg + ('--status-fd', '1', '--output', plain,
+                                       '--decrypt', signed),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        except subprocess.CalledProcessError:
+            raise VirtDeployException('Index signature verification failed')
+
+        valid = [x.split()[2] for x in status.decode('utf-8').splitlines()
+                 if x.startswith('[GNUPG:] VALIDSIG ')]
+
+        if valid != [fingerprint]:
+            raise VirtDeployException(
+                'Index not signed by {0}'.format(fingerprint))
+
+        with open(plain, 'rb') as f:
+            return f.read().decode('utf-8')
+    finally:
+        shutil.rmtree(home)
+
+
+class Mirror(object):
+    def __init__(self, path=None):
+        self.path = path or MIRROR_DIR
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, INDEX_NAME)
+
+    @property
+    def index_uri(self):
+        return 'file://{0}'.format(self.index_path)
+
+    def entries(self):
+        try:
+            with open(self.index_path) as f:
+                return parse_index(f.read())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+    def find(self, template, arch):
+        # The link may still point to an image older than the index
+        for entry in self.entries():
+            if (entry['id'] == template and
+                    get_field(entry, 'arch') == arch and
+                    self._is_linked(entry)):
+                return entry
+
+        return None
+
+    def sync(self, url=None, templates=None, arch=None):
+        # Downloads the images (of the templates, or all) missing from the
+        # store and replaces the local index with the upstream one, once
+        # its signature is verified.
+        url = url or UPSTREAM_INDEX
+        text = _fetch_index(url)
+        upstream = parse_index(verify_index(text))
+
+        if templates:
+            missing = set(templates) - set(x['id'] for x in upstream)
+
+            if missing:
+                raise VirtDeployException('Templates not in {0}: {1}'.format(
+                    url, ', '.join(sorted(missing))))
+
+        result = {'downloaded': [], 'present': [], 'bytes': 0}
+
+        for entry in upstream:
+            if templates and entry['id'] not in templates:
+                continue
+
+            if arch is not None and get_field(entry, 'arch') != arch:
+                continue
+
+            checksum = get_field(entry, CHECKSUM_KEY)
+            source = get_field(entry, 'file')
+
+            if checksum is None or source is None:
+                raise VirtDeployException(
+                    'No file or sha512 checksum for {0}'.format(entry['id']))
+
+            # The images are linked next to the index (virt-builder looks
+            # for them relative to it)
+            if ('/' in source or source.startswith('.') or
+                    source == INDEX_NAME):
+                raise VirtDeployException(
+                    'Invalid file for {0}: {1}'.format(entry['id'], source))
+
+            target = self._object_path(entry)
+            name = '{0} ({1})'.format(entry['id'], get_field(entry, 'arch'))
+
+            if os.path.exists(target):
+                result['present'].append(name)
+            else:
+                result['bytes'] += self._download(urljoin(url, source),
+                                                  target, checksum)
+                result['downloaded'].append(name)
+
+            self._link(entry)
+
+        self._write_index(text)
+
+        return result
+
+    def _object_path(self, entry):
+        return os.path.join(self.path, _object_name(
+            get_field(entry, CHECKSUM_KEY, ''), get_field(entry, 'file', '')))
+
+    def _link_path(self, entry):
+        return os.path.join(self.path, get_field(entry, 'file', ''))
+
+    def _is_linked(self, entry):
+        return (os.path.exists(self._object_path(entry)) and
+                os.path.realpath(self._link_path(entry)) ==
+                os.path.realpath(self._object_path(entry)))
+
+    def _link(self, entry):
+        path = self._link_path(entry)
+        partial = '{0}.{1}.part'.format(path, os.getpid())
+
+        _remove_file(partial)
+        os.symlink(os.path.relpath(self._object_path(entry), self.path),
+                   partial)
+        os.rename(partial, path)
+
+    def _download(self, url, path, checksum):
+        try:
+            os.makedirs(os.path.dirname(path), 0o755)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        partial = '{0}.{1}.part'.format(path, os.getpid())
+        digest = hashlib.sha512()
+        size = 0
+
+        with Rollback() as rollback:
+            rollback.add(_remove_file, partial)
+
+            source = urlopen(url)
+
+            try:
+                with open(partial, 'wb') as f:
+                    for chunk in iter(lambda: source.read(DOWNLOAD_CHUNK),
+                                      b''):
+                        digest.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+            finally:
+                source.close()
+
+            if digest.hexdigest() != checksum.lower():
+                raise VirtDeployException(
+                    'Checksum mismatch for {0}'.format(url))
+
+        os.rename(partial, path)
+
+        return size
+
+    def _write_index(self, text):
+        partial = '{0}.{1}.part'.format(self.index_path, os.getpid())
+
+        with open(partial, 'wb') as f:
+            f.write(text.encode('utf-8'))
+
+        os.rename(partial, self.index_path)
+
+
+def _object_name(checksum, source):
+    # The extension tells virt-builder how the image is compressed (.xz)
+    _, ext = os.path.splitext(os.path.basename(source))
+    checksum = checksum.lower()
+
+    return '/'.join((OBJECTS_DIR, checksum[:2], checksum + ext))
+
+
+def _fetch_index(url):
+    source = urlopen(url)
+
+    try:
+        return source.read().decode('utf-8')
+    finally:
+        source.close()
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def make_server(address, path=None):
+    # The http server is slow to import and only needed by serve
+    try:
+        from http import server as httpserver
+        import socketserver
+    except ImportError:  # pragma: no cover
+        import BaseHTTPServer as httpserver
+        import SocketServer as socketserver
+
+    class MirrorHandler(httpserver.BaseHTTPRequestHandler):
+        def do_GET(self):
+            # Only the index, the images links and the objects are served
+            name = self.path.split('?')[0].lstrip('/')
+            parts = name.split('/')
+
+            if not (len(parts) == 1 and not name.startswith('.') or (
+                    len(parts) == 3 and parts[0] == OBJECTS_DIR and
+                    '..' not in parts)):
+                self.send_error(404)
+                return
+
+            try:
+                f = open(os.path.join(path or MIRROR_DIR, *parts), 'rb')
+            except IOError:
+                self.send_error(404)
+                return
+
+            with f:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length',
+                                 str(os.fstat(f.fileno()).st_size))
+                self.end_headers()
+                shutil.copyfileobj(f, self.wfile, DOWNLOAD_CHUNK)
+
+    class MirrorServer(socketserver.ThreadingMixIn, httpserver.HTTPServer):
+        daemon_threads = True
+
+    return MirrorServer(address, MirrorHandler)
@@ -0,0 +1,136 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import threading
+
+from .utils import monotonic_time
+from .utils import parallel
+
+# Fraction of the vcpus time below which an instance is considered idle
+IDLE_CPU_USAGE = 0.02
+
+POLICY_INTERVAL = 60
+
+GC_INTERVAL = 300
+
+# Kinds of orphans reported by the driver pool_fsck
+ORPHAN_KINDS = ('domains', 'hosts', 'dns', 'images')
+
+
+class IdleTracker(object):
+    def __init__(self, idle, usage=IDLE_CPU_USAGE):
+        self.idle = idle
+        self.usage = usage
+        self._samples = {}
+
+    def update(self, stats, now):
+        # Returns the instances idle for longer than the threshold, given
+        # the cpu stats (driver instance_cpu_stats) sampled at time now.
+        samples = {}
+        idle = []
+
+        for name, stat in stats.items():
+            previous = self._samples.get(name)
+            since = now
+
+            # A decreasing cpu time means that the instance was restarted
+            if previous is not None and stat['cpu_time'] >= previous[1]:
+                available = (now - previous[0]) * max(stat['vcpus'], 1)
+                used = (stat['cpu_time'] - previous[1]) / 1e9
+
+                if used <= available * self.usage:
+                    since = previous[2]
+
+            samples[name] = (now, stat['cpu_time'], since)
+
+            if now - since >= self.idle:
+                idle.append(name)
+
+        # Instances that are not running anymore are forgotten
+        self._samples = samples
+
+        return sorted(idle)
+
+
+def collect_garbage(driver, interval=GC_INTERVAL, stop=None, report=None):
+    if stop is None:
+        stop = threading.Event()
+
+    while not stop.is_set():
+        try:
+            result = driver.pool_gc()
+        except Exception as e:
+            result, error = None, e
+        else:
+            error = None
+
+        if report is not None and (error is not None or result['files'] or
+                                   result.get('ephemeral') or
+                                   result.get('bases')):
+            report(result, error)
+
+        stop.wait(interval)
+
+
+def count_orphans(result):
+    return sum(len(result[x]) for x in ORPHAN_KINDS)
+
+
+def reconcile(driver, interval, stop=None, report=None):
+    if stop is None:
+        stop = threading.Event()
+
+    while not stop.is_set():
+        try:
+            result = driver.pool_fsck(repair=True)
+        except Exception as e:
+            result, error = None, e
+        else:
+            error = None
+
+        if report is not None and (error is not None or
+                                   count_orphans(result)):
+            report(result, error)
+
+        stop.wait(interval)
+
+
+def suspend_idle(driver, idle, interval=POLICY_INTERVAL, stop=None,
+                 report=None):
+    tracker = IdleTracker(idle)
+
+    if stop is None:
+        stop = threading.Event()
+
+    while not stop.is_set():
+        try:
+            names = tracker.update(driver.instance_cpu_stats(),
+                                   monotonic_time())
+            results = parallel(driver.instance_suspend, names)
+        except Exception as e:
+            names, results = [None], [(None, e)]
+
+        for name, (_, error) in zip(names, results):
+            if report is not None:
+                report(name, error)
+
+        stop.wait(interval)
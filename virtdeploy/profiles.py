@@ -0,0 +1,120 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+
+from .errors import InvalidProfile
+
+PROFILE_KEYS = {
+    'update': bool,
+    'packages': list,
+    'files': list,
+    'scripts': list,
+    'commands': list,
+    'ssh_keys': list,
+    'tuning': type(u''),  # json strings are unicode on python 2
+}
+
+# Keys that don't change the content of the template image
+_INSTANCE_KEYS = ('tuning',)
+
+PROFILE_HASH_SIZE = 12
+
+
+def load_profile(path):
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (IOError, ValueError) as e:
+        raise InvalidProfile(path, e)
+
+    profile = validate_profile(profile, path)
+
+    # The files and scripts are relative to the profile, and are opened by
+    # the driver (or the daemon) in another working directory.
+    directory = os.path.dirname(os.path.abspath(path))
+
+    if 'files' in profile:
+        profile['files'] = [
+            os.path.join(directory, x) for x in profile['files']]
+
+    if 'scripts' in profile:
+        profile['scripts'] = [
+            os.path.join(directory, x) for x in profile['scripts']]
+
+    return profile
+
+
+def validate_profile(profile, name='profile'):
+    if not isinstance(profile, dict):
+        raise InvalidProfile(name, 'not a json object')
+
+    for key, value in profile.items():
+        if key not in PROFILE_KEYS:
+            raise InvalidProfile(name, 'unknown key {0}'.format(key))
+
+        if not isinstance(value, PROFILE_KEYS[key]):
+            raise InvalidProfile(name, 'wrong type for {0}'.format(key))
+
+    for upload in profile.get('files', ()):
+        if ':' not in upload:
+            raise InvalidProfile(name, 'files must be SOURCE:DESTINATION')
+
+    return profile
+
+
+def image_profile(profile):
+    # The part of the profile applied to the template image (if any)
+    if not profile:
+        return None
+
+    image = dict((k, v) for k, v in profile.items()
+                 if k not in _INSTANCE_KEYS)
+
+    return image or None
+
+
+def profile_hash(profile):
+    digest = hashlib.sha256()
+    digest.update(json.dumps(profile, sort_keys=True).encode('utf-8'))
+
+    # The content of uploaded files and scripts is part of the profile:
+    # a change in any of them must produce a different golden image.
+    paths = [x.split(':', 1)[0] for x in profile.get('files', ())]
+    paths.extend(profile.get('scripts', ()))
+
+    # Each content is preceded by its path and length, so that moving
+    # data from one file to the next changes the hash as well.
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                digest.update('{0}\0{1}\0'.format(path, size).encode('utf-8'))
+
+                for chunk in iter(lambda: f.read(65536), b''):
+                    digest.update(chunk)
+        except (IOError, OSError) as e:
+            raise InvalidProfile(path, e)
+
+    return digest.hexdigest()[:PROFILE_HASH_SIZE]
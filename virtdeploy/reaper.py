@@ -0,0 +1,48 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import argparse
+import sys
+
+import virtdeploy
+
+DRIVER = 'libvirt'
+
+# The reaper of an ephemeral instance is started (detached) by the driver
+# that created it: it waits for the instance to stop and then releases its
+# disk and network reservations.
+
+
+def main(cmdline=None):
+    parser = argparse.ArgumentParser(prog='virt-deploy-reaper')
+    parser.add_argument('--uri', help='libvirt connection uri')
+    parser.add_argument('name', help='ephemeral instance name')
+
+    args = parser.parse_args(cmdline)
+
+    kwargs = {'uri': args.uri} if args.uri else {}
+    driver = virtdeploy.get_driver(DRIVER, kwargs=kwargs)
+    driver.instance_reap(args.name)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
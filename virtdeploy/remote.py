@@ -0,0 +1,309 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import collections
+import errno
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+from .errors import VirtDeployException
+from .utils import execute
+from .utils import parallel
+from .utils import parse_files
+
+try:
+    from shlex import quote
+except ImportError:  # pragma: no cover
+    from pipes import quote
+
+SSH_OPTIONS = (
+    '-o', 'StrictHostKeychecking=no',
+    '-o', 'UserKnownHostsFile=/dev/null',
+    '-o', 'LogLevel=QUIET',
+)
+
+# The connections to the instances are shared (ssh ControlMaster) and
+# kept open in background: the commands that follow skip the handshake.
+CONTROL_PERSIST = 600
+
+# The addresses of the instances are cached, a failed connection (ssh
+# exit code 255) to a cached address is retried with a fresh one. The
+# entries are dropped when the instances are deleted or (re)created, and
+# when their address is given to another instance.
+ADDRESS_TTL = 300
+ADDRESS_CACHE = 'addresses.json'
+
+SSH_FAILURE = 255
+
+EXEC_WORKERS = 32
+
+
+def control_dir():
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+
+    if runtime:
+        return os.path.join(runtime, 'virt-deploy')
+
+    return os.path.join(tempfile.gettempdir(),
+                        'virt-deploy-{0}'.format(os.getuid()))
+
+
+def _make_control_dir():
+    directory = control_dir()
+
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    return directory
+
+
+def ssh_command(address, user=None, batch=False, stdin=True):
+    directory = _make_control_dir()
+
+    command = ['ssh', '-A']
+    command.extend(SSH_OPTIONS)
+    command.extend(('-o', 'ControlMaster=auto',
+                    '-o', 'ControlPath={0}'.format(
+                        os.path.join(directory, '%C')),
+                    '-o', 'ControlPersist={0}'.format(CONTROL_PERSIST)))
+
+    # No password prompts when running on many instances
+    if batch:
+        command.extend(('-o', 'BatchMode=yes'))
+
+    # The concurrent commands must not consume the input of the caller
+    # (e.g. a shell loop reading it), nor race for the terminal.
+    if not stdin:
+        command.append('-n')
+
+    if user:
+        command.extend(('-l', user))
+
+    command.append(address)
+
+    return command
+
+
+class AddressCache(object):
+    def __init__(self, path=None, ttl=ADDRESS_TTL):
+        self._path = path
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._addresses = None
+
+    def resolve(self, get_driver, name, refresh=False):
+        # Returns the address of the instance and whether it was cached
+        with self._lock:
+            self._load()
+            entry = self._addresses.get(name)
+
+        if (not refresh and entry is not None and
+                time.time() - entry[1] < self._ttl):
+            return entry[0], True
+
+        addresses = get_driver().instance_address(name)
+
+        if not addresses:
+            raise VirtDeployException('No address for {0}'.format(name))
+
+        with self._lock:
+            # The address was reused, the other entry is stale
+            for other, x in list(self._addresses.items()):
+                if x[0] == addresses[0]:
+                    del self._addresses[other]
+
+            self._addresses[name] = (addresses[0], time.time())
+
+        return addresses[0], False
+
+    def forget(self, names):
+        with self._lock:
+            self._load()
+
+            for name in names:
+                self._addresses.pop(name, None)
+
+    def save(self):
+        with self._lock:
+            if self._addresses is None:
+                return
+
+            now = time.time()
+            addresses = dict((k, v) for k, v in self._addresses.items()
+                             if now - v[1] < self._ttl)
+
+        path = self._path or os.path.join(_make_control_dir(), ADDRESS_CACHE)
+        partial = '{0}.{1}.part'.format(path, os.getpid())
+
+        with open(partial, 'w') as f:
+            json.dump(addresses, f)
+
+        os.rename(partial, path)
+
+    def _load(self):
+        if self._addresses is not None:
+            return
+
+        path = self._path or os.path.join(control_dir(), ADDRESS_CACHE)
+
+        try:
+            with open(path) as f:
+                self._addresses = dict((k, tuple(v)) for k, v in
+                                       json.load(f).items())
+        except (IOError, ValueError, AttributeError):
+            self._addresses = {}
+
+
+def forget_addresses(names, cache=None):
+    # The instances were deleted or (re)created
+    cache = cache or AddressCache()
+    cache.forget(names)
+    cache.save()
+
+
+def ssh_call(get_driver, name, arguments=(), user=None, cache=None):
+    # An interactive ssh session (or command) on the instance
+    cache = cache or AddressCache()
+    address, cached = cache.resolve(get_driver, name)
+    cache.save()
+
+    exitcode = subprocess.call(ssh_command(address, user) + list(arguments))
+
+    if exitcode == SSH_FAILURE and cached:
+        address, _ = cache.resolve(get_driver, name, refresh=True)
+        cache.save()
+
+        exitcode = subprocess.call(ssh_command(address, user) +
+                                   list(arguments))
+
+    return exitcode
+
+
+def run_command(address, command, user=None, timeout=None):
+    # Returns the exit code and the output (stdout and stderr) lines
+    lines = []
+
+    try:
+        execute(ssh_command(address, user, batch=True, stdin=False) +
+                [command],
+                callback=lines.append, timeout=timeout)
+    except subprocess.CalledProcessError as e:
+        return e.returncode, lines
+
+    return 0, lines
+
+
+def copy_files(address, files, user=None):
+    # The files (SOURCE:DIRECTORY) are streamed to each directory as a tar
+    # archive, extracted by the remote tar. Returns the exit code and the
+    # output lines of the last failure (if any).
+    directories = collections.OrderedDict()
+
+    for source, directory in parse_files(files):
+        directories.setdefault(directory, []).append(source)
+
+    for directory, sources in directories.items():
+        exitcode, lines = _send_tar(address, directory, sources, user)
+
+        if exitcode != 0:
+            return exitcode, lines
+
+    return 0, []
+
+
+def _send_tar(address, directory, sources, user):
+    # Only needed by the copy command, kept off the cli start-up
+    import tarfile
+
+    command = 'mkdir -p {0} && tar -xf - -C {0}'.format(quote(directory))
+    p = subprocess.Popen(ssh_command(address, user, batch=True) + [command],
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT)
+
+    output = []
+    reader = threading.Thread(target=lambda: output.append(p.stdout.read()))
+    reader.daemon = True
+    reader.start()
+
+    try:
+        with tarfile.open(fileobj=p.stdin, mode='w|') as tar:
+            for source in sources:
+                tar.add(source, os.path.basename(source.rstrip('/')))
+    except IOError as e:
+        # The remote side failed, its exit code tells why
+        if e.errno != errno.EPIPE:
+            p.kill()
+            raise
+    finally:
+        try:
+            p.stdin.close()
+        except IOError:
+            pass
+
+    reader.join()
+    p.wait()
+
+    lines = b''.join(output).decode('utf-8', 'replace').splitlines()
+    return p.returncode, lines
+
+
+def run(get_driver, names, command, user=None, workers=EXEC_WORKERS,
+        timeout=None, cache=None):
+    # Runs the command on the instances concurrently
+    return _fan_out(get_driver, names, lambda x: run_command(
+        x, command, user, timeout), workers, cache)
+
+
+def copy(get_driver, names, files, user=None, workers=EXEC_WORKERS,
+         cache=None):
+    # Copies the files (SOURCE:DIRECTORY) on the instances concurrently
+    return _fan_out(get_driver, names, lambda x: copy_files(
+        x, files, user), workers, cache)
+
+
+def _fan_out(get_driver, names, func, workers, cache):
+    # Each worker gets its own driver (get_driver) for the addresses that
+    # are missing from the cache.
+    cache = cache or AddressCache()
+
+    def target(name):
+        address, cached = cache.resolve(get_driver, name)
+        exitcode, lines = func(address)
+
+        if exitcode == SSH_FAILURE and cached:
+            address, _ = cache.resolve(get_driver, name, refresh=True)
+            exitcode, lines = func(address)
+
+        return {'name': name, 'address': address, 'exitcode': exitcode,
+                'output': lines}
+
+    try:
+        return parallel(target, names, workers)
+    finally:
+        cache.save()
@@ -0,0 +1,82 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import time
+
+from .utils import monotonic_time
+
+STATS_INTERVAL = 2.0
+
+# Counters (driver instance_stats) reported as rates per second
+RATE_COUNTERS = {
+    'block_read': 'block_rd_bytes',
+    'block_write': 'block_wr_bytes',
+    'block_read_iops': 'block_rd_reqs',
+    'block_write_iops': 'block_wr_reqs',
+    'net_rx': 'net_rx_bytes',
+    'net_tx': 'net_tx_bytes',
+}
+
+
+def compute_rates(before, after, elapsed):
+    # The rates of the instances between two samples (elapsed seconds
+    # apart), None when they can't be computed (e.g. a new instance).
+    rates = {}
+
+    for name, stat in after.items():
+        previous = before.get(name)
+        rate = {
+            'vcpus': stat['vcpus'],
+            'memory': stat['memory'],
+            'memory_used': stat['memory_used'],
+        }
+
+        # A decreasing cpu time means that the instance was restarted
+        if (previous is None or elapsed <= 0 or
+                stat['cpu_time'] < previous['cpu_time']):
+            rate['cpu'] = None
+            rate.update((x, None) for x in RATE_COUNTERS)
+        else:
+            rate['cpu'] = ((stat['cpu_time'] - previous['cpu_time']) * 100.0 /
+                           (elapsed * 1e9 * max(stat['vcpus'], 1)))
+            rate.update((k, (stat[v] - previous[v]) / elapsed)
+                        for k, v in RATE_COUNTERS.items())
+
+        rates[name] = rate
+
+    return rates
+
+
+def sample_rates(driver, interval=STATS_INTERVAL, count=None):
+    # Yields (time, rates) every interval seconds, count times (or forever)
+    previous, sampled = driver.instance_stats(), monotonic_time()
+
+    while count is None or count > 0:
+        time.sleep(interval)
+
+        stats, now = driver.instance_stats(), monotonic_time()
+        yield time.time(), compute_rates(previous, stats, now - sampled)
+
+        previous, sampled = stats, now
+
+        if count is not None:
+            count -= 1
@@ -20,13 +20,22 @@
 
 from __future__ import absolute_import
 
+import json
+import os
+import shutil
+import subprocess
 import sys
+import tempfile
 import unittest
 
+from mock import ANY
+from mock import MagicMock
 from mock import patch
 
 from . import cli
 from . import errors
+from . import policy
+from . import utils
 
 
 if sys.version_info[0] == 3:  # pragma: no cover
@@ -38,23 +47,55 @@ else:  # pragma: no cover
 class TestCommandLine(unittest.TestCase):
     HELP_OUTPUT = """\
 usage: python -m unittest [-h] [-v]
-                          {create,start,stop,delete,templates,address,ssh} ...
+                          {create,reset,clone,apply,start,stop,suspend,resume,delete,templates,benchmark,pool,gc,fsck,recover,top,metrics,address,ssh,exec,copy,mirror,serve}
+                          ...
 
 positional arguments:
-  {create,start,stop,delete,templates,address,ssh}
+  {create,reset,clone,apply,start,stop,suspend,resume,delete,templates,benchmark,pool,gc,fsck,recover,top,metrics,address,ssh,exec,copy,mirror,serve}
     create              create a new instance
+    reset               reset an instance disk
+    clone               clone an instance
+    apply               apply an environment file
     start               start an instance
     stop                stop an instance
+    suspend             suspend an instance
+    resume              resume an instance
     delete              delete an instance
     templates           list all the templates
+    benchmark           run an i/o benchmark (fio)
+    pool                storage pool usage
+    gc                  reclaim the deleted disks
+    fsck                find orphan reservations and images
+    recover             resume the interrupted operations
+    top                 instances resource usage
+    metrics             dump the metrics (prometheus)
     address             instance ip address
     ssh                 connects to the instance
+    exec                run a command on instances
+    copy                copy files to instances
+    mirror              template images mirror
+    serve               run the virt-deploy daemon
 
 optional arguments:
   -h, --help            show this help message and exit
   -v, --version         show program's version number and exit
 """
 
+    def setUp(self):
+        # The tests must not be forwarded to a daemon running on the host
+        patcher = patch('virtdeploy.daemon.get_client', return_value=None)
+        self.client_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Nor share the ssh connections and addresses of the host
+        self.control_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.control_dir)
+
+        patcher = patch('virtdeploy.remote.control_dir',
+                        return_value=self.control_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_help(self):
         with patch('sys.stdout', new=StringIO()) as stdout_mock:
             with self.assertRaises(SystemExit) as cm:
@@ -79,6 +120,27 @@ optional arguments:
 
         self.assertEqual(cm.exception.code, 1)
 
+    @patch('sys.stderr')
+    def test_main_command_failure(self, stderr_mock):
+        with patch('virtdeploy.cli.parse_command_line') as func_mock:
+            func_mock.side_effect = subprocess.CalledProcessError(
+                1, ['virt-builder'], 'output tail')
+
+            with self.assertRaises(SystemExit) as cm:
+                cli.main()
+
+        self.assertEqual(cm.exception.code, 1)
+
+    @patch('sys.stderr')
+    def test_main_timeout(self, stderr_mock):
+        with patch('virtdeploy.cli.parse_command_line') as func_mock:
+            func_mock.side_effect = errors.CommandTimeout('virt-builder', 10)
+
+            with self.assertRaises(SystemExit) as cm:
+                cli.main()
+
+        self.assertEqual(cm.exception.code, cli.EXITCODE_TIMEOUT)
+
     def test_main_interrupt(self):
         with patch('virtdeploy.cli.parse_command_line') as func_mock:
             func_mock.side_effect = KeyboardInterrupt
@@ -105,6 +167,77 @@ optional arguments:
         driver_mock.assert_called_with('libvirt')
         instance_create.assert_called_with('test01', 'base01')
 
+    @patch('sys.stdout')
+    @patch('virtdeploy.get_driver')
+    @patch('virtdeploy.profiles.load_profile')
+    def test_instance_create_profile(self, profile_mock, driver_mock,
+                                     stdout_mock):
+        instance_create = driver_mock.return_value.instance_create
+        profile_mock.return_value = {'packages': ['qemu-guest-agent']}
+
+        cli.parse_command_line(['create', '--profile', 'agent.json',
+                                'test01', 'base01'])
+
+        profile_mock.assert_called_with('agent.json')
+        instance_create.assert_called_with(
+            'test01', 'base01', profile={'packages': ['qemu-guest-agent']})
+
+    @patch('sys.stdout')
+    @patch('virtdeploy.get_driver')
+    def test_instance_create_snapshot(self, driver_mock, stdout_mock):
+        instance_create = driver_mock.return_value.instance_create
+
+        cli.parse_command_line(['create', '--snapshot', 'test01', 'base01'])
+
+        instance_create.assert_called_with('test01', 'base01', snapshot=True)
+
+    @patch('sys.stdout')
+    @patch('virtdeploy.get_driver')
+    def test_instance_create_tuning(self, driver_mock, stdout_mock):
+        instance_create = driver_mock.return_value.instance_create
+
+        cli.parse_command_line(['create', '--tuning', 'latency',
+                                '--disk-bus', 'virtio', '--iothreads', '2',
+                                'test01', 'base01'])
+
+        instance_create.assert_called_with('test01', 'base01',
+                                           tuning='latency',
+                                           disk_bus='virtio', iothreads=2)
+
+    @patch('sys.stdout')
+    @patch('virtdeploy.get_driver')
+    def test_instance_create_overlay(self, driver_mock, stdout_mock):
+        instance_create = driver_mock.return_value.instance_create
+
+        cli.parse_command_line(['create', '--overlay', 'cluster_size=64k',
+                                '--overlay', 'preallocation=off',
+                                '--sparsify', 'test01', 'base01'])
+
+        instance_create.assert_called_with(
+            'test01', 'base01', sparsify=True,
+            overlay={'cluster_size': '64k', 'preallocation': 'off'})
+
+    @patch('sys.stdout')
+    @patch('virtdeploy.get_driver')
+    def test_instance_create_ephemeral(self, driver_mock, stdout_mock):
+        instance_create = driver_mock.return_value.instance_create
+
+        cli.parse_command_line(['create', '--ephemeral', '--scratch',
+                                '/scratch', 'test01', 'base01'])
+
+        instance_create.assert_called_with('test01', 'base01',
+                                           ephemeral=True, scratch='/scratch')
+
+    @patch('sys.stdout')
+    @patch('virtdeploy.get_driver')
+    def test_instance_create_progress(self, driver_mock, stdout_mock):
+        instance_create = driver_mock.return_value.instance_create
+
+        cli.parse_command_line(['create', '--progress', 'test01', 'base01'])
+
+        instance_create.assert_called_with('test01', 'base01',
+                                           progress=cli.print_progress)
+
     @patch('sys.stderr')
     @patch('virtdeploy.get_driver')
     def test_instance_create_fail1(self, driver_mock, stderr_mock):
@@ -125,11 +258,20 @@ optional arguments:
     def test_instance_delete(self, driver_mock):
         instance_delete = driver_mock.return_value.instance_delete
 
+        cache = cli.remote.AddressCache()
+        cache.resolve(lambda: MagicMock(**{
+            'instance_address.return_value': ['10.0.0.1']}), 'test01')
+        cache.save()
+
         cli.parse_command_line(['delete', 'test01'])
 
         driver_mock.assert_called_with('libvirt')
         instance_delete.assert_called_with('test01')
 
+        # The address of the deleted instance is no longer cached
+        self.assertEqual(cli.remote.AddressCache().resolve(
+            driver_mock, 'test01'), (ANY, False))
+
     @patch('sys.stdout')
     @patch('virtdeploy.get_driver')
     def test_instance_address(self, driver_mock, stdout_mock):
@@ -150,10 +292,10 @@ optional arguments:
         instance_start.assert_called_with('test01')
 
     @patch('virtdeploy.get_driver')
-    @patch('virtdeploy.utils.wait_tcp_access')
+    @patch('virtdeploy.utils.wait_instance')
     def test_instance_start_wait_success(self, wait_mock, driver_mock):
         instance_start = driver_mock.return_value.instance_start
-        wait_mock.return_value = '192.168.122.2'
+        wait_mock.return_value = True
 
         cli.parse_command_line(['start', '--wait', 'test01'])
 
@@ -162,10 +304,10 @@ optional arguments:
         wait_mock.assert_called_with(driver_mock.return_value, 'test01')
 
     @patch('virtdeploy.get_driver')
-    @patch('virtdeploy.utils.wait_tcp_access')
+    @patch('virtdeploy.utils.wait_instance')
     def test_instance_start_wait_fail(self, wait_mock, driver_mock):
         instance_start = driver_mock.return_value.instance_start
-        wait_mock.return_value = None
+        wait_mock.return_value = False
 
         cli.parse_command_line(['start', '--wait', 'test01'])
 
@@ -182,6 +324,228 @@ optional arguments:
         driver_mock.assert_called_with('libvirt')
         instance_stop.assert_called_with('test01')
 
+    @patch('virtdeploy.get_driver')
+    def test_instance_stop_many(self, driver_mock):
+        instance_stop = driver_mock.return_value.instance_stop
+
+        cli.parse_command_line(['stop', 'test01', 'test02'])
+
+        self.assertEqual(instance_stop.call_count, 2)
+        instance_stop.assert_called_with('test02')
+
+    @patch('sys.stderr')
+    @patch('virtdeploy.get_driver')
+    def test_instance_stop_wait(self, driver_mock, stderr_mock):
+        instance_stop_wait = driver_mock.return_value.instance_stop_wait
+        instance_stop_wait.return_value = {'test01': 'shutdown',
+                                           'test02': 'destroyed'}
+
+        retvalue = cli.parse_command_line(['stop', '--wait', '--grace', '30',
+                                           'test01', 'test02'])
+
+        self.assertEqual(retvalue, cli.EXITCODE_SUCCESS)
+        instance_stop_wait.assert_called_with(['test01', 'test02'], 30)
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('virtdeploy.get_driver')
+    def test_instance_reset(self, driver_mock, stderr_mock, stdout_mock):
+        def instance_reset(name):
+            if name == 'test02':
+                raise errors.InstanceNotFound(name)
+            return {'name': name, 'password': 'secret',
+                    'mac': '52:54:00:a0:b0:01', 'hostname': 'vm-test01',
+                    'ipaddress': '192.168.122.2'}
+
+        instance_reset_mock = driver_mock.return_value.instance_reset
+        instance_reset_mock.side_effect = instance_reset
+
+        retvalue = cli.parse_command_line(['reset', 'test01', 'test02'])
+
+        self.assertEqual(retvalue, cli.EXITCODE_FAILURE)
+        self.assertEqual(instance_reset_mock.call_count, 2)
+        self.assertIn('name: test01', stdout_mock.getvalue())
+        self.assertEqual(stderr_mock.getvalue(),
+                         'test02: No such instance: test02\n')
+
+    @patch('sys.stdout')
+    @patch('sys.stderr')
+    @patch('virtdeploy.get_driver')
+    def test_instance_clone(self, driver_mock, stderr_mock, stdout_mock):
+        instance_clone = driver_mock.return_value.instance_clone
+        instance_clone.return_value = {
+            'base': '_base.qcow2',
+            'instances': [{'name': 'test01-1-base01-x86_64',
+                           'password': 'secret', 'mac': '52:54:00:00:00:01',
+                           'hostname': 'vm-test01-1',
+                           'ipaddress': '10.0.0.2'}],
+            'errors': {'test01-2': 'failure'},
+        }
+
+        exitcode = cli.parse_command_line(['clone', '--count', '2',
+                                           'test01-base01-x86_64'])
+
+        instance_clone.assert_called_with('test01-base01-x86_64', 2, None,
+                                          cli.utils.PARALLEL_WORKERS)
+        self.assertEqual(exitcode, cli.EXITCODE_FAILURE)
+        stderr_mock.write.assert_any_call('test01-2: failure')
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('virtdeploy.get_driver')
+    def test_command_apply(self, driver_mock, stdout_mock):
+        driver = driver_mock.return_value
+        driver.instance_list.return_value = [
+            {'name': 'old01-fedora-21-x86_64', 'env': 'test',
+             'instance': 'old01', 'spec': 'x'}]
+        driver.instance_create.return_value = {
+            'name': 'test-db01-fedora-21-x86_64', 'password': 'secret',
+            'mac': '52:54:00:00:00:01', 'hostname': 'vm-test-db01',
+            'ipaddress': '10.0.0.2'}
+
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.json') as f:
+            json.dump({'name': 'test', 'instances': [
+                {'id': 'db01', 'template': 'fedora-21'}]}, f)
+            f.flush()
+
+            exitcode = cli.parse_command_line(['apply', '--dry-run', f.name])
+            self.assertFalse(driver.instance_create.called)
+
+            cli.parse_command_line(['apply', f.name])
+
+        self.assertIsNone(exitcode)
+        self.assertIn('create: test-db01-fedora-21-x86_64\n'
+                      'delete: old01-fedora-21-x86_64\n',
+                      stdout_mock.getvalue())
+        driver.instance_delete.assert_called_once_with(
+            'old01-fedora-21-x86_64')
+        self.assertEqual(driver.instance_create.call_count, 1)
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('virtdeploy.get_driver')
+    def test_journal_recover(self, driver_mock, stderr_mock, stdout_mock):
+        journal_recover = driver_mock.return_value.journal_recover
+        journal_recover.return_value = {
+            'instances': [], 'rolledback': ['test01-fedora-21-x86_64'],
+            'errors': {'test02-fedora-21-x86_64': 'failure'}}
+
+        exitcode = cli.parse_command_line(['recover', '--rollback'])
+
+        journal_recover.assert_called_once_with(None, True)
+        self.assertEqual(exitcode, cli.EXITCODE_FAILURE)
+        self.assertEqual(stdout_mock.getvalue(),
+                         'rolled back: test01-fedora-21-x86_64\n')
+        self.assertEqual(stderr_mock.getvalue(),
+                         'test02-fedora-21-x86_64: failure\n')
+
+    @patch('virtdeploy.get_driver')
+    def test_instance_suspend_resume(self, driver_mock):
+        driver = driver_mock.return_value
+
+        cli.parse_command_line(['suspend', 'test01', 'test02'])
+        cli.parse_command_line(['resume', 'test01'])
+
+        self.assertEqual(driver.instance_suspend.call_count, 2)
+        driver.instance_resume.assert_called_once_with('test01')
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('virtdeploy.get_driver')
+    def test_instance_benchmark(self, driver_mock, stdout_mock):
+        instance_benchmark = driver_mock.return_value.instance_benchmark
+        instance_benchmark.return_value = {
+            'tuning': 'latency', 'read_iops': 10000, 'write_iops': 9000,
+            'read_bw': 40000, 'write_bw': 36000, 'read_latency': 3100,
+            'write_latency': 3500}
+
+        cli.parse_command_line(['benchmark', '--runtime', '10',
+                                'test01', 'test02'])
+
+        instance_benchmark.assert_called_with('test02', 10)
+        lines = stdout_mock.getvalue().splitlines()
+
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[1].split(), ['test01', 'latency', '10000',
+                                            '9000', '3100us', '3500us'])
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('virtdeploy.get_driver')
+    def test_pool_info(self, driver_mock, stdout_mock):
+        driver_mock.return_value.pool_info.return_value = {
+            'name': 'default', 'capacity': 100 * 1024 ** 3,
+            'allocation': 40 * 1024 ** 3, 'available': 60 * 1024 ** 3,
+            'trash': 10 * 1024 ** 3}
+
+        cli.parse_command_line(['pool'])
+
+        driver_mock.return_value.pool_info.assert_called_with(None)
+        self.assertIn('trash: 10.0 GiB', stdout_mock.getvalue())
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('virtdeploy.get_driver')
+    def test_pool_gc(self, driver_mock, stdout_mock):
+        pool_gc = driver_mock.return_value.pool_gc
+        pool_gc.return_value = {'files': 1, 'bytes': 1024, 'bases': 2}
+
+        cli.parse_command_line(['gc', '--pool', 'images', '--rate', '64',
+                                '--age', '3600'])
+
+        pool_gc.assert_called_with('images', 64 * 1024 * 1024, 3600)
+        self.assertIn('trashed 2 unused clone bases', stdout_mock.getvalue())
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('virtdeploy.get_driver')
+    def test_pool_fsck(self, driver_mock, stdout_mock):
+        pool_fsck = driver_mock.return_value.pool_fsck
+        pool_fsck.return_value = {
+            'domains': ['test01-base01-x86_64'],
+            'hosts': [{'network': 'default', 'name': 'vm-test02',
+                       'mac': '52:54:00:00:00:02', 'ip': '10.0.0.2'}],
+            'dns': [],
+            'images': [],
+        }
+
+        exitcode = cli.parse_command_line(['fsck'])
+
+        pool_fsck.assert_called_with(None, False)
+        self.assertEqual(exitcode, cli.EXITCODE_FAILURE)
+        self.assertEqual(stdout_mock.getvalue().splitlines(), [
+            'orphan domain: test01-base01-x86_64',
+            'orphan dhcp host: vm-test02 52:54:00:00:00:02 10.0.0.2 '
+            '(default)',
+            '2 orphans found (--repair to remove them)'])
+
+        self.assertIsNone(cli.parse_command_line(['fsck', '--repair']))
+        pool_fsck.assert_called_with(None, True)
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('time.sleep')
+    @patch('virtdeploy.get_driver')
+    def test_top_stream(self, driver_mock, sleep_mock, stdout_mock):
+        stat = {'cpu_time': 0, 'vcpus': 1, 'memory': 0, 'memory_used': 0,
+                'block_rd_bytes': 0, 'block_wr_bytes': 0,
+                'block_rd_reqs': 0, 'block_wr_reqs': 0,
+                'net_rx_bytes': 0, 'net_tx_bytes': 0}
+        driver_mock.return_value.instance_stats.return_value = {
+            'test01': stat}
+
+        cli.parse_command_line(['top', '--stream', '--count', '2',
+                                '--interval', '5'])
+
+        lines = stdout_mock.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(list(json.loads(lines[0])['instances']), ['test01'])
+        sleep_mock.assert_called_with(5.0)
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('time.sleep')
+    @patch('virtdeploy.get_driver')
+    def test_top(self, driver_mock, sleep_mock, stdout_mock):
+        driver_mock.return_value.instance_stats.return_value = {}
+
+        cli.parse_command_line(['top', '--count', '1'])
+
+        self.assertTrue(stdout_mock.getvalue().startswith('NAME'))
+
     @patch('sys.stdout')
     @patch('virtdeploy.get_driver')
     def test_template_list(self, driver_mock, stdout_mock):
@@ -196,31 +560,245 @@ optional arguments:
         driver_mock.assert_called_with('libvirt')
         template_list.assert_called_with()
 
+    def _ssh_command(self, *args):
+        return ['ssh', '-A',
+                '-o', 'StrictHostKeychecking=no',
+                '-o', 'UserKnownHostsFile=/dev/null',
+                '-o', 'LogLevel=QUIET',
+                '-o', 'ControlMaster=auto',
+                '-o', 'ControlPath={0}/%C'.format(self.control_dir),
+                '-o', 'ControlPersist={0}'.format(
+                    cli.remote.CONTROL_PERSIST)] + list(args)
+
     @patch('virtdeploy.get_driver')
     def test_instance_ssh(self, driver_mock):
         instance_address = driver_mock.return_value.instance_address
         instance_address.return_value = ['192.168.122.2']
 
-        with patch('subprocess.call') as call_mock:
+        with patch('subprocess.call', return_value=0) as call_mock:
             cli.parse_command_line(['ssh', 'test01'])
+            cli.parse_command_line(['ssh', 'test01', 'uptime'])
+
+        call_mock.assert_called_with(self._ssh_command('192.168.122.2',
+                                                       'uptime'))
 
-        call_mock.assert_called_with(['ssh', '-A',
-                                      '-o', 'StrictHostKeychecking=no',
-                                      '-o', 'UserKnownHostsFile=/dev/null',
-                                      '-o', 'LogLevel=QUIET',
-                                      '192.168.122.2'])
+        # The address is cached
+        instance_address.assert_called_once_with('test01')
 
     @patch('virtdeploy.get_driver')
     def test_instance_ssh_user(self, driver_mock):
         instance_address = driver_mock.return_value.instance_address
         instance_address.return_value = ['192.168.122.3']
 
-        with patch('subprocess.call') as call_mock:
+        with patch('subprocess.call', return_value=0) as call_mock:
             cli.parse_command_line(['ssh', 'root@test02'])
 
-        call_mock.assert_called_with(['ssh', '-A',
-                                      '-o', 'StrictHostKeychecking=no',
-                                      '-o', 'UserKnownHostsFile=/dev/null',
-                                      '-o', 'LogLevel=QUIET',
-                                      '-l', 'root',
-                                      '192.168.122.3'])
+        call_mock.assert_called_with(self._ssh_command('-l', 'root',
+                                                       '192.168.122.3'))
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('virtdeploy.get_driver')
+    def test_command_exec(self, driver_mock, stderr_mock, stdout_mock):
+        driver_mock.return_value.instance_list.return_value = [
+            {'name': 'test01', 'active': True},
+            {'name': 'test02', 'active': True},
+            {'name': 'test03', 'active': False}]
+
+        def run_command(address, command, user, timeout):
+            return int(address[-1]), ['up {0}'.format(address)]
+
+        driver_mock.return_value.instance_address.side_effect = (
+            lambda name: ['10.0.0.{0}'.format(name[-1])])
+
+        with patch.object(cli.remote, 'run_command',
+                          side_effect=run_command):
+            exitcode = cli.parse_command_line(['exec', '--all', 'uptime'])
+
+        self.assertEqual(exitcode, cli.EXITCODE_FAILURE)
+        self.assertEqual(stdout_mock.getvalue(),
+                         'test01: up 10.0.0.1\ntest02: up 10.0.0.2\n')
+        self.assertEqual(stderr_mock.getvalue(),
+                         'test01: exit code 1\ntest02: exit code 2\n')
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('virtdeploy.get_driver')
+    def test_command_copy(self, driver_mock, stdout_mock):
+        driver = driver_mock.return_value
+        driver.instance_list.return_value = [
+            {'name': 'test01', 'active': True},
+            {'name': 'test02', 'active': False}]
+        driver.instance_address.return_value = ['10.0.0.1']
+
+        with patch.object(cli.remote, 'copy_files',
+                          return_value=(0, [])) as copy_mock:
+            exitcode = cli.parse_command_line([
+                'copy', '-f', 'rpms:/opt', 'test01', 'test02'])
+
+        files = ['{0}:/opt'.format(os.path.abspath('rpms'))]
+
+        self.assertEqual(exitcode, cli.EXITCODE_SUCCESS)
+        copy_mock.assert_called_once_with('10.0.0.1', files, None)
+        driver.instance_copy_in.assert_called_once_with('test02', files)
+        self.assertEqual(stdout_mock.getvalue(), 'test01: copied (ssh)\n'
+                                                 'test02: copied (disk)\n')
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('virtdeploy.get_driver')
+    def test_command_copy_saved(self, driver_mock, stdout_mock):
+        driver = driver_mock.return_value
+        driver.instance_list.return_value = [
+            {'name': 'test01', 'active': False, 'saved': True}]
+        driver.instance_address.return_value = ['10.0.0.1']
+
+        with patch.object(cli.remote, 'copy_files',
+                          return_value=(0, [])) as copy_mock:
+            exitcode = cli.parse_command_line([
+                'copy', '-f', 'rpms:/opt', 'test01'])
+
+        # The suspended instances are resumed and reached over ssh
+        self.assertEqual(exitcode, cli.EXITCODE_SUCCESS)
+        driver.instance_resume.assert_called_once_with('test01')
+        self.assertTrue(copy_mock.called)
+        self.assertFalse(driver.instance_copy_in.called)
+        self.assertEqual(stdout_mock.getvalue(), 'test01: copied (ssh)\n')
+
+    @patch('virtdeploy.get_driver')
+    def test_daemon_forward(self, driver_mock):
+        client = self.client_mock.return_value = MagicMock()
+
+        cli.parse_command_line(['start', 'test01'])
+
+        self.assertFalse(driver_mock.called)
+        client.instance_start.assert_called_with('test01')
+
+    @patch('threading.Thread')
+    @patch('virtdeploy.get_driver')
+    @patch('virtdeploy.daemon.VirtDeployServer')
+    def test_serve(self, server_mock, driver_mock, thread_mock):
+        cli.parse_command_line(['serve', '--socket', '/tmp/test.sock'])
+
+        server_mock.assert_called_once_with('/tmp/test.sock',
+                                            driver_mock.return_value)
+        server_mock.return_value.serve_forever.assert_called_once_with()
+        server_mock.return_value.server_close.assert_called_once_with()
+
+        # The trash reclaim runs by default
+        self.assertEqual(thread_mock.call_args[1]['target'],
+                         policy.collect_garbage)
+        self.assertEqual(thread_mock.call_args[1]['args'],
+                         (driver_mock.return_value, policy.GC_INTERVAL))
+
+    @patch('threading.Thread')
+    @patch('virtdeploy.get_driver')
+    @patch('virtdeploy.daemon.VirtDeployServer')
+    def test_serve_policies(self, server_mock, driver_mock, thread_mock):
+        cli.parse_command_line(['serve', '--socket', '/tmp/test.sock',
+                                '--suspend-idle', '600', '--gc-interval', '0'])
+
+        thread_mock.assert_called_once_with(
+            target=policy.suspend_idle, args=(driver_mock.return_value, 600),
+            kwargs={'stop': ANY, 'report': ANY})
+
+    @patch('threading.Thread')
+    @patch('virtdeploy.metrics.make_server')
+    @patch('virtdeploy.get_driver')
+    @patch('virtdeploy.daemon.VirtDeployServer')
+    def test_serve_metrics(self, server_mock, driver_mock, exporter_mock,
+                           thread_mock):
+        cli.parse_command_line(['serve', '--socket', '/tmp/test.sock',
+                                '--gc-interval', '0', '--metrics-port',
+                                '9100'])
+
+        exporter_mock.assert_called_once_with(
+            ('127.0.0.1', 9100), driver_mock.return_value.metrics_collect)
+        thread_mock.assert_called_once_with(
+            target=exporter_mock.return_value.serve_forever)
+        exporter_mock.return_value.shutdown.assert_called_once_with()
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('virtdeploy.get_driver')
+    def test_metrics(self, driver_mock, stdout_mock):
+        driver_mock.return_value.metrics_collect.return_value = 'test 1\n'
+
+        cli.parse_command_line(['metrics'])
+
+        self.assertEqual(stdout_mock.getvalue(), 'test 1\n')
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('virtdeploy.mirror.Mirror.sync')
+    def test_mirror_sync(self, sync_mock, stdout_mock):
+        sync_mock.return_value = {'downloaded': ['fedora-21 (x86_64)'],
+                                  'present': [], 'bytes': 2 * 1024 ** 2}
+
+        cli.parse_command_line(['mirror', 'sync', 'fedora-21'])
+
+        sync_mock.assert_called_once_with(None, ['fedora-21'], None)
+        self.assertEqual(stdout_mock.getvalue(),
+                         'downloaded: fedora-21 (x86_64)\n'
+                         '{0} downloaded\n'.format(
+                             utils.format_size(2 * 1024 ** 2)))
+
+    @patch('virtdeploy.mirror.make_server')
+    def test_mirror_serve(self, server_mock):
+        cli.parse_command_line(['mirror', '--path', '/srv/mirror', 'serve'])
+
+        server_mock.assert_called_once_with(('', 8100), '/srv/mirror')
+        server_mock.return_value.serve_forever.assert_called_once_with()
+        server_mock.return_value.server_close.assert_called_once_with()
+
+    @patch('virtdeploy.daemon.VirtDeployServer')
+    def test_serve_running(self, server_mock):
+        self.client_mock.return_value = MagicMock()
+
+        with self.assertRaises(errors.VirtDeployException):
+            cli.parse_command_line(['serve', '--socket', '/tmp/test.sock'])
+
+        self.assertFalse(server_mock.called)
+
+
+class TestStartup(unittest.TestCase):
+    # Modules that are slow to import and must stay off the cli start-up
+    SLOW_MODULES = ('pkg_resources', 'libvirt', 'lxml', 'netaddr')
+
+    # Generous upper bound for importing the cli in a fresh interpreter,
+    # meant to catch gross regressions and not to benchmark the host.
+    IMPORT_BUDGET = 1.0
+
+    IMPORT_SCRIPT = """\
+import sys, time
+start = time.time()
+import virtdeploy.cli
+print(time.time() - start)
+print(' '.join(sys.modules))
+"""
+
+    def test_startup_imports(self):
+        self._check_imports(self.IMPORT_SCRIPT)
+
+    def test_driver_imports(self):
+        # libvirt and lxml are imported on first use by the driver
+        self._check_imports(self.IMPORT_SCRIPT.replace(
+            'virtdeploy.cli', 'virtdeploy.drivers.libvirt'))
+
+    def _check_imports(self, script):
+        output = subprocess.check_output([sys.executable, '-c', script])
+
+        elapsed, modules = output.decode('utf-8').splitlines()
+        modules = set(x.split('.')[0] for x in modules.split())
+
+        for name in self.SLOW_MODULES:
+            self.assertNotIn(name, modules)
+
+        self.assertLess(float(elapsed), self.IMPORT_BUDGET)
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('virtdeploy.cli.get_version')
+    def test_version(self, version_mock, stdout_mock):
+        version_mock.return_value = '1.0'
+
+        with self.assertRaises(SystemExit) as cm:
+            cli.parse_command_line(['--version'])
+
+        self.assertEqual(cm.exception.code, 0)
+        self.assertTrue(stdout_mock.getvalue().endswith(' 1.0\n'))
@@ -0,0 +1,171 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from mock import MagicMock
+
+from . import daemon
+from . import errors
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.sock')
+        self.driver = MagicMock()
+        self.server = daemon.VirtDeployServer(self.path, self.driver)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.05,))
+        self.thread.start()
+        self.client = daemon.get_client(self.path)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def test_call(self):
+        self.driver.template_list.return_value = [{'id': 'fedora-21'}]
+
+        self.assertEqual(self.client.template_list(), [{'id': 'fedora-21'}])
+        self.driver.template_list.assert_called_once_with()
+
+    def test_call_params(self):
+        self.driver.instance_address.return_value = ['192.168.122.2']
+
+        self.assertEqual(self.client.instance_address('test01'),
+                         ['192.168.122.2'])
+        self.driver.instance_address.assert_called_once_with(
+            vmid='test01', network=None)
+
+    def test_call_error(self):
+        self.driver.instance_start.side_effect = \
+            errors.InstanceNotFound('test01')
+
+        with self.assertRaises(errors.InstanceNotFound) as cm:
+            self.client.instance_start('test01')
+
+        self.assertEqual(str(cm.exception), 'No such instance: test01')
+
+    def test_call_error_type(self):
+        self.driver.instance_create.side_effect = [
+            errors.CommandTimeout('virt-install', 300),
+            errors.InvalidProfile('test.json', IOError('missing')),
+            subprocess.CalledProcessError(1, ('virt-customize', '-a'),
+                                          b'error: no space'),
+            ValueError('unexpected')]
+
+        with self.assertRaises(errors.CommandTimeout) as cm:
+            self.client.instance_create('test01', 'fedora-21')
+
+        self.assertEqual(str(cm.exception),
+                         'Command virt-install timed out after 300 seconds')
+
+        with self.assertRaises(errors.InvalidProfile) as cm:
+            self.client.instance_create('test01', 'fedora-21')
+
+        self.assertEqual(str(cm.exception),
+                         'Invalid profile test.json: missing')
+
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            self.client.instance_create('test01', 'fedora-21')
+
+        self.assertEqual(cm.exception.returncode, 1)
+        self.assertEqual(cm.exception.output, 'error: no space')
+
+        with self.assertRaises(errors.VirtDeployException) as cm:
+            self.client.instance_create('test01', 'fedora-21')
+
+        self.assertEqual(str(cm.exception), 'unexpected')
+
+    def test_call_cancel(self):
+        cancelled = threading.Event()
+
+        def instance_create(vmid, template, cancel):
+            if cancel.wait(5):
+                cancelled.set()
+
+        self.driver.instance_create.side_effect = instance_create
+
+        # The client is gone (e.g. ctrl-c) while the creation runs
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall(json.dumps({
+            'jsonrpc': '2.0', 'id': 1, 'method': 'instance_create',
+            'params': {'vmid': 'test01', 'template': 'fedora-21'}})
+            .encode('utf-8') + b'\n')
+        sock.close()
+
+        self.assertTrue(cancelled.wait(5))
+
+    def test_socket_mode(self):
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_call_progress(self):
+        events = []
+
+        def instance_create(vmid, template, progress, cancel):
+            progress({'instance': vmid, 'stage': 'build'})
+            return {'name': vmid}
+
+        self.driver.instance_create.side_effect = instance_create
+
+        instance = self.client.instance_create('test01', 'fedora-21',
+                                               progress=events.append)
+
+        self.assertEqual(instance, {'name': 'test01'})
+        self.assertEqual(events, [{'instance': 'test01', 'stage': 'build'}])
+
+    def test_method_not_found(self):
+        with self.assertRaises(errors.VirtDeployException):
+            self.client._call('server_close')
+
+        self.assertFalse(self.driver.server_close.called)
+
+
+class TestGetClient(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_client_missing(self):
+        self.assertIs(daemon.get_client(self.path), None)
+
+    def test_get_client_stale(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.close()
+
+        self.assertIs(daemon.get_client(self.path), None)
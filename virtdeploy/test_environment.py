@@ -0,0 +1,186 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock
+
+from . import environment
+from . import errors
+
+
+class TestEnvironment(unittest.TestCase):
+    ENVIRONMENT = {
+        'name': 'test',
+        'instances': [
+            {'id': 'db01', 'template': 'fedora-21', 'memory': 2048},
+            {'id': 'web01', 'template': 'fedora-21', 'depends': ['db01']},
+        ],
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def _instances(self, **changes):
+        # The instances (driver instance_list) of the environment as it is
+        instances = []
+
+        for instance in self.ENVIRONMENT['instances']:
+            spec = environment.instance_spec(
+                dict(instance, **changes.get(instance['id'], {})))
+            instances.append({'name': environment.instance_name('test',
+                                                                instance),
+                              'env': 'test', 'instance': instance['id'],
+                              'spec': spec})
+
+        return instances
+
+    def test_load_environment(self):
+        path = self._write('env.json', json.dumps(self.ENVIRONMENT))
+        self.assertEqual(environment.load_environment(path), self.ENVIRONMENT)
+
+    def test_load_environment_profile_path(self):
+        env = {'name': 'test', 'instances': [
+            {'id': 'db01', 'template': 'fedora-21', 'profile': 'db.json'}]}
+        path = self._write('env.json', json.dumps(env))
+
+        self.assertEqual(
+            environment.load_environment(path)['instances'][0]['profile'],
+            os.path.join(self.tmpdir, 'db.json'))
+
+    def test_load_environment_invalid(self):
+        path = self._write('env.json', '{')
+
+        with self.assertRaises(errors.InvalidEnvironment):
+            environment.load_environment(path)
+
+    def test_validate_environment_failures(self):
+        for instances in ([{'id': 'db01'}],
+                          [{'id': 'db01', 'template': 'f', 'cpus': '2'}],
+                          [{'id': 'db01', 'template': 'f', 'unknown': 1}],
+                          [{'id': 'db01', 'template': 'f'},
+                           {'id': 'db01', 'template': 'f'}],
+                          [{'id': 'db01', 'template': 'f',
+                            'depends': ['web01']}],
+                          [{'id': 'db01', 'template': 'f',
+                            'depends': ['web01']},
+                           {'id': 'web01', 'template': 'f',
+                            'depends': ['db01']}],
+                          [{'id': 'db_01', 'template': 'f'}]):
+            with self.assertRaises(errors.InvalidEnvironment):
+                environment.validate_environment({'name': 'test',
+                                                  'instances': instances})
+
+    def test_validate_environment_name(self):
+        for name in ('', 'my_env', '-test', 'test.lab'):
+            with self.assertRaises(errors.InvalidEnvironment):
+                environment.validate_environment(
+                    dict(self.ENVIRONMENT, name=name))
+
+    def test_validate_environment_str(self):
+        # yaml strings are str (not unicode) on python 2
+        env = {'name': str('test'), 'instances': [
+            {'id': str('db01'), 'template': str('fedora-21')}]}
+        self.assertEqual(environment.validate_environment(env), env)
+
+    def test_instance_spec(self):
+        instance = self.ENVIRONMENT['instances'][1]
+
+        # The dependencies are not part of the instance definition
+        self.assertEqual(environment.instance_spec(instance),
+                         environment.instance_spec({'id': 'other',
+                                                    'template': 'fedora-21'}))
+        self.assertNotEqual(environment.instance_spec(instance),
+                            environment.instance_spec(
+                                dict(instance, cpus=4)))
+
+    def test_plan_environment(self):
+        instances = self._instances(web01={'cpus': 4})
+        instances.append({'name': 'old01-fedora-21-x86_64', 'env': 'test',
+                          'instance': 'old01', 'spec': 'x'})
+        instances.append({'name': 'other01-fedora-21-x86_64',
+                          'env': 'other', 'instance': 'db01', 'spec': 'x'})
+
+        plan = environment.plan_environment(self.ENVIRONMENT, instances)
+
+        self.assertEqual([(x['action'], x['id']) for x in plan],
+                         [('keep', 'db01'), ('recreate', 'web01'),
+                          ('delete', 'old01')])
+        self.assertEqual(plan[2]['existing'], 'old01-fedora-21-x86_64')
+
+    def test_plan_environment_reset(self):
+        plan = environment.plan_environment(self.ENVIRONMENT,
+                                            self._instances(), reset=True)
+
+        self.assertEqual([x['action'] for x in plan], ['reset', 'reset'])
+
+    def test_plan_environment_pending(self):
+        instances = self._instances()
+        instances[0]['pending'] = 'create'
+        instances[1]['pending'] = 'reset'
+
+        plan = environment.plan_environment(self.ENVIRONMENT, instances)
+
+        self.assertEqual([x['action'] for x in plan], ['create', 'reset'])
+
+    def test_apply_plan(self):
+        driver = MagicMock()
+        instances = self._instances()[1:]
+        instances.append({'name': 'old01-fedora-21-x86_64', 'env': 'test',
+                          'instance': 'old01', 'spec': 'x'})
+
+        plan = environment.plan_environment(self.ENVIRONMENT, instances)
+        results = environment.apply_plan(lambda: driver, self.ENVIRONMENT,
+                                         plan)
+
+        self.assertEqual(sorted(results), ['db01', 'old01'])
+        driver.instance_delete.assert_called_once_with(
+            'old01-fedora-21-x86_64')
+        self.assertEqual(plan[0]['name'], 'test-db01-fedora-21-x86_64')
+        driver.instance_create.assert_called_once_with(
+            'test-db01', template='fedora-21', memory=2048,
+            labels={'env': 'test', 'instance': 'db01',
+                    'spec': plan[0]['spec']})
+
+    def test_apply_plan_dependency_failure(self):
+        driver = MagicMock()
+        driver.instance_create.side_effect = errors.VirtDeployException('x')
+
+        plan = environment.plan_environment(self.ENVIRONMENT, [])
+        results = environment.apply_plan(lambda: driver, self.ENVIRONMENT,
+                                         plan)
+
+        self.assertEqual(driver.instance_create.call_count, 1)
+        self.assertIn('db01', str(results['web01'][1]))
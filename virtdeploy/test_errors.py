@@ -29,3 +29,15 @@ class TestCommandLine(unittest.TestCase):
     def test_instance_not_found(self):
         self.assertEqual(str(errors.InstanceNotFound('test01')),
                          'No such instance: test01')
+
+    def test_invalid_profile(self):
+        self.assertEqual(str(errors.InvalidProfile('p.json', 'bad key')),
+                         'Invalid profile p.json: bad key')
+
+    def test_command_timeout(self):
+        self.assertEqual(str(errors.CommandTimeout('virt-builder', 60)),
+                         'Command virt-builder timed out after 60 seconds')
+
+    def test_operation_in_progress(self):
+        self.assertEqual(str(errors.OperationInProgress('test01', 'create')),
+                         'Operation create in progress on test01')
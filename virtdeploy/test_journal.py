@@ -0,0 +1,116 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+from . import errors
+from . import journal
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        self.path = os.path.join(self.tmpdir, 'journal')
+        self.journal = journal.Journal(self.path)
+
+    def _crash(self, name, pid=None):
+        # An operation left behind by a process that is gone
+        self.journal.begin(name, 'create', path='/pool/test01.qcow2')
+        self.journal.record(name, 'overlay')
+        self.journal.release(name)
+
+        with journal._LockedFile(self.path) as f:
+            journal._append(f, {'name': name, 'stage': 'resume',
+                                'pid': pid or 2 ** 22 + 1})
+
+    def test_pending(self):
+        self.assertEqual(self.journal.pending(), {})
+        self.assertFalse(os.path.exists(self.path))
+
+        self._crash('test01')
+        self.journal.begin('test02', 'create')
+        self.journal.end('test02')
+
+        pending = self.journal.pending()
+
+        self.assertEqual(list(pending), ['test01'])
+        self.assertEqual(pending['test01']['stages'], ['overlay'])
+        self.assertEqual(pending['test01']['path'], '/pool/test01.qcow2')
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_pending_running(self):
+        self.journal.begin('test01', 'create')
+        self.assertEqual(self.journal.pending(), {})
+
+        # Another process (alive) is running it
+        self._crash('test02', pid=os.getppid())
+        self.assertEqual(self.journal.pending(), {})
+
+        with self.assertRaises(errors.OperationInProgress):
+            self.journal.begin('test01', 'create')
+
+        self.assertEqual(sorted(self.journal.unfinished()),
+                         ['test01', 'test02'])
+
+    def test_begin_resume(self):
+        self._crash('test01')
+
+        state = self.journal.begin('test01', 'create')
+        self.assertEqual(state['stages'], ['overlay'])
+
+        self.journal.record('test01', 'customize')
+        self.journal.release('test01')
+
+        self.assertEqual(self.journal.pending()['test01']['stages'],
+                         ['overlay', 'customize'])
+
+        with self.assertRaises(errors.OperationInProgress):
+            self.journal.begin('test01', 'reset')
+
+    def test_partial_line(self):
+        self._crash('test01')
+
+        with open(self.path, 'ab') as f:
+            f.write(b'{"name": "test01", "sta')
+
+        self.journal.record('test01', 'customize')
+
+        self.assertEqual(self.journal.pending()['test01']['stages'],
+                         ['overlay', 'customize'])
+
+    def test_compact(self):
+        self._crash('test01')
+
+        for x in range(3):
+            self.journal.begin('test02', 'create', kwargs={'cpus': 2})
+            self.journal.end('test02')
+
+        with open(self.path) as f:
+            self.assertFalse(any('test02' in x for x in f))
+
+        self.assertEqual(list(self.journal.pending()), ['test01'])
@@ -0,0 +1,109 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import threading
+import unittest
+
+from . import metrics
+
+try:
+    from urllib.request import urlopen
+except ImportError:  # pragma: no cover
+    from urllib2 import urlopen
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter_gauge(self):
+        counter = metrics.Counter('test_total', 'Test counter', ('result',),
+                                  registry=self.registry)
+        gauge = metrics.Gauge('test_value', 'Test gauge',
+                              registry=self.registry)
+
+        counter.inc(result='success')
+        counter.inc(2, result='success')
+        counter.inc(result='fail"ure')
+        gauge.set(1.5)
+
+        self.assertEqual(counter.value(result='success'), 3)
+        self.assertEqual(metrics.render(self.registry), (
+            '# HELP test_total Test counter\n'
+            '# TYPE test_total counter\n'
+            'test_total{result="fail\\"ure"} 1\n'
+            'test_total{result="success"} 3\n'
+            '# HELP test_value Test gauge\n'
+            '# TYPE test_value gauge\n'
+            'test_value 1.5\n'))
+
+    def test_wrong_labels(self):
+        counter = metrics.Counter('test_total', 'Test counter', ('result',),
+                                  registry=self.registry)
+
+        with self.assertRaises(ValueError):
+            counter.inc(stage='build')
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Test histogram',
+                                      ('stage',), registry=self.registry,
+                                      buckets=(1, 10))
+
+        histogram.observe(0.5, stage='build')
+        histogram.observe(5, stage='build')
+        histogram.observe(50, stage='build')
+
+        with histogram.time(stage='install'):
+            pass
+
+        lines = metrics.render(self.registry).splitlines()
+
+        self.assertIn('test_seconds_bucket{le="1",stage="build"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="10",stage="build"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf",stage="build"} 3',
+                      lines)
+        self.assertIn('test_seconds_count{stage="build"} 3', lines)
+        self.assertIn('test_seconds_sum{stage="build"} 55.5', lines)
+        self.assertIn('test_seconds_count{stage="install"} 1', lines)
+
+    def test_register_again(self):
+        metrics.Gauge('test_value', 'Old', registry=self.registry)
+        gauge = metrics.Gauge('test_value', 'New', registry=self.registry)
+
+        self.assertEqual(self.registry.metrics(), [gauge])
+
+    def test_server(self):
+        server = metrics.make_server(('127.0.0.1', 0),
+                                     lambda: 'test_value 1\n')
+        self.addCleanup(server.server_close)
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.shutdown)
+
+        response = urlopen('http://127.0.0.1:{0}/metrics'.format(
+            server.server_address[1]))
+
+        self.assertEqual(response.read(), b'test_value 1\n')
+        self.assertEqual(response.headers['Content-Type'],
+                         metrics.CONTENT_TYPE)
@@ -0,0 +1,288 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from mock import patch
+
+from . import errors
+from . import mirror
+
+try:
+    from http import server as httpserver
+    from urllib.request import urlopen
+except ImportError:  # pragma: no cover
+    import BaseHTTPServer as httpserver
+    from urllib2 import urlopen
+
+
+class TestIndex(unittest.TestCase):
+    INDEX = """\
+-----BEGIN PGP SIGNED MESSAGE-----
+Hash: SHA512
+
+# virt-builder index
+[fedora-21]
+name=Fedora 21
+arch=x86_64
+file=fedora-21.xz
+notes=Fedora 21 Server
+ - with the default packages
+
+[fedora-21]
+arch=aarch64
+file=fedora-21-aarch64.xz
+-----BEGIN PGP SIGNATURE-----
+xxxx
+-----END PGP SIGNATURE-----
+"""
+
+    def test_parse_index(self):
+        entries = mirror.parse_index(self.INDEX)
+
+        self.assertEqual([x['id'] for x in entries],
+                         ['fedora-21', 'fedora-21'])
+        self.assertEqual(mirror.get_field(entries[0], 'notes'),
+                         'Fedora 21 Server\n- with the default packages')
+        self.assertEqual(mirror.get_field(entries[1], 'arch'), 'aarch64')
+        self.assertEqual(mirror.parse_index(mirror.render_index(entries)),
+                         entries)
+
+    def test_parse_index_invalid(self):
+        with self.assertRaises(errors.VirtDeployException):
+            mirror.parse_index('[fedora-21]\nnot a field\n')
+
+
+class _SigningKey(object):
+    # A throwaway key signing the stand-in upstream indexes
+    def __init__(self, path):
+        self.home = os.path.join(path, 'gnupg')
+        os.mkdir(self.home, 0o700)
+
+        self._gpg('--passphrase', '', '--quick-gen-key', 'virt-deploy test',
+                  'ed25519', 'sign', 'never')
+
+        self.key = os.path.join(path, 'test.gpg')
+        self._gpg('--armor', '--output', self.key, '--export')
+
+        keys = self._gpg('--with-colons', '--list-keys').decode('utf-8')
+        self.fingerprint = [x.split(':')[9] for x in keys.splitlines()
+                            if x.startswith('fpr:')][0]
+
+    def _gpg(self, *args):
+        return subprocess.check_output(
+            ('gpg', '--batch', '--no-tty', '--homedir', self.home) + args,
+            stderr=subprocess.STDOUT)
+
+    def sign(self, path):
+        self._gpg('--yes', '--output', path + '.asc', '--clearsign', path)
+        os.rename(path + '.asc', path)
+
+    def close(self):
+        subprocess.call(('gpgconf', '--homedir', self.home, '--kill', 'all'))
+
+
+class TestVerifyIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        self.signer = _SigningKey(self.tmpdir)
+        self.addCleanup(self.signer.close)
+
+        self.path = os.path.join(self.tmpdir, 'index')
+
+        with open(self.path, 'w') as f:
+            f.write('[fedora-21]\nfile=fedora-21.xz\n')
+
+        self.signer.sign(self.path)
+
+        with open(self.path) as f:
+            self.signed = f.read()
+
+    def _verify(self, text, fingerprint=None):
+        return mirror.verify_index(text, self.signer.key,
+                                   fingerprint or self.signer.fingerprint)
+
+    def test_verify_index(self):
+        self.assertEqual(self._verify('# prepended\n' + self.signed),
+                         '[fedora-21]\nfile=fedora-21.xz\n')
+
+    def test_verify_index_tampered(self):
+        with self.assertRaises(errors.VirtDeployException):
+            self._verify(self.signed.replace('fedora-21.xz', 'evil.xz'))
+
+        with self.assertRaises(errors.VirtDeployException):
+            self._verify('[fedora-21]\nfile=fedora-21.xz\n')
+
+    def test_verify_index_other_key(self):
+        with self.assertRaises(errors.VirtDeployException):
+            self._verify(self.signed, mirror.UPSTREAM_FINGERPRINT)
+
+
+class TestMirror(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        # A local stand-in for the upstream index
+        self.upstream = os.path.join(self.tmpdir, 'upstream')
+        os.mkdir(self.upstream)
+
+        self.signer = _SigningKey(self.tmpdir)
+        self.addCleanup(self.signer.close)
+
+        for name, value in (('UPSTREAM_KEY', self.signer.key),
+                            ('UPSTREAM_FINGERPRINT',
+                             self.signer.fingerprint)):
+            patcher = patch.object(mirror, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.mirror = mirror.Mirror(os.path.join(self.tmpdir, 'mirror'))
+        self.index = self._index({'fedora-21': b'fedora image',
+                                  'centos-7': b'centos image'})
+
+    def _index(self, images, checksums=None):
+        entries = []
+
+        for name, content in sorted(images.items()):
+            with open(os.path.join(self.upstream, name + '.xz'), 'wb') as f:
+                f.write(content)
+
+            checksum = (checksums or {}).get(
+                name, hashlib.sha512(content).hexdigest())
+            entries.append({'id': name, 'fields': [
+                ('arch', 'x86_64'), ('file', name + '.xz'),
+                (mirror.CHECKSUM_KEY, checksum)]})
+
+        index = os.path.join(self.upstream, 'index')
+
+        with open(index, 'w') as f:
+            f.write(mirror.render_index(entries))
+
+        self.signer.sign(index)
+
+        return 'file://{0}/index'.format(self.upstream)
+
+    def test_sync(self):
+        result = self.mirror.sync(self.index, ['fedora-21'])
+
+        self.assertEqual(result['downloaded'], ['fedora-21 (x86_64)'])
+        self.assertEqual(result['bytes'], len(b'fedora image'))
+
+        entry = self.mirror.find('fedora-21', 'x86_64')
+        checksum = hashlib.sha512(b'fedora image').hexdigest()
+
+        self.assertEqual(mirror.get_field(entry, 'file'), 'fedora-21.xz')
+        self.assertEqual(
+            os.readlink(os.path.join(self.mirror.path, 'fedora-21.xz')),
+            'objects/{0}/{1}.xz'.format(checksum[:2], checksum))
+        self.assertIsNone(self.mirror.find('centos-7', 'x86_64'))
+
+        # The upstream index is kept signed
+        with open(self.mirror.index_path) as f:
+            self.assertTrue(f.read().startswith(mirror.PGP_SIGNED_HEADER))
+
+        # The images are downloaded once
+        result = self.mirror.sync(self.index)
+
+        self.assertEqual(result['downloaded'], ['centos-7 (x86_64)'])
+        self.assertEqual(result['present'], ['fedora-21 (x86_64)'])
+
+        # A new upstream image is not in the mirror until synced
+        self._index({'fedora-21': b'fedora image v2',
+                     'centos-7': b'centos image'})
+        self.mirror.sync(self.index, ['centos-7'])
+
+        self.assertIsNone(self.mirror.find('fedora-21', 'x86_64'))
+        self.assertIsNotNone(self.mirror.find('centos-7', 'x86_64'))
+
+    def test_sync_unsigned(self):
+        with open(os.path.join(self.upstream, 'index'), 'w') as f:
+            f.write(mirror.render_index([{'id': 'fedora-21', 'fields': [
+                ('file', 'fedora-21.xz'), (mirror.CHECKSUM_KEY, '0')]}]))
+
+        with self.assertRaises(errors.VirtDeployException):
+            self.mirror.sync(self.index)
+
+        self.assertFalse(os.path.exists(self.mirror.index_path))
+
+    def test_sync_checksum_mismatch(self):
+        index = self._index({'fedora-21': b'fedora image'},
+                            {'fedora-21': '0' * 128})
+
+        with self.assertRaises(errors.VirtDeployException):
+            self.mirror.sync(index)
+
+        self.assertIsNone(self.mirror.find('fedora-21', 'x86_64'))
+        self.assertEqual(os.listdir(os.path.join(self.mirror.path,
+                                                 mirror.OBJECTS_DIR, '00')),
+                         [])
+
+    def test_sync_missing_template(self):
+        with self.assertRaises(errors.VirtDeployException):
+            self.mirror.sync(self.index, ['debian-8'])
+
+    def test_make_server(self):
+        self.mirror.sync(self.index, ['fedora-21'])
+        entry = self.mirror.find('fedora-21', 'x86_64')
+
+        # Keep the request log out of the test output
+        patcher = patch.object(httpserver.BaseHTTPRequestHandler,
+                               'log_message')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        server = mirror.make_server(('127.0.0.1', 0), self.mirror.path)
+        self.addCleanup(server.server_close)
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.shutdown)
+
+        url = 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+
+        self.assertEqual(urlopen(url + mirror.get_field(entry, 'file'))
+                         .read(), b'fedora image')
+
+        # The mirror can be the upstream of another one
+        other = mirror.Mirror(os.path.join(self.tmpdir, 'other'))
+        other.sync(url + 'index', ['fedora-21'])
+        self.assertIsNotNone(other.find('fedora-21', 'x86_64'))
+
+        for path in ('../upstream/index', 'objects/../../upstream/index'):
+            with self.assertRaises(Exception):
+                urlopen(url + path)
+
+    @patch.object(mirror, 'MIRROR_DIR', '/nonexistent')
+    def test_default_path(self):
+        self.assertEqual(mirror.Mirror().index_uri,
+                         'file:///nonexistent/index')
+        self.assertEqual(mirror.Mirror().entries(), [])
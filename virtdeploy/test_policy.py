@@ -0,0 +1,128 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import unittest
+
+from mock import MagicMock
+
+from . import policy
+
+
+class TestIdleTracker(unittest.TestCase):
+    def test_idle(self):
+        tracker = policy.IdleTracker(100, usage=0.1)
+
+        # 1 second of cpu time every 50 seconds on 2 vcpus is 1% usage
+        for now, cpu_time, idle in ((0, 0, []),
+                                    (50, 1e9, []),
+                                    (100, 2e9, ['test01'])):
+            stats = {'test01': {'cpu_time': cpu_time, 'vcpus': 2}}
+            self.assertEqual(tracker.update(stats, now), idle)
+
+    def test_busy(self):
+        tracker = policy.IdleTracker(100, usage=0.1)
+
+        for now, cpu_time in ((0, 0), (50, 1e9), (100, 50e9), (150, 51e9)):
+            stats = {'test01': {'cpu_time': cpu_time, 'vcpus': 1}}
+            self.assertEqual(tracker.update(stats, now), [])
+
+    def test_restarted(self):
+        tracker = policy.IdleTracker(100)
+
+        tracker.update({'test01': {'cpu_time': 10e9, 'vcpus': 1}}, 0)
+        tracker.update({'test01': {'cpu_time': 10e9, 'vcpus': 1}}, 50)
+
+        # Not running in between: the idle time starts again
+        tracker.update({}, 75)
+        self.assertEqual(
+            tracker.update({'test01': {'cpu_time': 10e9, 'vcpus': 1}}, 100),
+            [])
+
+
+class TestCollectGarbage(unittest.TestCase):
+    def test_collect_garbage(self):
+        driver = MagicMock()
+        driver.pool_gc.side_effect = [{'files': 0, 'bytes': 0},
+                                      {'files': 2, 'bytes': 4096},
+                                      ValueError('pool')]
+
+        stop = MagicMock()
+        stop.is_set.side_effect = [False, False, False, True]
+        report = MagicMock()
+
+        policy.collect_garbage(driver, interval=0, stop=stop, report=report)
+
+        self.assertEqual(report.call_count, 2)
+        report.assert_any_call({'files': 2, 'bytes': 4096}, None)
+        self.assertIsInstance(report.call_args[0][1], ValueError)
+
+
+class TestReconcile(unittest.TestCase):
+    def test_reconcile(self):
+        clean = {'domains': [], 'hosts': [], 'dns': [], 'images': []}
+        orphans = dict(clean, images=['/pool/test01.qcow2'])
+
+        driver = MagicMock()
+        driver.pool_fsck.side_effect = [clean, orphans]
+
+        stop = MagicMock()
+        stop.is_set.side_effect = [False, False, True]
+        report = MagicMock()
+
+        policy.reconcile(driver, interval=0, stop=stop, report=report)
+
+        driver.pool_fsck.assert_called_with(repair=True)
+        report.assert_called_once_with(orphans, None)
+        self.assertEqual(policy.count_orphans(orphans), 1)
+
+
+class TestSuspendIdle(unittest.TestCase):
+    def test_suspend_idle(self):
+        driver = MagicMock()
+        driver.instance_cpu_stats.return_value = {
+            'test01': {'cpu_time': 0, 'vcpus': 1}}
+
+        stop = MagicMock()
+        stop.is_set.side_effect = [False, False, True]
+        report = MagicMock()
+
+        policy.suspend_idle(driver, 0, interval=0, stop=stop, report=report)
+
+        self.assertEqual(driver.instance_suspend.call_count, 2)
+        report.assert_called_with('test01', None)
+
+    def test_suspend_idle_error(self):
+        driver = MagicMock()
+        driver.instance_cpu_stats.side_effect = [
+            ValueError('libvirt'), {'test01': {'cpu_time': 0, 'vcpus': 1}}]
+
+        stop = MagicMock()
+        stop.is_set.side_effect = [False, False, True]
+        report = MagicMock()
+
+        policy.suspend_idle(driver, 0, interval=0, stop=stop, report=report)
+
+        # The loop goes on after the failure
+        self.assertEqual(report.call_count, 2)
+        self.assertIsNone(report.call_args_list[0][0][0])
+        self.assertIsInstance(report.call_args_list[0][0][1], ValueError)
+        driver.instance_suspend.assert_called_once_with('test01')
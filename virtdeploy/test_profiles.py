@@ -0,0 +1,127 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import errors
+from . import profiles
+
+
+class TestProfiles(unittest.TestCase):
+    PROFILE = {
+        'update': True,
+        'packages': ['qemu-guest-agent'],
+        'commands': ['systemctl enable qemu-guest-agent'],
+        'ssh_keys': ['ssh-rsa AAAA user@example.com'],
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_load_profile(self):
+        path = self._write('profile.json', json.dumps(self.PROFILE))
+        self.assertEqual(profiles.load_profile(path), self.PROFILE)
+
+    def test_load_profile_relative_paths(self):
+        self._write('profile.json', json.dumps({
+            'files': ['motd:/etc/motd', '/srv/issue:/etc/issue'],
+            'scripts': ['setup.sh']}))
+
+        workdir = os.path.join(self.tmpdir, 'work')
+        os.mkdir(workdir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(workdir)
+
+        profile = profiles.load_profile('../profile.json')
+        os.chdir('/')
+
+        self.assertEqual(profile['files'], [
+            '{0}/motd:/etc/motd'.format(self.tmpdir),
+            '/srv/issue:/etc/issue'])
+        self.assertEqual(profile['scripts'], [
+            os.path.join(self.tmpdir, 'setup.sh')])
+
+    def test_load_profile_invalid_json(self):
+        path = self._write('profile.json', '{')
+
+        with self.assertRaises(errors.InvalidProfile):
+            profiles.load_profile(path)
+
+    def test_validate_profile_failures(self):
+        for profile in ([], {'unknown': 1}, {'packages': 'vim'},
+                        {'files': ['/tmp/nodestination']}):
+            with self.assertRaises(errors.InvalidProfile):
+                profiles.validate_profile(profile)
+
+    def test_profile_hash_stable(self):
+        reordered = dict(reversed(list(self.PROFILE.items())))
+
+        self.assertEqual(profiles.profile_hash(self.PROFILE),
+                         profiles.profile_hash(reordered))
+        self.assertEqual(len(profiles.profile_hash(self.PROFILE)),
+                         profiles.PROFILE_HASH_SIZE)
+
+    def test_profile_hash_file_content(self):
+        script = self._write('setup.sh', 'echo one\n')
+        profile = {'scripts': [script]}
+
+        first = profiles.profile_hash(profile)
+        self._write('setup.sh', 'echo two\n')
+
+        self.assertNotEqual(first, profiles.profile_hash(profile))
+
+    def test_profile_hash_file_boundary(self):
+        first = self._write('first.sh', 'echo one\n')
+        second = self._write('second.sh', '')
+        profile = {'scripts': [first, second]}
+
+        digest = profiles.profile_hash(profile)
+        self._write('first.sh', 'echo one')
+        self._write('second.sh', '\n')
+
+        self.assertNotEqual(digest, profiles.profile_hash(profile))
+
+    def test_profile_hash_missing_file(self):
+        profile = {'scripts': [os.path.join(self.tmpdir, 'missing.sh')]}
+
+        with self.assertRaises(errors.InvalidProfile):
+            profiles.profile_hash(profile)
+
+    def test_image_profile(self):
+        profile = dict(self.PROFILE, tuning=u'latency')
+
+        self.assertEqual(profiles.image_profile(profile), self.PROFILE)
+        self.assertIsNone(profiles.image_profile({'tuning': u'latency'}))
+        self.assertIsNone(profiles.image_profile(None))
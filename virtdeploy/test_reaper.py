@@ -0,0 +1,43 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import unittest
+
+from mock import patch
+
+from . import reaper
+
+
+class TestReaper(unittest.TestCase):
+    @patch('virtdeploy.get_driver')
+    def test_main(self, driver_mock):
+        reaper.main(['--uri', 'qemu:///session', 'test01'])
+
+        driver_mock.assert_called_with('libvirt',
+                                       kwargs={'uri': 'qemu:///session'})
+        driver_mock.return_value.instance_reap.assert_called_with('test01')
+
+    @patch('virtdeploy.get_driver')
+    def test_main_default_uri(self, driver_mock):
+        reaper.main(['test01'])
+
+        driver_mock.assert_called_with('libvirt', kwargs={})
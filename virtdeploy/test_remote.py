@@ -0,0 +1,165 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from mock import MagicMock
+from mock import patch
+
+from . import errors
+from . import remote
+
+
+class TestRemote(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        patcher = patch.object(remote, 'control_dir',
+                               return_value=self.tmpdir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.driver = MagicMock()
+        self.driver.instance_address.side_effect = (
+            lambda name: ['10.0.0.{0}'.format(name[-1])])
+
+    def test_ssh_command(self):
+        command = remote.ssh_command('10.0.0.1', 'root', batch=True)
+
+        self.assertIn('ControlPath={0}/%C'.format(self.tmpdir), command)
+        self.assertIn('BatchMode=yes', command)
+        self.assertEqual(command[-3:], ['-l', 'root', '10.0.0.1'])
+        self.assertNotIn('-n', command)
+
+    def test_address_cache(self):
+        cache = remote.AddressCache()
+
+        self.assertEqual(cache.resolve(lambda: self.driver, 'test01'),
+                         ('10.0.0.1', False))
+        self.assertEqual(cache.resolve(lambda: self.driver, 'test01'),
+                         ('10.0.0.1', True))
+        cache.save()
+
+        # Shared with the next commands, until expired
+        self.assertEqual(remote.AddressCache().resolve(
+            lambda: self.driver, 'test01'), ('10.0.0.1', True))
+        self.assertEqual(remote.AddressCache(ttl=0).resolve(
+            lambda: self.driver, 'test01'), ('10.0.0.1', False))
+
+        self.assertEqual(self.driver.instance_address.call_count, 2)
+
+    def test_address_cache_forget(self):
+        cache = remote.AddressCache()
+        cache.resolve(lambda: self.driver, 'test01')
+        cache.save()
+
+        remote.forget_addresses(['test01'])
+
+        self.assertEqual(remote.AddressCache().resolve(
+            lambda: self.driver, 'test01'), ('10.0.0.1', False))
+
+    def test_address_cache_reused(self):
+        cache = remote.AddressCache()
+        cache.resolve(lambda: self.driver, 'test01')
+
+        # The address of test01 was given to other01
+        self.driver.instance_address.side_effect = None
+        self.driver.instance_address.return_value = ['10.0.0.1']
+        cache.resolve(lambda: self.driver, 'other01')
+
+        self.assertEqual(cache.resolve(lambda: self.driver, 'test01'),
+                         ('10.0.0.1', False))
+
+    def test_address_cache_missing(self):
+        self.driver.instance_address.side_effect = None
+        self.driver.instance_address.return_value = []
+
+        with self.assertRaises(errors.VirtDeployException):
+            remote.AddressCache().resolve(lambda: self.driver, 'test01')
+
+    def test_run_command(self):
+        def execute(args, callback, timeout):
+            callback('line1')
+            callback('line2')
+            raise subprocess.CalledProcessError(3, args)
+
+        with patch.object(remote, 'execute', side_effect=execute) as mock:
+            self.assertEqual(remote.run_command('10.0.0.1', 'uptime'),
+                             (3, ['line1', 'line2']))
+
+        self.assertEqual(mock.call_args[0][0][-2:], ['10.0.0.1', 'uptime'])
+
+        # The commands don't read the input of the caller
+        self.assertIn('-n', mock.call_args[0][0])
+
+    def test_run(self):
+        cache = remote.AddressCache()
+        cache.resolve(lambda: self.driver, 'test01')
+
+        # The cached address is stale, the instance got a new one
+        self.driver.instance_address.side_effect = None
+        self.driver.instance_address.return_value = ['10.0.0.9']
+
+        def run_command(address, command, user, timeout):
+            if address == '10.0.0.1':
+                return remote.SSH_FAILURE, []
+            return 0, [address]
+
+        with patch.object(remote, 'run_command', side_effect=run_command):
+            results = remote.run(lambda: self.driver, ['test01', 'test02'],
+                                 'uptime', cache=cache)
+
+        self.assertEqual(results[0], ({'name': 'test01',
+                                       'address': '10.0.0.9',
+                                       'exitcode': 0,
+                                       'output': ['10.0.0.9']}, None))
+        self.assertEqual(results[1][0]['exitcode'], 0)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir,
+                                                    remote.ADDRESS_CACHE)))
+
+    def test_copy_files(self):
+        source = os.path.join(self.tmpdir, 'bundle')
+        os.mkdir(source)
+
+        with open(os.path.join(source, 'setup.sh'), 'w') as f:
+            f.write('echo setup\n')
+
+        target = os.path.join(self.tmpdir, 'remote', 'opt')
+
+        # The remote shell is a local one
+        with patch.object(remote, 'ssh_command',
+                          return_value=['sh', '-c']):
+            self.assertEqual(remote.copy_files('10.0.0.1', [
+                '{0}:{1}'.format(source, target)]), (0, []))
+
+            exitcode, _ = remote.copy_files('10.0.0.1', [
+                '{0}:/proc/virt-deploy'.format(source)])
+
+        self.assertNotEqual(exitcode, 0)
+
+        with open(os.path.join(target, 'bundle', 'setup.sh')) as f:
+            self.assertEqual(f.read(), 'echo setup\n')
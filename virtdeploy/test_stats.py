@@ -0,0 +1,79 @@
+#
+# Copyright 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Refer to the README and COPYING files for full details of the license
+#
+
+from __future__ import absolute_import
+
+import unittest
+
+from mock import MagicMock
+from mock import patch
+
+from . import stats
+
+
+def _stat(cpu_time=0, block=0, net=0, vcpus=2):
+    return {'cpu_time': cpu_time, 'vcpus': vcpus,
+            'memory': 1024, 'memory_used': 512,
+            'block_rd_bytes': block, 'block_wr_bytes': block,
+            'block_rd_reqs': block, 'block_wr_reqs': block,
+            'net_rx_bytes': net, 'net_tx_bytes': net}
+
+
+class TestComputeRates(unittest.TestCase):
+    def test_rates(self):
+        rates = stats.compute_rates({'test01': _stat()},
+                                    {'test01': _stat(1e9, 2048, 4096)}, 2)
+
+        self.assertEqual(rates['test01']['cpu'], 25.0)
+        self.assertEqual(rates['test01']['block_read'], 1024)
+        self.assertEqual(rates['test01']['block_write_iops'], 1024)
+        self.assertEqual(rates['test01']['net_tx'], 2048)
+        self.assertEqual(rates['test01']['memory_used'], 512)
+
+    def test_rates_new_instance(self):
+        rates = stats.compute_rates({}, {'test01': _stat(1e9)}, 2)
+
+        self.assertIsNone(rates['test01']['cpu'])
+        self.assertIsNone(rates['test01']['net_rx'])
+        self.assertEqual(rates['test01']['memory'], 1024)
+
+    def test_rates_restarted(self):
+        rates = stats.compute_rates({'test01': _stat(5e9)},
+                                    {'test01': _stat(1e9)}, 2)
+
+        self.assertIsNone(rates['test01']['cpu'])
+
+
+class TestSampleRates(unittest.TestCase):
+    @patch('time.sleep')
+    def test_sample_rates(self, sleep_mock):
+        driver = MagicMock()
+        driver.instance_stats.side_effect = [
+            {'test01': _stat(0)}, {'test01': _stat(1e9)},
+            {'test01': _stat(2e9)},
+        ]
+
+        with patch.object(stats, 'monotonic_time', side_effect=[0, 1, 2]):
+            samples = list(stats.sample_rates(driver, 1, count=2))
+
+        self.assertEqual(len(samples), 2)
+        self.assertEqual([x[1]['test01']['cpu'] for x in samples],
+                         [50.0, 50.0])
+        self.assertEqual(sleep_mock.call_count, 2)
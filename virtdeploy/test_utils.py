@@ -20,15 +20,22 @@
 
 from __future__ import absolute_import
 
+import errno
+import os
+import signal
+import socket
+import tempfile
+import threading
+import time
 import unittest
 
 from mock import MagicMock
 from mock import call
 from mock import patch
-from socket import SOL_SOCKET
-from socket import SO_ERROR
 from subprocess import CalledProcessError
 
+from . import errors
+from . import metrics
 from . import utils
 
 
@@ -50,6 +57,7 @@ class TestExecute(unittest.TestCase):
 
             self.assertEqual(utils.execute(command, **optargs), outputs)
 
+        optargs.update(utils._POPEN_SESSION)
         popen_mock.assert_called_once_with(command, **optargs)
 
     def test_execute_failure(self):
@@ -66,6 +74,267 @@ class TestExecute(unittest.TestCase):
 
             self.assertEqual(cm.exception.returncode, 1)
 
+    def _pipe(self, data):
+        r, w = os.pipe()
+        os.write(w, data)
+        os.close(w)
+        return os.fdopen(r, 'rb')
+
+    def test_execute_callback(self):
+        command = ('command', 'arg1')
+        lines = []
+
+        with patch('subprocess.Popen') as popen_mock:
+            popen_mock.return_value.stdout = self._pipe(b'line1\nline2\n')
+            popen_mock.return_value.returncode = 0
+
+            utils.execute(command, callback=lines.append)
+
+        self.assertEqual(lines, ['line1', 'line2'])
+
+    def test_execute_callback_carriage_return(self):
+        lines = []
+        utils.execute(('printf', '[ 1.0] a\\r[ 2.0] b\\r\\nend'),
+                      callback=lines.append)
+
+        self.assertEqual(lines, ['[ 1.0] a', '[ 2.0] b', 'end'])
+
+    def test_execute_callback_failure_tail(self):
+        command = ('command', 'arg1')
+        output = b''.join(b'line%d\n' % i for i in range(10))
+
+        with patch('subprocess.Popen') as popen_mock:
+            popen_mock.return_value.stdout = self._pipe(output)
+            popen_mock.return_value.returncode = 1
+
+            with self.assertRaises(CalledProcessError) as cm:
+                utils.execute(command, callback=lambda x: None, tail=3)
+
+        self.assertEqual(cm.exception.output, 'line7\nline8\nline9')
+
+    def test_execute_metrics(self):
+        failures = utils.COMMAND_FAILURES.value(command='false') or 0
+
+        with self.assertRaises(CalledProcessError):
+            utils.execute(('/bin/false',))
+
+        self.assertEqual(utils.COMMAND_FAILURES.value(command='false'),
+                         failures + 1)
+        self.assertIn('virtdeploy_command_duration_seconds_count'
+                      '{command="false"}', metrics.render())
+
+    @patch('virtdeploy.utils.kill_process_group')
+    @patch('virtdeploy.utils.monotonic_time')
+    def test_execute_timeout(self, time_mock, kill_mock):
+        blocked = threading.Event()
+        time_mock.side_effect = [0, 0, 10]
+
+        with patch('subprocess.Popen') as popen_mock:
+            popen_mock.return_value.communicate.side_effect = blocked.wait
+
+            with self.assertRaises(errors.CommandTimeout):
+                utils.execute(('command',), timeout=10)
+
+        blocked.set()
+        kill_mock.assert_called_once_with(popen_mock.return_value)
+
+    @patch('virtdeploy.utils.kill_process_group')
+    def test_execute_cancel(self, kill_mock):
+        blocked = threading.Event()
+        cancel = threading.Event()
+        cancel.set()
+
+        with patch('subprocess.Popen') as popen_mock:
+            popen_mock.return_value.communicate.side_effect = blocked.wait
+
+            with self.assertRaises(errors.OperationCancelled):
+                utils.execute(('command',), cancel=cancel)
+
+        blocked.set()
+        kill_mock.assert_called_once_with(popen_mock.return_value)
+
+
+class TestKillProcessGroup(unittest.TestCase):
+    @patch('os.killpg')
+    def test_kill_process_group(self, killpg_mock):
+        process = MagicMock(pid=1234)
+        process.poll.return_value = 0
+
+        utils.kill_process_group(process)
+
+        self.assertEqual(killpg_mock.mock_calls, [
+            call(1234, signal.SIGTERM),
+            call(1234, signal.SIGKILL),
+        ])
+        process.wait.assert_called_once_with()
+
+    @patch('os.killpg')
+    def test_kill_process_group_missing(self, killpg_mock):
+        process = MagicMock(pid=1234)
+        killpg_mock.side_effect = OSError(errno.ESRCH, 'No such process')
+
+        utils.kill_process_group(process)
+
+        killpg_mock.assert_called_once_with(1234, signal.SIGTERM)
+        self.assertFalse(process.wait.called)
+
+
+class TestRollback(unittest.TestCase):
+    def test_rollback_failure(self):
+        actions = MagicMock()
+        actions.second.side_effect = OSError
+
+        with self.assertRaises(KeyboardInterrupt):
+            with utils.Rollback() as rollback:
+                rollback.add(actions.first, 1)
+                rollback.add(actions.second, 2)
+                rollback.add(actions.third, 3, arg=4)
+                raise KeyboardInterrupt
+
+        self.assertEqual(actions.mock_calls, [
+            call.third(3, arg=4),
+            call.second(2),
+            call.first(1),
+        ])
+
+    def test_rollback_success(self):
+        action = MagicMock()
+
+        with utils.Rollback() as rollback:
+            rollback.add(action)
+
+        self.assertFalse(action.called)
+
+
+class TestParallel(unittest.TestCase):
+    def test_parallel(self):
+        def func(x):
+            if x == 2:
+                raise ValueError(x)
+            return x * 10
+
+        results = utils.parallel(func, [1, 2, 3], workers=2)
+
+        self.assertEqual(results[0], (10, None))
+        self.assertIsNone(results[1][0])
+        self.assertIsInstance(results[1][1], ValueError)
+        self.assertEqual(results[2], (30, None))
+
+    def test_parallel_empty(self):
+        self.assertEqual(utils.parallel(len, []), [])
+
+
+class TestParallelGraph(unittest.TestCase):
+    def test_parallel_graph_order(self):
+        done = []
+
+        def func(x):
+            done.append(x)
+            return x.upper()
+
+        results = utils.parallel_graph(func, {'web': ['db'], 'db': [],
+                                              'app': ['db', 'web']},
+                                       workers=3)
+
+        self.assertEqual(done, ['db', 'web', 'app'])
+        self.assertEqual(results['app'], ('APP', None))
+
+    def test_parallel_graph_failure(self):
+        def func(x):
+            if x == 'db':
+                raise ValueError(x)
+            return x
+
+        results = utils.parallel_graph(func, {'db': [], 'web': ['db'],
+                                              'other': ['unknown']})
+
+        self.assertIsInstance(results['db'][1], ValueError)
+        self.assertIsInstance(results['web'][1], errors.VirtDeployException)
+        self.assertEqual(results['other'], ('other', None))
+
+    def test_parallel_graph_cycle(self):
+        results = utils.parallel_graph(len, {'a': ['b'], 'b': ['a']})
+
+        self.assertIsInstance(results['a'][1], errors.VirtDeployException)
+        self.assertIsInstance(results['b'][1], errors.VirtDeployException)
+
+
+class TestFilesystemType(unittest.TestCase):
+    MOUNTS = (
+        'sysfs /sys sysfs rw 0 0\n'
+        '/dev/vda1 / ext4 rw 0 0\n'
+        '/dev/vdb1 /var/lib/libvirt xfs rw 0 0\n'
+        '/dev/vdc1 /var/lib/libvirt/images\\040old btrfs rw 0 0\n'
+    )
+
+    def setUp(self):
+        self.mounts = tempfile.NamedTemporaryFile(mode='w')
+        self.addCleanup(self.mounts.close)
+        self.mounts.write(self.MOUNTS)
+        self.mounts.flush()
+
+    def test_filesystem_type(self):
+        for path, fstype in (('/var/lib/libvirt/images', 'xfs'),
+                             ('/var/lib/libvirt', 'xfs'),
+                             ('/var/lib/libvirt/images old/x', 'btrfs'),
+                             ('/var/lib/libvirtd', 'ext4'),
+                             ('/tmp', 'ext4')):
+            self.assertEqual(
+                utils.filesystem_type(path, mounts=self.mounts.name), fstype)
+
+    def test_filesystem_type_unavailable(self):
+        self.assertIsNone(utils.filesystem_type('/', mounts='/nonexistent'))
+
+
+class TestReclaimFile(unittest.TestCase):
+    def test_reclaim_file(self):
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.write(b'x' * 10000)
+        f.close()
+
+        with patch('time.sleep') as sleep_mock:
+            freed = utils.reclaim_file(f.name, rate=4096, step=4096)
+
+        self.assertFalse(os.path.exists(f.name))
+        self.assertGreaterEqual(freed, 10000)
+        # Truncated to 5904 and 1808 bytes before the unlink
+        self.assertEqual(sleep_mock.call_args_list, [call(1.0), call(1.0)])
+
+    def test_reclaim_file_missing(self):
+        self.assertEqual(utils.reclaim_file('/nonexistent', rate=1), 0)
+
+
+class TestSpawnDetached(unittest.TestCase):
+    @patch('subprocess.Popen')
+    def test_spawn_detached(self, popen_mock):
+        utils.spawn_detached(('/bin/true',))
+
+        args, kwargs = popen_mock.call_args
+        self.assertEqual(args, (('/bin/true',),))
+        self.assertIsNotNone(kwargs['stdin'])
+        self.assertIs(kwargs['stdout'], kwargs['stdin'])
+        self.assertTrue(kwargs.get('start_new_session') or
+                        kwargs.get('preexec_fn'))
+        self.assertFalse(popen_mock.return_value.wait.called)
+
+
+class TestFormatSize(unittest.TestCase):
+    def test_format_size(self):
+        for size, text in ((0, '0.0 B'), (1536, '1.5 KiB'),
+                           (3 * 1024 ** 3, '3.0 GiB'),
+                           (2 * 1024 ** 4, '2.0 TiB')):
+            self.assertEqual(utils.format_size(size), text)
+
+
+class TestParseProgress(unittest.TestCase):
+    def test_parse_progress(self):
+        self.assertEqual(
+            utils.parse_progress('[  12.5] Downloading: http://x/y.xz'),
+            {'elapsed': 12.5, 'message': 'Downloading: http://x/y.xz'})
+
+    def test_parse_progress_other(self):
+        self.assertIs(utils.parse_progress('Setting passwords'), None)
+
 
 class TestMonotonicTime(unittest.TestCase):
     def test_monotonic_time(self):
@@ -144,62 +413,166 @@ class TestWaitTcpAccess(unittest.TestCase):
             sleep_mock.reset_mock()
 
 
+class TestWaitInstance(unittest.TestCase):
+    def setUp(self):
+        self.driver_mock = MagicMock()
+
+    @patch('virtdeploy.utils.probe_tcp_access')
+    def test_wait_instance_agent(self, probe_mock):
+        self.driver_mock.instance_ready.return_value = True
+
+        self.assertTrue(utils.wait_instance(self.driver_mock, 'test01'))
+        self.assertFalse(probe_mock.called)
+
+    @patch('virtdeploy.utils.probe_tcp_access')
+    def test_wait_instance_tcp(self, probe_mock):
+        self.driver_mock.instance_ready.return_value = False
+        probe_mock.return_value = ('192.168.122.2', 22)
+
+        self.assertTrue(utils.wait_instance(self.driver_mock, 'test01'))
+
+    @patch('time.sleep')
+    @patch('virtdeploy.utils.monotonic_time')
+    @patch('virtdeploy.utils.probe_tcp_access')
+    def test_wait_instance_timeout(self, probe_mock, time_mock, sleep_mock):
+        self.driver_mock.instance_ready.return_value = False
+        probe_mock.return_value = None
+        time_mock.side_effect = [0, 0, 0, 1.0, 1.0, 1.0, 2.0]
+
+        self.assertFalse(utils.wait_instance(self.driver_mock, 'test01',
+                                             timeout=2.0))
+        self.assertEqual(probe_mock.call_count, 2)
+
+
 class TestProbeTcpAccess(unittest.TestCase):
-    TIMEOUT = 10
+    TIMEOUT = 2.0
 
     def setUp(self):
-        self.addresses = ['192.168.122.2', '192.168.122.3']
-        self.sockets = [MagicMock() for _ in self.addresses]
+        self.servers = []
         self.driver_mock = MagicMock()
-        self.driver_mock.instance_address.return_value = self.addresses
 
-    @patch('select.select')
-    @patch('socket.socket')
-    @patch('virtdeploy.utils.monotonic_time')
-    def test_probe_timeout(self, time_mock, socket_mock, select_mock):
-        socket_mock.side_effect = self.sockets
-        time_mock.side_effect = [0, 0, self.TIMEOUT / 2, self.TIMEOUT]
-        select_mock.return_value = (), (), ()
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def _listen(self, address='127.0.0.1', banner=None):
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+
+        server = socket.socket(family, socket.SOCK_STREAM)
+        server.bind((address, 0))
+        server.listen(8)
+        self.servers.append(server)
+
+        if banner is not None:
+            def accept():
+                conn, _ = server.accept()
+
+                # A list of chunks is sent in separate segments
+                for chunk in (banner if isinstance(banner, list)
+                              else [banner]):
+                    conn.sendall(chunk)
+                    time.sleep(0.1)
+
+                conn.close()
+
+            thread = threading.Thread(target=accept)
+            thread.daemon = True
+            thread.start()
+
+        return server.getsockname()[1]
+
+    def _closed_port(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        port = server.getsockname()[1]
+        server.close()
+        return port
+
+    def test_probe_success(self):
+        port = self._listen()
+        self.driver_mock.instance_address.return_value = ['127.0.0.1']
 
-        retvalue = utils.probe_tcp_access(self.driver_mock, None,
+        retvalue = utils.probe_tcp_access(self.driver_mock, 'test01', port,
                                           timeout=self.TIMEOUT)
 
-        self.assertEqual(retvalue, None)
+        self.assertEqual(retvalue, ('127.0.0.1', port))
 
-        self._assert_sockets_calls()
+    def test_probe_refused(self):
+        port = self._closed_port()
+        self.driver_mock.instance_address.return_value = ['127.0.0.1']
 
-        # FIXME: mock should record the collection snapshot, not the
-        # collection object, code should be:
-        #   call((), self.sockets, (), self.TIMEOUT)
-        select_mock.assert_has_calls([
-            call((), [], (), self.TIMEOUT),
-            call((), [], (), self.TIMEOUT / 2),
-        ])
+        retvalue = utils.probe_tcp_access(self.driver_mock, 'test01', port,
+                                          timeout=self.TIMEOUT)
+
+        self.assertIs(retvalue, None)
 
-    @patch('select.select')
-    @patch('socket.socket')
     @patch('virtdeploy.utils.monotonic_time')
-    def test_probe_success(self, time_mock, socket_mock, select_mock):
-        sock = self.sockets[0]
+    def test_probe_timeout(self, time_mock):
+        port = self._listen()
+        self.driver_mock.instance_address.return_value = ['127.0.0.1']
+        time_mock.side_effect = [0, self.TIMEOUT, self.TIMEOUT]
+
+        retvalue = utils.probe_tcp_access(self.driver_mock, 'test01', port,
+                                          timeout=self.TIMEOUT)
+
+        self.assertIs(retvalue, None)
+
+    def test_probe_banner(self):
+        port = self._listen(banner=b'SSH-2.0-OpenSSH_7.4\r\n')
+        self.driver_mock.instance_address.return_value = ['127.0.0.1']
+
+        retvalue = utils.probe_tcp_access(self.driver_mock, 'test01', port,
+                                          timeout=self.TIMEOUT,
+                                          banner=utils.SSH_BANNER)
+
+        self.assertEqual(retvalue, ('127.0.0.1', port))
+
+    def test_probe_banner_split(self):
+        port = self._listen(banner=[b'SS', b'H-2.0-OpenSSH_7.4\r\n'])
+        self.driver_mock.instance_address.return_value = ['127.0.0.1']
+
+        retvalue = utils.probe_tcp_access(self.driver_mock, 'test01', port,
+                                          timeout=self.TIMEOUT,
+                                          banner=utils.SSH_BANNER)
+
+        self.assertEqual(retvalue, ('127.0.0.1', port))
+
+    def test_probe_banner_mismatch(self):
+        port = self._listen(banner=b'HTTP/1.1 400 Bad Request\r\n')
+        self.driver_mock.instance_address.return_value = ['127.0.0.1']
+
+        retvalue = utils.probe_tcp_access(self.driver_mock, 'test01', port,
+                                          timeout=self.TIMEOUT,
+                                          banner=utils.SSH_BANNER)
+
+        self.assertIs(retvalue, None)
 
-        sock.getsockopt.return_value = 0
-        sock.getpeername.return_value = self.addresses[0]
+    def test_probe_ipv6(self):
+        try:
+            port = self._listen('::1')
+        except socket.error:
+            self.skipTest('ipv6 loopback not available')
 
-        socket_mock.side_effect = self.sockets
-        time_mock.side_effect = [0, 0]
-        select_mock.return_value = (), (sock,), ()
+        self.driver_mock.instance_address.return_value = ['::1']
 
-        retvalue = utils.probe_tcp_access(self.driver_mock, None,
+        retvalue = utils.probe_tcp_access(self.driver_mock, 'test01', port,
                                           timeout=self.TIMEOUT)
 
-        self.assertEqual(retvalue, self.addresses[0])
+        self.assertEqual(retvalue, ('::1', port))
 
-        self._assert_sockets_calls()
+    def test_probe_instances(self):
+        open_port = self._listen()
+        closed_port = self._closed_port()
+        self.driver_mock.instance_address.side_effect = lambda vmid: {
+            'test01': ['127.0.0.1'],
+            'test02': ['127.0.0.2', '127.0.0.1'],
+        }[vmid]
 
-        sock.getsockopt.assert_called_with(SOL_SOCKET, SO_ERROR)
+        ready = utils.probe_instances(self.driver_mock, ['test01', 'test02'],
+                                      (open_port, closed_port),
+                                      timeout=self.TIMEOUT)
 
-    def _assert_sockets_calls(self):
-        for sock, address in zip(self.sockets, self.addresses):
-            sock.setblocking.assert_called_once_with(0)
-            sock.connect_ex.assert_called_once_with((address, 22))
-            sock.close.assert_called_once_with()
+        self.assertEqual(ready, {
+            ('test01', open_port): ('127.0.0.1', open_port),
+            ('test02', open_port): ('127.0.0.1', open_port),
+        })
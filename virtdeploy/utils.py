@@ -20,26 +20,440 @@
 
 from __future__ import absolute_import
 
+import collections
+import errno
+import heapq
+import importlib
 import os
 import random
-import select
+import re
+import signal
 import socket
 import string
 import subprocess
+import sys
+import threading
 import time
 
+from . import metrics
+from .errors import CommandTimeout
+from .errors import OperationCancelled
+from .errors import VirtDeployException
+
+try:
+    import selectors
+except ImportError:  # pragma: no cover
+    import selectors2 as selectors
+
 _PASSWORD_CHARS = string.ascii_letters + string.digits + '!#$%&'
 
+# Progress messages of the libguestfs tools (virt-builder, virt-customize,
+# virt-sysprep) are in the form: "[   2.4] Downloading: http://..."
+_PROGRESS_RE = re.compile(r'^\[\s*(\d+\.\d+)\]\s+(.*)$')
+
+OUTPUT_TAIL_LINES = 100
+OUTPUT_READ_SIZE = 4096
+
+# The progress bars (virt-builder) are redrawn with carriage returns
+_LINE_SEPARATOR_RE = re.compile(b'[\r\n]+')
+
+# Identification string sent by an ssh server as soon as it accepts
+SSH_BANNER = b'SSH-'
+BANNER_SIZE = 256
+
+_CONNECT_PENDING = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+
+# Grace period given to a process group between SIGTERM and SIGKILL
+KILL_GRACE = 5.0
+
+_WAIT_INTERVAL = 0.2
+
+PARALLEL_WORKERS = 8
+
+RECLAIM_STEP = 256 * 1024 * 1024
+
+COMMAND_DURATION = metrics.Histogram(
+    'virtdeploy_command_duration_seconds',
+    'Duration of the external commands', ('command',))
+COMMAND_FAILURES = metrics.Counter(
+    'virtdeploy_command_failures_total',
+    'External commands failed, timed out or cancelled', ('command',))
+
+# Each command runs in its own session so that on timeout, cancellation
+# or interruption the entire process tree (e.g. the libguestfs appliance)
+# can be terminated at once.
+if sys.version_info[0] == 3:  # pragma: no cover
+    _POPEN_SESSION = {'start_new_session': True}
+else:  # pragma: no cover
+    _POPEN_SESSION = {'preexec_fn': os.setsid}
+
+
+def execute(args, stdout=None, stderr=None, cwd=None, callback=None,
+            tail=OUTPUT_TAIL_LINES, timeout=None, cancel=None):
+    command = os.path.basename(args[0])
+
+    try:
+        with COMMAND_DURATION.time(command=command):
+            return _execute(args, stdout, stderr, cwd, callback, tail,
+                            timeout, cancel)
+    except Exception:
+        COMMAND_FAILURES.inc(command=command)
+        raise
+
 
-def execute(args, stdout=None, stderr=None, cwd=None):
-    p = subprocess.Popen(args, stdout=stdout, stderr=stderr, cwd=cwd)
+def _execute(args, stdout, stderr, cwd, callback, tail, timeout, cancel):
+    if callback is not None:
+        stdout, stderr = subprocess.PIPE, subprocess.STDOUT
 
-    out, err = p.communicate()
+    p = subprocess.Popen(args, stdout=stdout, stderr=stderr, cwd=cwd,
+                         **_POPEN_SESSION)
+
+    result = {'output': (None, None)}
+
+    if callback is None:
+        def reader():
+            result['output'] = p.communicate()
+    else:
+        # Only the last lines are kept for the error report, the complete
+        # output is never held in memory.
+        lines = collections.deque(maxlen=tail)
+
+        def reader():
+            for line in _read_lines(p.stdout):
+                line = line.decode('utf-8', 'replace')
+                lines.append(line)
+                callback(line)
+
+            p.stdout.close()
+            p.wait()
+
+    _wait_reader(p, args, reader, timeout, cancel)
 
     if p.returncode != 0:
-        raise subprocess.CalledProcessError(p.returncode, args)
+        if callback is None:
+            raise subprocess.CalledProcessError(p.returncode, args)
+
+        raise subprocess.CalledProcessError(p.returncode, args,
+                                            '\n'.join(lines))
+
+    return result['output']
+
+
+def _read_lines(f):
+    # The lines are split on carriage returns as well as on newlines, the
+    # output is read as soon as it is available (os.read).
+    pending = b''
+
+    for data in iter(lambda: os.read(f.fileno(), OUTPUT_READ_SIZE), b''):
+        lines = _LINE_SEPARATOR_RE.split(pending + data)
+        pending = lines.pop()
+
+        for line in lines:
+            if line:
+                yield line
+
+    if pending:
+        yield pending
+
+
+def _wait_reader(p, args, reader, timeout, cancel):
+    failure = []
+
+    def target():
+        try:
+            reader()
+        except Exception as e:
+            failure.append(e)
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+
+    if timeout is not None:
+        endtime = monotonic_time() + timeout
+
+    try:
+        while thread.is_alive():
+            if cancel is not None and cancel.is_set():
+                raise OperationCancelled(args[0])
+
+            if timeout is not None and monotonic_time() >= endtime:
+                raise CommandTimeout(args[0], timeout)
+
+            thread.join(_WAIT_INTERVAL)
+    except BaseException:
+        kill_process_group(p)
+        raise
+
+    if failure:
+        raise failure[0]
+
+
+def kill_process_group(p, grace=KILL_GRACE):
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+        return
+
+    endtime = monotonic_time() + grace
+
+    while p.poll() is None and monotonic_time() < endtime:
+        time.sleep(_WAIT_INTERVAL)
+
+    # Children may outlive the group leader, they are killed as well
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+    p.wait()
+
+
+# Compensating actions of a multi-stage operation: they are registered as
+# each stage completes and they are run in reverse order if the operation
+# fails, times out or is interrupted.
+class Rollback(object):
+    def __init__(self):
+        self._actions = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def add(self, func, *args, **kwargs):
+        self._actions.append((func, args, kwargs))
+
+    def commit(self):
+        self._actions = []
+
+    def rollback(self):
+        while self._actions:
+            func, args, kwargs = self._actions.pop()
+
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                pass  # best effort, the remaining actions are still run
+
+
+def parallel(func, items, workers=PARALLEL_WORKERS):
+    # Returns a (result, exception) pair for each item, in the same order
+    items = list(items)
+    results = [None] * len(items)
+    pending = collections.deque(enumerate(items))
+
+    def worker():
+        while True:
+            try:
+                index, item = pending.popleft()
+            except IndexError:
+                return
+
+            try:
+                results[index] = (func(item), None)
+            except Exception as e:
+                results[index] = (None, e)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(workers, len(items)))]
+
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    return results
+
+
+def parallel_graph(func, depends, workers=PARALLEL_WORKERS):
+    # Runs func on each item (the keys of depends) once the items it
+    # depends on succeeded, returns the (result, exception) of each item.
+    # The items depending on a failed one are not run.
+    cond = threading.Condition()
+    results = {}
+    pending = dict((k, set(v) & set(depends)) for k, v in depends.items())
+    running = set()
+
+    def next_item():
+        for item in sorted(pending):
+            failed = [x for x in pending[item]
+                      if x in results and results[x][1] is not None]
+
+            if failed:
+                del pending[item]
+                results[item] = (None, VirtDeployException(
+                    'Dependency {0} failed'.format(failed[0])))
+                return next_item()
+
+            if all(x in results for x in pending[item]):
+                del pending[item]
+                return item
+
+        return None
+
+    def worker():
+        with cond:
+            while True:
+                item = next_item()
+
+                if item is None:
+                    if not pending or not running:
+                        cond.notify_all()
+                        return
+                    cond.wait()
+                    continue
+
+                running.add(item)
+                cond.release()
+
+                try:
+                    result = (func(item), None)
+                except Exception as e:
+                    result = (None, e)
+                finally:
+                    cond.acquire()
+
+                running.discard(item)
+                results[item] = result
+                cond.notify_all()
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(workers, len(depends)))]
+
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    # Left over only by a dependency cycle
+    for item in pending:
+        results[item] = (None, VirtDeployException(
+            'Dependency cycle on {0}'.format(item)))
+
+    return results
+
+
+def filesystem_type(path, mounts='/proc/mounts'):
+    # The type of the filesystem mounted on the longest prefix of path
+    path = os.path.realpath(path)
+    fstype, mountpoint = None, ''
+
+    try:
+        with open(mounts) as f:
+            entries = [x.split() for x in f]
+    except IOError:
+        return None
+
+    for entry in entries:
+        if len(entry) < 3:
+            continue
+
+        # Spaces and other characters are octal escaped (e.g. \040)
+        target = re.sub(r'\\([0-7]{3})',
+                        lambda m: chr(int(m.group(1), 8)), entry[1])
+
+        if len(target) > len(mountpoint) and (
+                path == target or
+                path.startswith(target.rstrip('/') + '/')):
+            fstype, mountpoint = entry[2], target
+
+    return fstype
+
+
+def spawn_detached(args):
+    # The process is not waited and it outlives the caller (and its session)
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen(args, stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, **_POPEN_SESSION)
+
+
+def reclaim_file(path, rate, step=RECLAIM_STEP):
+    # Large files are truncated in steps before the unlink, so that the
+    # extents are freed at the given rate (bytes per second) instead of in
+    # a single long i/o burst. Returns the bytes freed.
+    try:
+        f = open(path, 'r+b')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return 0
+        raise
+
+    with f:
+        stat = os.fstat(f.fileno())
+        size = stat.st_size
+
+        while size > step:
+            size -= step
+            f.truncate(size)
+            time.sleep(float(step) / rate)
+
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return 0
+
+    return stat.st_blocks * 512
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TiB'
+
+    return '{0:.1f} {1}'.format(size, unit)
+
+
+def parse_progress(line):
+    match = _PROGRESS_RE.match(line)
+
+    if match is None:
+        return None
+
+    return {'elapsed': float(match.group(1)), 'message': match.group(2)}
+
+
+def parse_files(files):
+    # The files to copy (SOURCE:DIRECTORY) as (source, directory) pairs,
+    # the source itself may contain colons.
+    result = []
 
-    return out, err
+    for x in files or ():
+        source, _, directory = x.rpartition(':')
+
+        if not source or not directory:
+            raise VirtDeployException(
+                'Invalid file {0}, SOURCE:DIRECTORY expected'.format(x))
+
+        result.append((source, directory))
+
+    return result
+
+
+class LazyModule(object):
+    # A module imported on its first use, for the dependencies that are
+    # slow to import (libvirt, lxml) and not needed by every command.
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
 
 
 def random_password(size=12):
@@ -51,44 +465,196 @@ def monotonic_time():
     return os.times()[4]
 
 
-def probe_tcp_access(driver, vmid, port=22, timeout=10):
-    sockets = list()
-    endtime = monotonic_time() + timeout
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+        if e.errno != errno.EPERM:
+            raise
 
-    for address in driver.instance_address(vmid):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setblocking(0)
-        sock.connect_ex((address, port))
-        sockets.append(sock)
+    return True
 
-    address_found = None
 
-    while sockets and address_found is None:
-        remaining = endtime - monotonic_time()
+class TcpProber(object):
+    # Probes many (address, port) targets concurrently, the readiness of
+    # each key is reported by the first of its targets that accepts the
+    # connection and, when requested, sends the expected banner.
 
-        if remaining <= 0:
-            break
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._deadlines = []
+        self._sequence = 0
+        self._targets = {}
+        self.ready = {}
 
-        _, response, _ = select.select((), sockets, (), remaining)
+    def add(self, key, address, port, timeout, banner=None):
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
 
-        for sock in response:
-            e = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(0)
 
-            if e == 0:
-                address_found = sock.getpeername()
+        e = sock.connect_ex((address, port))
 
+        if e not in _CONNECT_PENDING:
             sock.close()
-            sockets.remove(sock)
+            return
+
+        target = {
+            'key': key,
+            'address': address,
+            'port': port,
+            'banner': banner,
+            'received': b'',
+            'sock': sock,
+        }
+
+        self._selector.register(sock, selectors.EVENT_WRITE, target)
+        self._targets.setdefault(key, []).append(target)
+
+        self._sequence += 1
+        heapq.heappush(self._deadlines, (monotonic_time() + timeout,
+                                         self._sequence, target))
+
+    def run(self):
+        try:
+            while self._expire():
+                remaining = self._deadlines[0][0] - monotonic_time()
+
+                for selkey, events in self._selector.select(remaining):
+                    self._process(selkey.data, events)
+        finally:
+            self.close()
+
+        return self.ready
+
+    def close(self):
+        for _, _, target in self._deadlines:
+            self._discard(target)
+
+        self._deadlines = []
+        self._selector.close()
+
+    def _expire(self):
+        now = monotonic_time()
+
+        while self._deadlines:
+            deadline, _, target = self._deadlines[0]
+
+            if target['sock'] is not None and deadline > now:
+                return True
+
+            heapq.heappop(self._deadlines)
+            self._discard(target)
+
+        return False
+
+    def _discard(self, target):
+        if target['sock'] is None:
+            return
 
-    for sock in list(sockets):
-        sock.close()
-        sockets.remove(sock)
+        self._selector.unregister(target['sock'])
+        target['sock'].close()
+        target['sock'] = None
 
-    return address_found
+    def _process(self, target, events):
+        if target['sock'] is None:
+            return  # discarded while processing the same selection
+        elif events & selectors.EVENT_WRITE:
+            self._connected(target)
+        else:
+            self._received(target)
+
+    def _connected(self, target):
+        sock = target['sock']
+
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            self._discard(target)
+        elif target['banner'] is None:
+            self._set_ready(target)
+        else:
+            self._selector.modify(sock, selectors.EVENT_READ, target)
+
+    def _received(self, target):
+        # The banner may be split across segments, it's compared once
+        # complete (or it's already wrong), until the deadline.
+        banner = target['banner']
+
+        try:
+            data = target['sock'].recv(BANNER_SIZE)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = b''
+
+        if not data:
+            self._discard(target)
+            return
+
+        target['received'] += data
+        received = target['received'][:len(banner)]
+
+        if not banner.startswith(received):
+            self._discard(target)
+        elif len(received) == len(banner):
+            self._set_ready(target)
+
+    def _set_ready(self, target):
+        self.ready[target['key']] = (target['address'], target['port'])
+
+        # The other targets of the same key are not needed anymore
+        for x in self._targets.pop(target['key']):
+            self._discard(x)
+
+
+def probe_instances(driver, vmids, ports=(22,), timeout=10, banner=None):
+    prober = TcpProber()
+
+    for vmid in vmids:
+        for address in driver.instance_address(vmid):
+            for port in ports:
+                prober.add((vmid, port), address, port, timeout, banner)
+
+    return prober.run()
+
+
+def probe_tcp_access(driver, vmid, port=22, timeout=10, banner=None):
+    ready = probe_instances(driver, (vmid,), (port,), timeout, banner)
+    return ready.get((vmid, port))
+
+
+def wait_instance(driver, vmid, port=22, timeout=180, interval=1.0,
+                  banner=SSH_BANNER):
+    # The guest agent reports the completed boot without any network
+    # access, the tcp probe covers the guests where it is not running.
+    endtime = monotonic_time() + timeout
+
+    while True:
+        probetime = monotonic_time()
+
+        if driver.instance_ready(vmid):
+            return True
+
+        remaining = min(interval, endtime - monotonic_time())
+
+        if remaining <= 0:
+            return False
+
+        if probe_tcp_access(driver, vmid, port, remaining,
+                            banner) is not None:
+            return True
+
+        nexttry = probetime + interval
+
+        if nexttry >= endtime:
+            return False
+
+        time.sleep(max(0, nexttry - monotonic_time()))
 
 
 def wait_tcp_access(driver, vmid, port=22, timeout=180,
-                    mininterval=5.0, maxinterval=10.0):
+                    mininterval=5.0, maxinterval=10.0, banner=None):
     endtime = monotonic_time() + timeout
 
     while True:
@@ -98,7 +664,8 @@ def wait_tcp_access(driver, vmid, port=22, timeout=180,
         if remaining <= 0:
             return None
 
-        address_found = probe_tcp_access(driver, vmid, port, remaining)
+        address_found = probe_tcp_access(driver, vmid, port, remaining,
+                                         banner)
 
         if address_found is not None:
             return address_found